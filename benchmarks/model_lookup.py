@@ -0,0 +1,104 @@
+"""Micro-benchmark of looking up models, and of converting loaded chats.
+
+Compares `get_model` (which uses the config's `ModelRegistry`) with building
+the ID and name indexes on every lookup, as `get_model` used to, and converting
+a chat which looks its model up once with looking it up for every message.
+
+    python benchmarks/model_lookup.py
+"""
+
+import timeit
+from datetime import UTC, datetime
+from types import SimpleNamespace
+
+from textual._context import active_app
+
+from elia_chat.config import EliaChatModel, LaunchConfig
+from elia_chat.database.converters import (
+    chat_dao_to_chat_data,
+    message_dao_to_chat_message,
+)
+from elia_chat.database.models import ChatDao, MessageDao
+from elia_chat.models import UnknownModel, get_model
+
+REPEATS = 5
+
+
+def get_model_without_registry(
+    model_id_or_name: str, config: LaunchConfig
+) -> EliaChatModel:
+    """How models were looked up before `ModelRegistry`."""
+    try:
+        return {model.id: model for model in config.all_models}[model_id_or_name]
+    except KeyError:
+        try:
+            return {model.name: model for model in config.all_models}[model_id_or_name]
+        except KeyError:
+            pass
+    return UnknownModel(id="unknown", name="unknown model")
+
+
+def best_time(statement, number: int) -> float:
+    """The best time of a call to `statement`, in seconds."""
+    return min(timeit.repeat(statement, number=number, repeat=REPEATS)) / number
+
+
+def benchmark_lookups(config: LaunchConfig) -> None:
+    keys = {
+        "first model's ID": config.all_models[0].id or config.all_models[0].name,
+        "last model's name": config.all_models[-1].name,
+        "unknown model": "not-a-model",
+    }
+    print(f"Looking up a model among {len(config.all_models)}:")
+    for description, key in keys.items():
+        before = best_time(lambda: get_model_without_registry(key, config), 10_000)
+        after = best_time(lambda: get_model(key, config), 10_000)
+        print(
+            f"  {description:<20} {before * 1e6:6.2f} µs -> {after * 1e6:6.2f} µs "
+            f"({before / after:.0f}x)"
+        )
+
+
+def benchmark_chat_conversion(config: LaunchConfig, message_count: int) -> None:
+    model = config.all_models[-1]
+    chat = ChatDao(id=1, model=model.name, title="Benchmark", started_at=None)
+    now = datetime.now(UTC)
+    messages = [
+        MessageDao(
+            id=index,
+            chat_id=1,
+            role="user" if index % 2 else "assistant",
+            content=f"Message {index}",
+            timestamp=now,
+        )
+        for index in range(message_count)
+    ]
+
+    def convert_looking_up_every_message() -> None:
+        # Before `ModelRegistry`, the model was looked up for each message.
+        for message in messages:
+            model = get_model_without_registry(chat.model, config)
+            message_dao_to_chat_message(message, model)
+
+    before = best_time(convert_looking_up_every_message, 1)
+    after = best_time(lambda: chat_dao_to_chat_data(chat, messages), 1)
+    print(
+        f"Converting a chat with {message_count:,} messages: "
+        f"{before * 1e3:.1f} ms -> {after * 1e3:.1f} ms"
+    )
+
+
+def main() -> None:
+    config = LaunchConfig()
+    app = SimpleNamespace(launch_config=config)
+    token = active_app.set(app)  # type: ignore
+    try:
+        benchmark_lookups(config)
+        for message_count in (5_000, 50_000):
+            benchmark_chat_conversion(config, message_count)
+    finally:
+        active_app.reset(token)
+
+
+if __name__ == "__main__":
+    main()
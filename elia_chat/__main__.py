@@ -3,28 +3,50 @@ Elia CLI
 """
 
 import asyncio
+from datetime import datetime
+import os
 import pathlib
+import subprocess
+import sys
 from textwrap import dedent
 import tomllib
 from typing import Any
 
 import click
+import humanize
 from click_default_group import DefaultGroup
 
 from rich.console import Console
 
 from elia_chat.app import Elia
-from elia_chat.config import LaunchConfig
-from elia_chat.database.import_chatgpt import import_chatgpt_data
-from elia_chat.database.database import create_database, sqlite_file_name
+from elia_chat.config import DatabaseConfig, LaunchConfig
+from elia_chat.database.export import (
+    COMPRESSION_SUFFIXES,
+    ArchivedFilter,
+    Compression,
+    ExportError,
+    ExportFilters,
+    ExportFormat,
+    export_chats,
+)
+from elia_chat.database.import_chatgpt import ImportFormatError, import_chatgpt_data
+from elia_chat.database.database import (
+    archive_file_name,
+    configure_database,
+    create_database,
+    engine,
+    sqlite_file_name,
+)
 from elia_chat.locations import config_file
 
 console = Console()
 
 def create_db_if_not_exists() -> None:
+    """Create the database if it doesn't exist, otherwise apply any
+    pending migrations to it."""
     if not sqlite_file_name.exists():
         click.echo(f"Creating database at {sqlite_file_name!r}")
-        asyncio.run(create_database())
+    asyncio.run(create_database())
 
 def load_or_create_config_file() -> dict[str, Any]:
     config = config_file()
@@ -40,6 +62,12 @@ def load_or_create_config_file() -> dict[str, Any]:
 
     return file_config
 
+def configure_database_from_config_file() -> None:
+    """Apply the `[database]` options from the config file, for commands
+    which don't otherwise need the config."""
+    file_config = load_or_create_config_file()
+    configure_database(DatabaseConfig(**file_config.get("database", {})))
+
 @click.group(cls=DefaultGroup, default="default", default_if_no_args=True)
 def cli() -> None:
     """Interact with large language models using your terminal."""
@@ -63,15 +91,32 @@ def cli() -> None:
 def default(prompt: tuple[str, ...], model: str, inline: bool) -> None:
     prompt = prompt or ("",)
     joined_prompt = " ".join(prompt)
-    create_db_if_not_exists()
     file_config = load_or_create_config_file()
     cli_config = {}
     if model:
         cli_config["default_model"] = model
 
-    launch_config: dict[str, Any] = {**file_config, **cli_config}
-    app = Elia(LaunchConfig(**launch_config), startup_prompt=joined_prompt)
+    launch_config = LaunchConfig(**{**file_config, **cli_config})
+    configure_database(launch_config.database)
+    create_db_if_not_exists()
+    app = Elia(launch_config, startup_prompt=joined_prompt)
     app.run(inline=inline)
+    if launch_config.database.optimize_on_exit:
+        optimize_in_background()
+
+def optimize_in_background() -> None:
+    """Run a quick `elia db optimize` in a detached, low-priority process, so
+    the query planner's statistics stay fresh without delaying the exit."""
+    try:
+        subprocess.Popen(
+            [sys.executable, "-m", "elia_chat", "db", "optimize", "--on-exit"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError:
+        pass
 
 @cli.command()
 def reset() -> None:
@@ -100,7 +145,15 @@ You may wish to create a backup of \
         )
     )
     if click.confirm("Delete all chats?", abort=True):
-        sqlite_file_name.unlink(missing_ok=True)
+        configure_database_from_config_file()
+        for database_file in (sqlite_file_name, archive_file_name):
+            database_file.unlink(missing_ok=True)
+            # Remove the write-ahead log too, so it isn't replayed into the
+            # new database.
+            for suffix in ("-wal", "-shm"):
+                database_file.with_name(database_file.name + suffix).unlink(
+                    missing_ok=True
+                )
         asyncio.run(create_database())
         console.print(f"♻️  Database reset @ {sqlite_file_name}")
 
@@ -111,15 +164,414 @@ You may wish to create a backup of \
         exists=True, dir_okay=False, path_type=pathlib.Path, resolve_path=True
     ),
 )
-def import_file_to_db(file: pathlib.Path) -> None:
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=0),
+    default=0,
+    help="The number of processes used to convert conversations (0 to use none).",
+)
+def import_file_to_db(file: pathlib.Path, workers: int) -> None:
     """
     Import ChatGPT Conversations
 
     This command will import the ChatGPT conversations from a local
     JSON file into the database.
     """
-    asyncio.run(import_chatgpt_data(file=file))
+    configure_database_from_config_file()
+    create_db_if_not_exists()
+    try:
+        asyncio.run(import_chatgpt_data(file=file, workers=workers))
+    except ImportFormatError as error:
+        raise click.ClickException(f"Couldn't import {str(file)!r}: {error}")
     console.print(f"[green]ChatGPT data imported from {str(file)!r}")
 
+@cli.command("export")
+@click.argument("output", type=click.Path(path_type=pathlib.Path, allow_dash=True))
+@click.option(
+    "-f",
+    "--format",
+    "export_format",
+    type=click.Choice(["jsonl", "markdown"]),
+    default="jsonl",
+    show_default=True,
+    help="JSONL writes one chat per line to OUTPUT. "
+    "Markdown writes one file per chat into the directory OUTPUT.",
+)
+@click.option(
+    "-c",
+    "--compress",
+    "compression",
+    type=click.Choice(["gzip", "zstd"]),
+    default=None,
+    help="Compress the output. "
+    "Inferred from the extension of OUTPUT (.gz or .zst) if not given.",
+)
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    default=None,
+    help="Only export chats started on or after this date.",
+)
+@click.option(
+    "--until",
+    type=click.DateTime(),
+    default=None,
+    help="Only export chats started before this date.",
+)
+@click.option(
+    "-m",
+    "--model",
+    "models",
+    type=str,
+    multiple=True,
+    help="Only export chats with this model. May be given more than once.",
+)
+@click.option(
+    "--archived",
+    type=click.Choice(["include", "exclude", "only"]),
+    default="include",
+    show_default=True,
+    help="Whether to export archived chats.",
+)
+def export_db_to_file(
+    output: pathlib.Path,
+    export_format: ExportFormat,
+    compression: Compression | None,
+    since: datetime | None,
+    until: datetime | None,
+    models: tuple[str, ...],
+    archived: ArchivedFilter,
+) -> None:
+    """
+    Export chats
+
+    This command will export chats and their messages from the database,
+    either as JSON Lines, or as a directory of Markdown files.
+    Use '-' as the OUTPUT to write JSON Lines to stdout.
+    """
+    to_stdout = str(output) == "-"
+    if compression is None and not to_stdout:
+        suffixes = {suffix: name for name, suffix in COMPRESSION_SUFFIXES.items()}
+        compression = suffixes.get(output.suffix)
+
+    configure_database_from_config_file()
+    create_db_if_not_exists()
+    filters = ExportFilters(since=since, until=until, models=models, archived=archived)
+    try:
+        progress = asyncio.run(
+            export_chats(
+                None if to_stdout else output,
+                export_format=export_format,
+                compression=compression,
+                filters=filters,
+            )
+        )
+    except ExportError as error:
+        raise click.ClickException(str(error))
+    if not to_stdout:
+        console.print(
+            f"[green]Exported {progress.chat_count} chats to {str(output)!r}"
+        )
+
+@cli.group()
+def db() -> None:
+    """Manage the database."""
+
+@db.command("compress")
+@click.option(
+    "-t",
+    "--threshold",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Compress messages with at least this many characters. "
+    "Defaults to 'compression_threshold' from the [database] config.",
+)
+@click.option(
+    "--retrain/--no-retrain",
+    default=True,
+    show_default=True,
+    help="Train a new dictionary from the messages in the database. "
+    "Otherwise, the latest dictionary is reused (if there is one).",
+)
+@click.option(
+    "--vacuum/--no-vacuum",
+    default=True,
+    show_default=True,
+    help="Rebuild the database file afterwards, to reclaim the space saved.",
+)
+@click.option(
+    "--benchmark",
+    is_flag=True,
+    default=False,
+    help="Measure the compression ratio and decoding speed on a sample "
+    "of messages, without changing the database.",
+)
+def compress_db(
+    threshold: int | None, retrain: bool, vacuum: bool, benchmark: bool
+) -> None:
+    """
+    Compress stored messages
+
+    This command will compress the messages in the database which are
+    longer than the threshold (using a dictionary trained from the
+    messages already in the database), and decompress any shorter ones.
+    Set 'compress_messages = true' in the [database] config to also
+    compress new messages.
+    """
+    from rich.live import Live
+    from rich.table import Table
+
+    from elia_chat.database import compression
+    from elia_chat.database.database import database_config
+
+    configure_database_from_config_file()
+    create_db_if_not_exists()
+    if threshold is None:
+        threshold = database_config().compression_threshold
+
+    if benchmark:
+        samples = asyncio.run(compression.sample_messages())
+        results = compression.benchmark_codecs(samples, threshold)
+        if not results[0].raw_bytes:
+            raise click.ClickException(
+                f"No sampled messages have at least {threshold} characters."
+            )
+        table = Table(title=f"Messages with at least {threshold} characters")
+        table.add_column("Codec")
+        for heading in ("Size", "Compressed", "Ratio", "Decoding"):
+            table.add_column(heading, justify="right")
+        for result in results:
+            table.add_row(
+                result.name,
+                humanize.naturalsize(result.raw_bytes),
+                humanize.naturalsize(result.compressed_bytes),
+                f"{result.ratio:.2f}x",
+                f"{result.decode_mb_per_second:.0f} MB/s",
+            )
+        console.print(table)
+        return
+
+    async def run() -> None:
+        dictionary = None
+        if retrain:
+            samples = await compression.sample_messages()
+            dictionary = await compression.create_dictionary(samples)
+        dictionary = dictionary or compression.current_dictionary()
+        progress = compression.RecompressProgress()
+        with Live(progress, console=console, refresh_per_second=4):
+            await compression.recompress_messages(threshold, dictionary, progress)
+        if vacuum:
+            with console.status("Vacuuming the database"):
+                await compression.vacuum()
+        await engine.dispose()
+
+    asyncio.run(run())
+    console.print(f"[green]Compressed messages in {str(sqlite_file_name)!r}")
+
+@db.command("decompress")
+@click.option(
+    "--vacuum/--no-vacuum",
+    default=True,
+    show_default=True,
+    help="Rebuild the database file afterwards.",
+)
+def decompress_db(vacuum: bool) -> None:
+    """
+    Decompress stored messages
+
+    This command will store every message in the database as plain text.
+    Set 'compress_messages = false' in the [database] config first, or
+    new messages will still be compressed.
+    """
+    from rich.live import Live
+
+    from elia_chat.database import compression
+
+    configure_database_from_config_file()
+    create_db_if_not_exists()
+
+    async def run() -> None:
+        progress = compression.RecompressProgress()
+        with Live(progress, console=console, refresh_per_second=4):
+            await compression.recompress_messages(None, None, progress)
+        if vacuum:
+            with console.status("Vacuuming the database"):
+                await compression.vacuum()
+        await engine.dispose()
+
+    asyncio.run(run())
+    console.print(f"[green]Decompressed messages in {str(sqlite_file_name)!r}")
+
+@db.command("stats")
+@click.option(
+    "-n",
+    "--largest",
+    type=click.IntRange(min=0),
+    default=10,
+    show_default=True,
+    help="The number of largest chats to list.",
+)
+def db_stats(largest: int) -> None:
+    """
+    Show database statistics
+
+    This command will show the size of the database files and how much
+    of them is free space, the number of rows and the size of each table
+    and index, the largest chats, and how the most common queries use
+    the indexes.
+    """
+    from rich.table import Table
+
+    from elia_chat.database.maintenance import database_stats
+
+    configure_database_from_config_file()
+    create_db_if_not_exists()
+
+    async def run():
+        try:
+            return await database_stats(largest_chats=largest)
+        finally:
+            await engine.dispose()
+
+    stats = asyncio.run(run())
+
+    files = Table(title="Database files")
+    files.add_column("Database")
+    for heading in ("Size", "WAL", "Pages", "Free pages"):
+        files.add_column(heading, justify="right")
+    files.add_column("Auto-vacuum")
+    for file in stats.files:
+        files.add_row(
+            file.path.name,
+            humanize.naturalsize(file.file_size),
+            humanize.naturalsize(file.wal_size),
+            f"{file.page_count:,}",
+            f"{humanize.naturalsize(file.free_bytes)} ({file.fragmentation:.0%})",
+            file.auto_vacuum,
+        )
+    console.print(files)
+
+    tables = Table(title="Tables and indexes")
+    tables.add_column("Name")
+    for heading in ("Rows", "Size", "Unused"):
+        tables.add_column(heading, justify="right")
+    tables.add_column("Index statistics")
+    for table in stats.tables:
+        name = table.name if table.type == "table" else f"  {table.name}"
+        if table.schema != "main":
+            name = f"{table.schema}.{name.strip()}"
+            name = name if table.type == "table" else f"  {name}"
+        tables.add_row(
+            name,
+            "" if table.rows is None else f"{table.rows:,}",
+            "" if table.size is None else humanize.naturalsize(table.size),
+            "" if table.unused is None else humanize.naturalsize(table.unused),
+            table.stat or "",
+            style="dim" if table.type == "index" else None,
+        )
+    console.print(tables)
+
+    if stats.largest_chats:
+        chats = Table(title="Largest chats")
+        chats.add_column("ID", justify="right")
+        chats.add_column("Title")
+        chats.add_column("Messages", justify="right")
+        chats.add_column("Size", justify="right")
+        for chat in stats.largest_chats:
+            title = chat.title or ""
+            if chat.schema != "main":
+                title = f"{title} [dim](archived)[/]"
+            chats.add_row(
+                str(chat.chat_id),
+                title,
+                f"{chat.message_count:,}",
+                humanize.naturalsize(chat.size),
+            )
+        console.print(chats)
+
+    for plan in stats.query_plans:
+        console.print(f"[b]{plan.name}[/b]")
+        for step in plan.steps:
+            style = "yellow" if step in plan.full_scans else "dim"
+            console.print(f"  {step}", style=style, highlight=False)
+
+@db.command("optimize")
+@click.option(
+    "--full-vacuum",
+    is_flag=True,
+    default=False,
+    help="Rebuild the database files, which defragments them. "
+    "Otherwise, free pages are released without a rebuild where possible.",
+)
+@click.option("--on-exit", is_flag=True, default=False, hidden=True)
+def db_optimize(full_vacuum: bool, on_exit: bool) -> None:
+    """
+    Optimize the database
+
+    This command will refresh the statistics SQLite uses to plan queries,
+    merge the search index, release unused space back to the filesystem
+    and checkpoint the write-ahead log. Elia should not be running.
+    """
+    from elia_chat.database.maintenance import optimize_database
+
+    configure_database_from_config_file()
+
+    async def run():
+        try:
+            return await optimize_database(full_vacuum=full_vacuum, quick=on_exit)
+        finally:
+            await engine.dispose()
+
+    if on_exit:
+        # Run after Elia exits, in the background: give way to anything else.
+        try:
+            os.nice(19)
+        except (AttributeError, OSError):
+            pass
+        if sqlite_file_name.exists():
+            asyncio.run(run())
+        return
+
+    create_db_if_not_exists()
+    with console.status("Optimizing the database"):
+        result = asyncio.run(run())
+    for step in result.steps:
+        console.print(f"{step.description} [dim]({step.seconds:.2f}s)[/]")
+    console.print(
+        f"[green]Optimized {str(sqlite_file_name)!r}: "
+        f"{humanize.naturalsize(result.size_before)} → "
+        f"{humanize.naturalsize(result.size_after)}"
+    )
+
+@db.command("check")
+def db_check() -> None:
+    """
+    Check the database for corruption
+
+    This command will check the integrity of the database files, the
+    search index and the compressed messages.
+    """
+    from elia_chat.database.maintenance import check_database
+
+    configure_database_from_config_file()
+    create_db_if_not_exists()
+
+    async def run():
+        try:
+            return await check_database()
+        finally:
+            await engine.dispose()
+
+    with console.status("Checking the database"):
+        problems = asyncio.run(run())
+    if problems:
+        for problem in problems:
+            console.print(f"[red]{problem}", highlight=False)
+        raise click.ClickException(
+            f"Found {len(problems)} {'problem' if len(problems) == 1 else 'problems'}."
+        )
+    console.print(f"[green]No problems found in {str(sqlite_file_name)!r}")
+
 if __name__ == "__main__":
     cli()
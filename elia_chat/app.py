@@ -4,6 +4,7 @@ import datetime
 from pathlib import Path
 from typing import TYPE_CHECKING
 
+from textual import work
 from textual.app import App
 from textual.binding import Binding
 from textual.reactive import Reactive, reactive
@@ -17,6 +18,7 @@ from elia_chat.screens.chat_screen import ChatScreen
 from elia_chat.screens.help_screen import HelpScreen
 from elia_chat.screens.home_screen import HomeScreen
 from elia_chat.themes import BUILTIN_THEMES, Theme, load_user_themes
+from elia_chat.tokens import backfill_token_counts
 
 if TYPE_CHECKING:
     from litellm.types.completion import (
@@ -92,12 +94,20 @@ class Elia(App[None]):
     async def on_mount(self) -> None:
         await self.push_screen(HomeScreen(self.runtime_config_signal))
         self.theme = self._config_theme
+        self.backfill_token_counts()
         if self.startup_prompt:
             await self.launch_chat(
                 prompt=self.startup_prompt,
                 model=self.runtime_config.selected_model,
             )
 
+    @work(exclusive=True, group="token_backfill")
+    async def backfill_token_counts(self) -> None:
+        """Count the tokens of messages saved before they were counted (e.g. in
+        imported chats), so that they don't need to be counted when they're
+        next sent. See `elia_chat.tokens`."""
+        await backfill_token_counts()
+
     async def launch_chat(self, prompt: str, model: EliaChatModel) -> None:
         current_time = datetime.datetime.now(datetime.timezone.utc)
         system_message: ChatCompletionSystemMessageParam = {
@@ -1,36 +1,352 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, replace
 import datetime
+import json
+from typing import TYPE_CHECKING, ClassVar, Iterable
 
-from sqlmodel import select
+from sqlalchemy import delete, func, insert, update
+from sqlmodel import col
+from sqlmodel.ext.asyncio.session import AsyncSession
 from textual import log
 
+from elia_chat.database import archive
+from elia_chat.database.compression import compress_content
 from elia_chat.database.converters import (
     chat_dao_to_chat_data,
-    chat_message_to_message_dao,
+    chat_message_to_message_row,
+    chat_summary_row_to_chat_summary,
     message_dao_to_chat_message,
+    search_row_to_message_search_result,
 )
 from elia_chat.database.database import get_session
-from elia_chat.database.models import ChatDao, MessageDao
-from elia_chat.models import ChatData, ChatMessage
+from elia_chat.database.models import ChatDao, MessageDao, SystemPromptsDao
+from elia_chat.models import (
+    SEARCH_MATCH_END,
+    SEARCH_MATCH_START,
+    ChatData,
+    ChatMessage,
+    ChatSummary,
+    MessageSearchResult,
+    get_model,
+)
+
+if TYPE_CHECKING:
+    from litellm.types.completion import ChatCompletionMessageParam
+
+MIN_PREFIX_SEARCH_LENGTH = 3
+"""The final word of a search only matches as a prefix if it's at least this long."""
+
+
+def build_match_query(search_text: str) -> str:
+    """Convert text entered by the user into an FTS5 query.
+
+    Each word must appear in the message, and the final word may be a prefix,
+    since the user may not have finished typing it. Words are quoted so that
+    FTS5 syntax in the search text is matched literally.
+    """
+    words = search_text.split()
+    if not words:
+        return ""
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    # Very short prefixes match (and so must rank) a large fraction of all
+    # messages, which is slow on big databases.
+    if len(words[-1]) >= MIN_PREFIX_SEARCH_LENGTH:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+@dataclass
+class ChatCacheInfo:
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size: int
+    """The approximate size of the cached chats, in bytes."""
+
+
+CACHED_MESSAGE_OVERHEAD = 256
+"""Roughly how many bytes a cached message uses, in addition to its content."""
+
+
+def _copy_chat_data(chat_data: ChatData) -> ChatData:
+    # Chats are modified by the screens they're shown on (e.g. messages are
+    # added, and responses stream into them), so the cache never hands out the
+    # objects it holds.
+    return replace(
+        chat_data,
+        messages=[
+            replace(
+                message,
+                message=message.message.copy(),  # type: ignore
+                token_counts=message.token_counts.copy(),
+            )
+            for message in chat_data.messages
+        ],
+    )
+
+
+def _chat_data_size(chat_data: ChatData) -> int:
+    size = 0
+    for message in chat_data.messages:
+        content = message.message.get("content")
+        size += CACHED_MESSAGE_OVERHEAD
+        if isinstance(content, str):
+            size += len(content)
+    return size
+
+
+class ChatDataCache:
+    """The chats most recently loaded by `ChatsManager.get_chat`, so that
+    reopening a chat doesn't need to query the database.
+
+    The least recently used chats are evicted once there are more than
+    `max_entries` of them, or they add up to more than roughly `max_size` bytes.
+    Entries are invalidated by `ChatsManager`'s methods which change chats.
+    """
+
+    def __init__(self, max_entries: int = 32, max_size: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._entries: OrderedDict[tuple, tuple[ChatData, int]] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> ChatData | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return _copy_chat_data(entry[0])
+
+    def put(self, key: tuple, chat_data: ChatData) -> None:
+        self._discard(key)
+        size = _chat_data_size(chat_data)
+        if size > self.max_size:
+            return
+        self._entries[key] = (_copy_chat_data(chat_data), size)
+        self._size += size
+        while len(self._entries) > self.max_entries or self._size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, chat_id: int) -> None:
+        """Remove every cached copy of a chat."""
+        for key in [key for key in self._entries if key[0] == chat_id]:
+            self._discard(key)
+
+    def invalidate_message(self, message_id: int) -> None:
+        """Remove every cached chat containing a message."""
+        for key, (chat_data, _) in list(self._entries.items()):
+            if any(message.id == message_id for message in chat_data.messages):
+                self._discard(key)
+
+    def rename(self, chat_id: int, title: str) -> None:
+        for key, (chat_data, _) in self._entries.items():
+            if key[0] == chat_id:
+                chat_data.title = title
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def info(self) -> ChatCacheInfo:
+        return ChatCacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._entries),
+            size=self._size,
+        )
+
+    def _discard(self, key: tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+
+def message_key(message: ChatMessage) -> tuple[datetime.datetime, int]:
+    """Return the `(timestamp, id)` key messages are ordered by within a chat.
+    The message must have been loaded from the database."""
+    assert message.timestamp is not None and message.id is not None
+    return message.timestamp, message.id
 
 
 @dataclass
 class ChatsManager:
+    cache: ClassVar[ChatDataCache] = ChatDataCache()
+    """Chats loaded by `get_chat`. See `ChatDataCache`."""
+
     @staticmethod
     async def all_chats() -> list[ChatData]:
         chat_daos = await ChatDao.all()
         return [chat_dao_to_chat_data(chat) for chat in chat_daos]
 
     @staticmethod
-    async def get_chat(chat_id: int) -> ChatData:
-        chat_dao = await ChatDao.from_id(chat_id)
-        return chat_dao_to_chat_data(chat_dao)
+    async def chat_summaries_page(
+        after: ChatSummary | None = None, limit: int = 100
+    ) -> list[ChatSummary]:
+        """Return up to `limit` chat summaries, most recently active first.
+
+        Args:
+            after: The last chat summary of the previous page, or None to
+                get the first page.
+            limit: The maximum number of summaries to return.
+        """
+        keyset = None
+        if after is not None and after.last_message_timestamp is not None:
+            keyset = (after.last_message_timestamp, after.id)
+        rows = await ChatDao.summaries_page(after=keyset, limit=limit)
+        return [chat_summary_row_to_chat_summary(row) for row in rows]
+
+    @staticmethod
+    async def archived_chat_summaries_page(
+        after: ChatSummary | None = None, limit: int = 100
+    ) -> list[ChatSummary]:
+        """Return up to `limit` summaries of archived chats, most recently
+        active first. See `chat_summaries_page`."""
+        keyset = None
+        if after is not None and after.last_message_timestamp is not None:
+            keyset = (after.last_message_timestamp, after.id)
+        rows = await ChatDao.summaries_page(after=keyset, limit=limit, archived=True)
+        return [chat_summary_row_to_chat_summary(row) for row in rows]
+
+    @staticmethod
+    async def count_chats() -> int:
+        return await ChatDao.count()
+
+    @staticmethod
+    async def count_archived_chats() -> int:
+        return await ChatDao.count(archived=True)
+
+    @staticmethod
+    async def search(search_text: str, limit: int = 50) -> list[MessageSearchResult]:
+        """Search all messages in non-archived chats, best matches first."""
+        match_query = build_match_query(search_text)
+        if not match_query:
+            return []
+        rows = await MessageDao.search(
+            match_query, SEARCH_MATCH_START, SEARCH_MATCH_END, limit=limit
+        )
+        return [search_row_to_message_search_result(row) for row in rows]
+
+    @staticmethod
+    async def get_chat(
+        chat_id: int,
+        message_limit: int | None = None,
+        include_message_id: int | None = None,
+    ) -> ChatData:
+        """Load a chat and its messages.
+
+        Args:
+            chat_id: The ID of the chat.
+            message_limit: If given, only load the first message (the system
+                prompt) and this many of the most recent messages. The others
+                can be loaded later with `get_older_messages`.
+            include_message_id: When `message_limit` is given, load enough
+                messages to include the message with this ID.
+        """
+        cache_key = (chat_id, message_limit, include_message_id)
+        chat_data = ChatsManager.cache.get(cache_key)
+        if chat_data is not None:
+            log.debug(
+                f"Chat {chat_id!r} loaded from cache: {ChatsManager.cache.info()}"
+            )
+            return chat_data
+
+        if message_limit is None:
+            chat_dao = await ChatDao.from_id(chat_id)
+            chat_data = chat_dao_to_chat_data(chat_dao)
+        else:
+            (
+                chat_dao,
+                message_daos,
+                older_message_count,
+                preview,
+            ) = await ChatDao.from_id_with_recent_messages(
+                chat_id, message_limit, include_message_id
+            )
+            chat_data = chat_dao_to_chat_data(
+                chat_dao,
+                message_daos,
+                older_message_count=older_message_count,
+                first_user_message_preview=preview if older_message_count else None,
+            )
+        ChatsManager.cache.put(cache_key, chat_data)
+        return chat_data
+
+    @staticmethod
+    async def get_older_messages(
+        chat_data: ChatData, limit: int | None = None
+    ) -> list[ChatMessage]:
+        """Return the most recent `limit` (or all) of the messages which haven't
+        been loaded into `chat_data` (see `ChatData.older_message_count`),
+        oldest first. `chat_data` isn't modified."""
+        if chat_data.id is None or not chat_data.older_message_count:
+            return []
+        first_message, oldest_loaded = chat_data.messages[:2]
+        message_daos = await MessageDao.messages_page(
+            chat_data.id,
+            after=message_key(first_message),
+            before=message_key(oldest_loaded),
+            limit=limit,
+        )
+        return [
+            message_dao_to_chat_message(message, chat_data.model)
+            for message in message_daos
+        ]
+
+    @staticmethod
+    async def older_message_tokens(
+        chat_data: ChatData, model_name: str
+    ) -> tuple[int, int]:
+        """Add up the stored token counts (for the LiteLLM model `model_name`)
+        of the messages which haven't been loaded into `chat_data`, without
+        loading them.
+
+        Returns:
+            The total of the counts, and the number of the messages which
+            haven't been counted for the model.
+        """
+        if chat_data.id is None or not chat_data.older_message_count:
+            return 0, 0
+        first_message, oldest_loaded = chat_data.messages[:2]
+        return await MessageDao.token_totals(
+            chat_data.id,
+            model_name,
+            after=message_key(first_message),
+            before=message_key(oldest_loaded),
+        )
+
+    @staticmethod
+    async def count_older_messages_within_tokens(
+        chat_data: ChatData, model_name: str, tokens: int
+    ) -> int:
+        """Count how many of the most recent messages which haven't been loaded
+        into `chat_data` fit in `tokens`, according to their stored token
+        counts for the LiteLLM model `model_name`, without loading them."""
+        if chat_data.id is None or not chat_data.older_message_count:
+            return 0
+        first_message, oldest_loaded = chat_data.messages[:2]
+        return await MessageDao.count_recent_within_tokens(
+            chat_data.id,
+            model_name,
+            after=message_key(first_message),
+            before=message_key(oldest_loaded),
+            tokens=tokens,
+        )
 
     @staticmethod
     async def rename_chat(chat_id: int, new_title: str) -> None:
         await ChatDao.rename_chat(chat_id, new_title)
+        ChatsManager.cache.rename(chat_id, new_title)
 
     @staticmethod
     async def get_messages(
@@ -51,7 +367,7 @@ class ChatsManager:
             await session.commit()
 
         # Convert MessageDao objects to ChatMessages
-        model = chat.model
+        model = get_model(chat.model)
         chat_messages: list[ChatMessage] = []
         for message_dao in message_daos:
             chat_message = message_dao_to_chat_message(message_dao, model)
@@ -73,41 +389,223 @@ class ChatsManager:
                 started_at=datetime.datetime.now(datetime.timezone.utc),
             )
             session.add(chat)
+            await session.flush()
+            await ChatsManager._insert_messages(session, chat.id, chat_data.messages)
             await session.commit()
 
-            chat_id = chat.id
-            for message in chat_data.messages:
-                litellm_message = message.message
-                content = litellm_message["content"]
-                new_message = MessageDao(
-                    chat_id=chat_id,
-                    role=litellm_message["role"],
-                    content=content if isinstance(content, str) else "",
-                    model=lookup_key,
-                    timestamp=message.timestamp,
-                )
-                (await chat.awaitable_attrs.messages).append(new_message)
+        # SQLite may reuse the ID of a chat which has been moved to the archive.
+        ChatsManager.cache.invalidate(chat.id)
+        return chat.id
+
+    @staticmethod
+    async def archive_chat(chat_id: int) -> None:
+        """Move a chat to the archive database."""
+        await ChatsManager.archive_chats([chat_id])
+
+    @staticmethod
+    async def archive_chats(chat_ids: list[int]) -> None:
+        """Move chats to the archive database, using one statement per table."""
+        await archive.archive_chats(chat_ids)
+        for chat_id in chat_ids:
+            ChatsManager.cache.invalidate(chat_id)
 
+    @staticmethod
+    async def unarchive_chat(chat_id: int) -> int:
+        """Move a chat out of the archive database, returning its new ID."""
+        restored_chat_ids = await ChatsManager.unarchive_chats([chat_id])
+        return restored_chat_ids[chat_id]
+
+    @staticmethod
+    async def unarchive_chats(chat_ids: list[int]) -> dict[int, int]:
+        """Move chats out of the archive database, using one statement per table.
+
+        Returns:
+            The new ID of each chat.
+        """
+        restored_chat_ids = await archive.unarchive_chats(chat_ids)
+        for restored_chat_id in restored_chat_ids.values():
+            ChatsManager.cache.invalidate(restored_chat_id)
+        return restored_chat_ids
+
+    @staticmethod
+    async def delete_chats(chat_ids: list[int], archived: bool = False) -> None:
+        """Permanently delete chats (from the archive database if `archived`),
+        in a single transaction."""
+        await ChatDao.delete_chats(chat_ids, archived=archived)
+        if not archived:
+            for chat_id in chat_ids:
+                ChatsManager.cache.invalidate(chat_id)
+
+    @staticmethod
+    async def add_message_to_chat(chat_id: int, message: ChatMessage) -> int:
+        """Insert a message into a chat, without loading the chat's other messages.
+
+        The ID of the new message is assigned to `message.id` and returned.
+        """
+        async with get_session() as session:
+            [message_id] = await ChatsManager._insert_messages(
+                session, chat_id, [message]
+            )
             await session.commit()
+        ChatsManager.cache.invalidate(chat_id)
+        return message_id
 
-        return chat.id
+    @staticmethod
+    async def delete_messages(chat_id: int, message_ids: list[int]) -> None:
+        """Permanently delete messages from a chat, in a single transaction."""
+        async with get_session() as session:
+            await session.execute(
+                delete(MessageDao).where(
+                    col(MessageDao.chat_id) == chat_id,
+                    col(MessageDao.id).in_(message_ids),
+                )
+            )
+            await ChatDao.refresh_activity(session, [chat_id])
+            await session.commit()
+        ChatsManager.cache.invalidate(chat_id)
 
     @staticmethod
-    async def archive_chat(chat_id: int) -> None:
+    async def update_message_content(
+        message_id: int, content: str, partial: bool
+    ) -> None:
+        """Overwrite the content of a message with a single UPDATE.
+
+        Args:
+            message_id: The ID of the message to update.
+            content: The new content of the message.
+            partial: True if the message is still incomplete.
+        """
+        # The tokens counted for the old content no longer apply.
+        if partial:
+            meta = func.json_set(
+                func.json_remove(func.coalesce(MessageDao.meta, "{}"), "$.tokens"),
+                "$.partial",
+                func.json("true"),
+            )
+        else:
+            meta = func.json_remove(MessageDao.meta, "$.partial", "$.tokens")
+        stored_content, compressed_content = compress_content(content)
+        statement = (
+            update(MessageDao)
+            .where(MessageDao.id == message_id)  # type: ignore
+            .values(
+                content=stored_content,
+                compressed_content=compressed_content,
+                meta=meta,
+            )
+        )
         async with get_session() as session:
-            statement = select(ChatDao).where(ChatDao.id == chat_id)
-            result = await session.exec(statement)
-            chat_dao = result.one()
-            chat_dao.archived = True
+            await session.execute(statement)
             await session.commit()
+        ChatsManager.cache.invalidate_message(message_id)
 
     @staticmethod
-    async def add_message_to_chat(chat_id: int, message: ChatMessage) -> None:
+    async def save_token_counts(
+        token_counts: dict[int, dict[str, int]], chat_ids: Iterable[int]
+    ) -> None:
+        """Store the token counts of messages (see `ChatMessage.token_counts`)
+        in a single transaction.
+
+        Args:
+            token_counts: The counts of each message, by message ID. These
+                replace the counts already stored for the message.
+            chat_ids: The chats the messages belong to.
+        """
+        if not token_counts:
+            return
+        rows = [
+            (json.dumps(counts), message_id)
+            for message_id, counts in token_counts.items()
+        ]
         async with get_session() as session:
-            chat: ChatDao | None = await session.get(ChatDao, chat_id)
-            if not chat:
-                raise Exception(f"Chat with ID {chat_id} not found.")
-            message_dao = chat_message_to_message_dao(message, chat_id)
-            (await chat.awaitable_attrs.messages).append(message_dao)
-            session.add(chat)
+            connection = await session.connection()
+            await connection.exec_driver_sql(
+                "UPDATE message SET meta = "
+                "json_set(coalesce(meta, '{}'), '$.tokens', json(?)) WHERE id = ?",
+                rows,
+            )
             await session.commit()
+        for chat_id in set(chat_ids):
+            ChatsManager.cache.invalidate(chat_id)
+
+    @staticmethod
+    async def messages_without_token_counts(
+        after_id: int = 0, limit: int = 500
+    ) -> list[tuple[int, int, str, ChatCompletionMessageParam]]:
+        """Return up to `limit` messages of non-archived chats which have no
+        token counts, in order of ID, starting after the message `after_id`.
+
+        Returns:
+            The ID of each message, the ID of its chat, the LiteLLM name of the
+            chat's model, and the message.
+        """
+        rows = await MessageDao.without_token_counts(after_id, limit)
+        models: dict[str, str] = {}
+        messages = []
+        for row in rows:
+            if row.model not in models:
+                models[row.model] = get_model(row.model).name
+            message = {"role": row.role, "content": row.content}
+            messages.append((row.id, row.chat_id, models[row.model], message))
+        return messages  # type: ignore[return-value]
+
+    @staticmethod
+    async def add_messages_to_chat(
+        chat_id: int, messages: list[ChatMessage]
+    ) -> list[int]:
+        """Insert many messages into a chat in a single transaction.
+
+        The IDs of the new messages are assigned to each `message.id`, and returned.
+        """
+        async with get_session() as session:
+            message_ids = await ChatsManager._insert_messages(
+                session, chat_id, messages
+            )
+            await session.commit()
+        ChatsManager.cache.invalidate(chat_id)
+        return message_ids
+
+    @staticmethod
+    async def _insert_messages(
+        session: AsyncSession, chat_id: int, messages: list[ChatMessage]
+    ) -> list[int]:
+        if not messages:
+            return []
+        # System prompts are stored once, and referred to by each chat using them.
+        system_prompts = {
+            index: content
+            for index, message in enumerate(messages)
+            if message.message["role"] == "system"
+            and isinstance(content := message.message.get("content", ""), str)
+        }
+        system_prompt_ids = await SystemPromptsDao.ids_for_prompts(
+            session, system_prompts.values()
+        )
+        rows = [
+            chat_message_to_message_row(
+                message,
+                chat_id,
+                (
+                    system_prompt_ids[system_prompts[index]]
+                    if index in system_prompts
+                    else None
+                ),
+            )
+            for index, message in enumerate(messages)
+        ]
+        statement = insert(MessageDao).returning(
+            MessageDao.id, sort_by_parameter_order=True
+        )
+        result = await session.execute(statement, rows)
+        message_ids = list(result.scalars())
+        for message, message_id in zip(messages, message_ids):
+            message.id = message_id
+        await ChatDao.update_activity(
+            session,
+            chat_id,
+            [row["timestamp"] for row in rows],
+            message_count=sum(
+                message.message["role"] != "system" for message in messages
+            ),
+        )
+        return message_ids
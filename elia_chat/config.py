@@ -1,6 +1,12 @@
 import os
+from functools import cached_property
+from typing import TYPE_CHECKING, Literal
+
 from pydantic import AnyHttpUrl, BaseModel, ConfigDict, Field, SecretStr
 
+if TYPE_CHECKING:
+    from elia_chat.models import ModelRegistry
+
 
 class EliaChatModel(BaseModel):
     name: str
@@ -318,6 +324,42 @@ def get_builtin_models() -> list[EliaChatModel]:
     )
 
 
+class DatabaseConfig(BaseModel):
+    """Options applied to each connection to the SQLite database.
+
+    These can be set in the `[database]` table of the config file.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    journal_mode: Literal["wal", "delete", "truncate", "persist", "memory"] = Field(
+        default="wal"
+    )
+    """The SQLite journal mode. In WAL mode, reads don't block writes and
+    commits don't need to rewrite the main database file."""
+    synchronous: Literal["off", "normal", "full", "extra"] = Field(default="normal")
+    """How often SQLite waits for data to reach the disk. In WAL mode, `normal`
+    is safe from corruption and avoids an fsync on every commit."""
+    cache_size_kib: int = Field(default=64_000)
+    """The maximum size of the page cache of each connection, in KiB."""
+    mmap_size: int = Field(default=256 * 1024 * 1024)
+    """The maximum number of bytes of the database file to memory-map.
+    Set to 0 to disable memory-mapped I/O."""
+    temp_store: Literal["default", "file", "memory"] = Field(default="memory")
+    """Where temporary tables and indexes (e.g. for sorting) are stored."""
+    busy_timeout_ms: int = Field(default=5000)
+    """How long to wait for a lock held by another connection before failing."""
+    compress_messages: bool = Field(default=False)
+    """Whether to store long messages compressed. Existing messages can be
+    (re)compressed with `elia db compress`."""
+    compression_threshold: int = Field(default=1024)
+    """Messages with at least this many characters are compressed, when
+    `compress_messages` is enabled."""
+    optimize_on_exit: bool = Field(default=False)
+    """Whether to refresh the query planner's statistics (`PRAGMA optimize`)
+    in a low-priority background process when Elia exits."""
+
+
 class LaunchConfig(BaseModel):
     """The config of the application at launch.
 
@@ -340,11 +382,23 @@ class LaunchConfig(BaseModel):
         default_factory=get_builtin_models, init=False
     )
     theme: str = Field(default="nebula")
+    stream_frame_rate: float = Field(default=30)
+    """The maximum number of times per second that a response is updated on
+    screen as it streams in. Chunks which arrive in between are shown together."""
+    database: DatabaseConfig = Field(default_factory=DatabaseConfig)
+    """Options for tuning the SQLite database."""
 
-    @property
+    @cached_property
     def all_models(self) -> list[EliaChatModel]:
         return self.models + self.builtin_models
 
+    @cached_property
+    def model_registry(self) -> "ModelRegistry":
+        """The models in `all_models`, indexed for looking them up by ID or name."""
+        from elia_chat.models import ModelRegistry
+
+        return ModelRegistry(self.all_models)
+
     @property
     def default_model_object(self) -> EliaChatModel:
         from elia_chat.models import get_model
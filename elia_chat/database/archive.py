@@ -0,0 +1,309 @@
+"""Archived chats, which are kept in a separate database file.
+
+Archiving a chat moves it, and all of its messages, from the main database to
+`archive.sqlite`, which is attached to every connection as `archive`. This keeps
+the tables and indexes used every day (and the search index, which excludes
+archived chats) small, however many chats have been archived. Unarchiving a
+chat moves it back.
+
+The archive has the same `chat` and `message` tables as the main database, so
+queries can be made against it using `in_archive`. Stored system prompts and
+compression dictionaries stay in the main database, and are shared.
+
+SQLite doesn't commit a transaction atomically across attached databases in
+WAL mode, so chats are moved in steps which each write to one database. The
+chats are copied to the target database, along with a record of the move in
+its `pending_chat_move` table, in one commit. Then they're deleted from the
+source database, and finally the record is deleted. If Elia stops part way
+through, the chats are still in the source database, or the record shows
+which copies to delete from it, which `finish_pending_moves` does at startup.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Iterable
+
+from sqlalchemy import Connection, bindparam, text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from elia_chat.database.database import ARCHIVE_SCHEMA, get_session
+
+MAIN_SCHEMA = "main"
+
+ARCHIVED_TABLES = ("chat", "message")
+"""The tables which archived chats are moved between. They have the same
+columns and indexes in both databases."""
+
+PENDING_MOVES_TABLE = "pending_chat_move"
+"""The table (in both databases) recording chats which have been copied to
+the database, but not yet deleted from the other database."""
+
+
+def sync_archive_schema(connection: Connection) -> None:
+    """Create the tables and indexes of the archive database, or bring them
+    up to date with the main database's tables after a migration."""
+    for table in ARCHIVED_TABLES:
+        archive_columns = {
+            row.name
+            for row in connection.exec_driver_sql(
+                f"PRAGMA {ARCHIVE_SCHEMA}.table_info({table})"
+            )
+        }
+        if not archive_columns:
+            table_sql = connection.execute(
+                text(
+                    "SELECT sql FROM main.sqlite_master "
+                    "WHERE type = 'table' AND name = :name"
+                ),
+                {"name": table},
+            ).scalar_one()
+            connection.exec_driver_sql(
+                re.sub(
+                    r'^CREATE TABLE "?(\w+)"?',
+                    rf"CREATE TABLE {ARCHIVE_SCHEMA}.\1",
+                    table_sql,
+                )
+            )
+        else:
+            for column in connection.exec_driver_sql(
+                f"PRAGMA {MAIN_SCHEMA}.table_info({table})"
+            ):
+                if column.name in archive_columns:
+                    continue
+                definition = column.type
+                if column.dflt_value is not None:
+                    definition += f" DEFAULT {column.dflt_value}"
+                    if column.notnull:
+                        definition += " NOT NULL"
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {ARCHIVE_SCHEMA}.{table} "
+                    f'ADD COLUMN "{column.name}" {definition}'
+                )
+
+        indexes = connection.execute(
+            text(
+                "SELECT name, sql FROM main.sqlite_master "
+                "WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"
+            ),
+            {"table": table},
+        )
+        for name, index_sql in indexes.all():
+            connection.exec_driver_sql(
+                re.sub(
+                    r'^CREATE (UNIQUE )?INDEX (IF NOT EXISTS )?"?\w+"?',
+                    lambda match: f"CREATE {match[1] or ''}INDEX IF NOT EXISTS "
+                    f"{ARCHIVE_SCHEMA}.{name}",
+                    index_sql,
+                )
+            )
+
+    for schema in (MAIN_SCHEMA, ARCHIVE_SCHEMA):
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {schema}.{PENDING_MOVES_TABLE} ("
+            "source_chat_id INTEGER PRIMARY KEY, target_chat_id INTEGER NOT NULL)"
+        )
+
+
+async def _column_names(session: AsyncSession, table: str) -> list[str]:
+    columns = await session.execute(text(f"PRAGMA {MAIN_SCHEMA}.table_info({table})"))
+    return [column.name for column in columns]
+
+
+def _select_list(columns: list[str], replacements: dict[str, str]) -> str:
+    return ", ".join(replacements.get(column, f'"{column}"') for column in columns)
+
+
+async def _copy_chats(
+    session: AsyncSession, chat_ids: Iterable[int], source: str, target: str
+) -> dict[int, int]:
+    """Copy chats and their messages from the `source` database to `target`,
+    using one statement per table however many chats are copied, and record
+    that they're being moved.
+
+    The chats and their messages keep their IDs, unless any of them have been
+    used for other chats or messages in the target database since the chats
+    were moved out of it (SQLite reuses the largest IDs once they're deleted),
+    in which case they're all shifted past the largest ID in either database.
+
+    Returns:
+        The ID in the target database of each chat which was copied.
+    """
+    ids = bindparam("chat_ids", expanding=True)
+    parameters: dict[str, Any] = {"chat_ids": list(chat_ids)}
+    if not parameters["chat_ids"]:
+        return {}
+    result = await session.execute(
+        text(f"SELECT id FROM {source}.chat WHERE id IN :chat_ids").bindparams(ids),
+        parameters,
+    )
+    moved_chat_ids = list(result.scalars())
+    if not moved_chat_ids:
+        return {}
+    parameters["chat_ids"] = moved_chat_ids
+
+    # Chats refer to each other by ID, so each table is shifted by a single
+    # amount, keeping them (and the order of the messages) consistent.
+    parameters["chat_shift"] = 0
+    parameters["message_shift"] = 0
+    chat_ids_taken = await session.scalar(
+        text(f"SELECT 1 FROM {target}.chat WHERE id IN :chat_ids LIMIT 1").bindparams(
+            ids
+        ),
+        parameters,
+    )
+    if chat_ids_taken:
+        parameters["chat_shift"] = (
+            await session.scalar(
+                text(
+                    f"SELECT max(coalesce((SELECT max(id) FROM {MAIN_SCHEMA}.chat), 0), "
+                    f"coalesce((SELECT max(id) FROM {ARCHIVE_SCHEMA}.chat), 0))"
+                )
+            )
+            - min(moved_chat_ids)
+            + 1
+        )
+    message_ids_taken = await session.scalar(
+        text(
+            f"SELECT 1 FROM {source}.message AS moved "
+            f"JOIN {target}.message AS existing ON existing.id = moved.id "
+            "WHERE moved.chat_id IN :chat_ids LIMIT 1"
+        ).bindparams(ids),
+        parameters,
+    )
+    if message_ids_taken:
+        parameters["message_shift"] = await session.scalar(
+            text(
+                f"SELECT max(coalesce((SELECT max(id) FROM {MAIN_SCHEMA}.message), 0), "
+                f"coalesce((SELECT max(id) FROM {ARCHIVE_SCHEMA}.message), 0)) "
+                f"- (SELECT min(id) FROM {source}.message "
+                "WHERE chat_id IN :chat_ids) + 1"
+            ).bindparams(ids),
+            parameters,
+        )
+
+    chat_columns = await _column_names(session, "chat")
+    message_columns = await _column_names(session, "message")
+    archived = "1" if target == ARCHIVE_SCHEMA else "0"
+    chat_values = _select_list(
+        chat_columns, {"id": "id + :chat_shift", "archived": archived}
+    )
+    message_values = _select_list(
+        message_columns,
+        {
+            "id": "id + :message_shift",
+            "chat_id": "chat_id + :chat_shift",
+            "parent_id": "parent_id + :message_shift",
+        },
+    )
+    quoted_chat_columns = ", ".join(f'"{column}"' for column in chat_columns)
+    quoted_message_columns = ", ".join(f'"{column}"' for column in message_columns)
+    statements = [
+        f"INSERT INTO {target}.chat ({quoted_chat_columns}) "
+        f"SELECT {chat_values} FROM {source}.chat WHERE id IN :chat_ids",
+        f"INSERT INTO {target}.message ({quoted_message_columns}) "
+        f"SELECT {message_values} FROM {source}.message "
+        "WHERE chat_id IN :chat_ids ORDER BY id",
+        f"INSERT INTO {target}.{PENDING_MOVES_TABLE} (source_chat_id, target_chat_id) "
+        f"SELECT id, id + :chat_shift FROM {source}.chat WHERE id IN :chat_ids",
+    ]
+    for statement in statements:
+        await session.execute(text(statement).bindparams(ids), parameters)
+    return {chat_id: chat_id + parameters["chat_shift"] for chat_id in moved_chat_ids}
+
+
+async def finish_pending_moves() -> int:
+    """Delete chats which have been copied to the other database from the
+    database they were moved out of, finishing any moves which were
+    interrupted.
+
+    Returns:
+        The number of chats which were deleted.
+    """
+    finished = 0
+    async with get_session() as session:
+        for source, target in (
+            (MAIN_SCHEMA, ARCHIVE_SCHEMA),
+            (ARCHIVE_SCHEMA, MAIN_SCHEMA),
+        ):
+            moved_chat_ids = (
+                f"SELECT source_chat_id FROM {target}.{PENDING_MOVES_TABLE}"
+            )
+            result = await session.execute(text(moved_chat_ids))
+            moved = len(result.all())
+            if not moved:
+                continue
+            await session.execute(
+                text(
+                    f"DELETE FROM {source}.message WHERE chat_id IN ({moved_chat_ids})"
+                )
+            )
+            await session.execute(
+                text(f"DELETE FROM {source}.chat WHERE id IN ({moved_chat_ids})")
+            )
+            await session.commit()
+            # Only forget the moves once the source database has committed, so
+            # the chats are never left in both databases.
+            await session.execute(text(f"DELETE FROM {target}.{PENDING_MOVES_TABLE}"))
+            await session.commit()
+            finished += moved
+    return finished
+
+
+async def _move_chats(
+    chat_ids: Iterable[int], source: str, target: str
+) -> dict[int, int]:
+    """Move chats and their messages from the `source` database to `target`.
+
+    Returns:
+        The ID in the target database of each chat which was moved.
+    """
+    async with get_session() as session:
+        moved_chat_ids = await _copy_chats(session, chat_ids, source, target)
+        if not moved_chat_ids:
+            return {}
+        await session.commit()
+    await finish_pending_moves()
+    return moved_chat_ids
+
+
+async def archive_chats(chat_ids: Iterable[int]) -> dict[int, int]:
+    """Move chats to the archive database, returning their IDs in the archive."""
+    return await _move_chats(chat_ids, MAIN_SCHEMA, ARCHIVE_SCHEMA)
+
+
+async def unarchive_chats(chat_ids: Iterable[int]) -> dict[int, int]:
+    """Move chats from the archive database back to the main database,
+    returning their IDs in the main database."""
+    return await _move_chats(chat_ids, ARCHIVE_SCHEMA, MAIN_SCHEMA)
+
+
+async def archive_chat(chat_id: int) -> int:
+    """Move a chat to the archive database, returning its ID in the archive."""
+    archived_chat_ids = await archive_chats([chat_id])
+    return archived_chat_ids[chat_id]
+
+
+async def unarchive_chat(chat_id: int) -> int:
+    """Move a chat from the archive database back to the main database,
+    returning its ID in the main database."""
+    restored_chat_ids = await unarchive_chats([chat_id])
+    return restored_chat_ids[chat_id]
+
+
+async def archive_pending_chats() -> int:
+    """Finish any moves between the databases which were interrupted, and move
+    any chats which are marked as archived in the main database (e.g. they were
+    archived by an older version of Elia) to the archive database.
+
+    Returns:
+        The number of chats which were moved to the archive database.
+    """
+    await finish_pending_moves()
+    async with get_session() as session:
+        result = await session.execute(
+            text(f"SELECT id FROM {MAIN_SCHEMA}.chat WHERE archived ORDER BY id")
+        )
+        pending_chat_ids = list(result.scalars())
+    moved = await _move_chats(pending_chat_ids, MAIN_SCHEMA, ARCHIVE_SCHEMA)
+    return len(moved)
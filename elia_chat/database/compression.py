@@ -0,0 +1,412 @@
+"""Transparent compression of large message bodies.
+
+When `compress_messages` is enabled in the `[database]` config, the content of
+messages longer than `compression_threshold` characters is stored compressed in
+`message.compressed_content`, and `message.content` is left empty. Messages are
+compressed and decompressed as they're converted to and from `MessageDao`, and
+the `message_content(content, compressed_content)` SQL function (registered on
+every connection) returns the text of a message in queries, triggers and views.
+
+Messages are compressed with zlib, using a preset dictionary trained from the
+messages already in the database when one is available. Most messages are too
+short for zlib to find much repetition within them, but chat transcripts share
+a lot of text with each other (code, Markdown, boilerplate), which is what the
+dictionary provides. Each compressed value starts with a header identifying how
+it was compressed, so rows compressed with older dictionaries remain readable.
+"""
+
+from __future__ import annotations
+
+import random
+import sqlite3
+import struct
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable
+
+from humanize import naturalsize
+from rich.text import Text
+from sqlalchemy import text
+
+from elia_chat.database.database import (
+    database_config,
+    engine,
+    get_session,
+    sqlite_file_name,
+)
+
+CODEC_ZLIB = 1
+"""Compressed with zlib (raw deflate) and no dictionary."""
+CODEC_ZLIB_DICTIONARY = 2
+"""Compressed with zlib (raw deflate), using a dictionary from the
+`compression_dictionary` table. The header includes the dictionary's ID."""
+
+_ZLIB_WBITS = -15
+"""Raw deflate streams, without zlib's own header and checksum."""
+_ZLIB_LEVEL = 6
+_DICTIONARY_HEADER = struct.Struct(">BI")
+
+MAX_DICTIONARY_SIZE = 32 * 1024
+"""zlib only looks back 32KiB, so any more of a dictionary would be unused."""
+
+DICTIONARY_SAMPLE_SIZE = 2000
+"""The number of messages sampled to train a dictionary."""
+
+MIN_SAMPLE_LENGTH = 200
+"""Shorter messages aren't used as samples, since they'd never be compressed."""
+
+_dictionaries: dict[int, bytes] = {}
+"""Dictionaries by ID. They never change once created, so can be cached forever."""
+
+_current_dictionary: tuple[int, bytes] | None = None
+_current_dictionary_loaded = False
+
+
+class DecompressionError(Exception):
+    """A compressed message couldn't be decompressed."""
+
+
+def _read_database(sql: str, parameters: tuple = ()) -> list[tuple]:
+    """Run a query on a short-lived connection to the database.
+
+    Dictionaries are loaded synchronously, when they're first needed, from
+    wherever they're needed: including inside the `message_content` SQL
+    function, while another query is running on the calling connection.
+    """
+    connection = sqlite3.connect(sqlite_file_name)
+    try:
+        return connection.execute(sql, parameters).fetchall()
+    finally:
+        connection.close()
+
+
+def get_dictionary(dictionary_id: int) -> bytes:
+    try:
+        return _dictionaries[dictionary_id]
+    except KeyError:
+        rows = _read_database(
+            "SELECT data FROM compression_dictionary WHERE id = ?", (dictionary_id,)
+        )
+        if not rows:
+            raise DecompressionError(f"Missing compression dictionary {dictionary_id}.")
+        _dictionaries[dictionary_id] = rows[0][0]
+        return rows[0][0]
+
+
+def current_dictionary() -> tuple[int, bytes] | None:
+    """Return the ID and content of the dictionary used to compress new messages."""
+    global _current_dictionary, _current_dictionary_loaded
+    if not _current_dictionary_loaded:
+        rows = _read_database(
+            "SELECT id, data FROM compression_dictionary ORDER BY id DESC LIMIT 1"
+        )
+        set_current_dictionary(*rows[0] if rows else (None, None))
+    return _current_dictionary
+
+
+def set_current_dictionary(dictionary_id: int | None, data: bytes | None) -> None:
+    global _current_dictionary, _current_dictionary_loaded
+    _current_dictionary_loaded = True
+    if dictionary_id is None or data is None:
+        _current_dictionary = None
+    else:
+        _dictionaries[dictionary_id] = data
+        _current_dictionary = (dictionary_id, data)
+
+
+def compress(content: str, dictionary: tuple[int, bytes] | None = None) -> bytes:
+    """Compress text, with the given `(id, data)` dictionary if there is one."""
+    if dictionary is None:
+        compressor = zlib.compressobj(_ZLIB_LEVEL, zlib.DEFLATED, _ZLIB_WBITS)
+        header = bytes([CODEC_ZLIB])
+    else:
+        dictionary_id, data = dictionary
+        compressor = zlib.compressobj(
+            _ZLIB_LEVEL, zlib.DEFLATED, _ZLIB_WBITS, zdict=data
+        )
+        header = _DICTIONARY_HEADER.pack(CODEC_ZLIB_DICTIONARY, dictionary_id)
+    encoded = content.encode("utf-8", "surrogatepass")
+    return header + compressor.compress(encoded) + compressor.flush()
+
+
+def decompress(compressed: bytes) -> str:
+    codec = compressed[0]
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj(_ZLIB_WBITS)
+        body = compressed[1:]
+    elif codec == CODEC_ZLIB_DICTIONARY:
+        _, dictionary_id = _DICTIONARY_HEADER.unpack_from(compressed)
+        decompressor = zlib.decompressobj(
+            _ZLIB_WBITS, zdict=get_dictionary(dictionary_id)
+        )
+        body = compressed[_DICTIONARY_HEADER.size :]
+    else:
+        raise DecompressionError(f"Unknown compression codec {codec}.")
+    decoded = decompressor.decompress(body) + decompressor.flush()
+    if not decompressor.eof:
+        raise DecompressionError("Compressed content is truncated.")
+    return decoded.decode("utf-8", "surrogatepass")
+
+
+def dictionary_id_of(compressed: bytes) -> int | None:
+    """Return the ID of the dictionary a value was compressed with, if any."""
+    if compressed[0] == CODEC_ZLIB_DICTIONARY:
+        return _DICTIONARY_HEADER.unpack_from(compressed)[1]
+    return None
+
+
+def message_content(content: str, compressed_content: bytes | None) -> str:
+    """Return the text of a message, given its `content` and `compressed_content`.
+
+    This is also registered as an SQL function on each connection.
+    """
+    if compressed_content is None:
+        return content
+    return decompress(compressed_content)
+
+
+def compress_content(content: str) -> tuple[str, bytes | None]:
+    """Return the values to store in a message's `content` and
+    `compressed_content` columns, compressing it if it's long enough and
+    compression is enabled."""
+    config = database_config()
+    if not config.compress_messages or len(content) < config.compression_threshold:
+        return content, None
+    return "", compress(content, current_dictionary())
+
+
+def train_dictionary(samples: Iterable[str], size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    """Build a zlib preset dictionary from samples of message content.
+
+    The dictionary is made of the lines which appear in the most samples,
+    weighted by their length, since those are the matches zlib can use. Any
+    space left is filled with the most common words, for prose (in which whole
+    lines rarely repeat). The most valuable text goes at the end, where it's
+    cheapest to refer to.
+    """
+    line_counts: Counter[str] = Counter()
+    word_counts: Counter[str] = Counter()
+    for sample in samples:
+        lines = {line.strip() for line in sample.splitlines()}
+        line_counts.update(line for line in lines if len(line) >= 4)
+        word_counts.update(word for word in set(sample.split()) if len(word) >= 3)
+
+    parts: list[bytes] = []
+    total = 0
+    for counts, separator in ((line_counts, "\n"), (word_counts, " ")):
+        ranked = sorted(
+            ((count * len(part), part) for part, count in counts.items() if count > 1),
+            reverse=True,
+        )
+        for _, part in ranked:
+            encoded = (part + separator).encode("utf-8", "surrogatepass")
+            if total + len(encoded) <= size:
+                parts.append(encoded)
+                total += len(encoded)
+    return b"".join(reversed(parts))
+
+
+async def sample_messages(count: int = DICTIONARY_SAMPLE_SIZE) -> list[str]:
+    """Return the content of a random sample of (not too short) messages."""
+    async with get_session() as session:
+        bounds = await session.execute(text("SELECT min(id), max(id) FROM message"))
+        low, high = bounds.one()
+        if low is None:
+            return []
+        # Picking random IDs avoids reading (or sorting) the whole table.
+        candidates = random.sample(range(low, high + 1), min(count * 4, high - low + 1))
+        samples: list[str] = []
+        for start in range(0, len(candidates), 500):
+            rows = await session.execute(
+                text(
+                    "SELECT message_content(content, compressed_content) FROM message "
+                    "WHERE id IN (SELECT value FROM json_each(:ids)) "
+                    "AND length(content) + coalesce(length(compressed_content), 0) "
+                    ">= :min_length"
+                ),
+                {
+                    "ids": str(candidates[start : start + 500]),
+                    "min_length": MIN_SAMPLE_LENGTH,
+                },
+            )
+            samples.extend(row[0] for row in rows)
+            if len(samples) >= count:
+                break
+    return samples[:count]
+
+
+async def create_dictionary(samples: list[str]) -> tuple[int, bytes] | None:
+    """Train a dictionary from the samples and store it, so it's used to compress
+    new messages. Returns its ID and content, or None if there were no samples."""
+    data = train_dictionary(samples)
+    if not data:
+        return None
+    async with get_session() as session:
+        result = await session.execute(
+            text(
+                "INSERT INTO compression_dictionary (data, sample_count) "
+                "VALUES (:data, :sample_count) RETURNING id"
+            ),
+            {"data": data, "sample_count": len(samples)},
+        )
+        dictionary_id = result.scalar_one()
+        await session.commit()
+    set_current_dictionary(dictionary_id, data)
+    return dictionary_id, data
+
+
+@dataclass
+class RecompressProgress:
+    total_messages: int = 0
+    messages_checked: int = 0
+    messages_rewritten: int = 0
+    bytes_before: int = 0
+    """The stored size of the message content checked so far, before..."""
+    bytes_after: int = 0
+    """...and after it was rewritten."""
+    done: bool = False
+
+    def __rich__(self) -> Text:
+        return Text.from_markup(
+            f"Checked [b]{self.messages_checked}[/]/{self.total_messages} messages, "
+            f"rewrote [b]{self.messages_rewritten}[/] · "
+            f"{naturalsize(self.bytes_before)} → {naturalsize(self.bytes_after)}",
+            style="green" if self.done else "yellow",
+        )
+
+
+RECOMPRESS_BATCH_SIZE = 1000
+
+
+async def recompress_messages(
+    threshold: int | None,
+    dictionary: tuple[int, bytes] | None,
+    progress: RecompressProgress,
+) -> None:
+    """Rewrite the stored content of every message.
+
+    Messages with at least `threshold` characters are compressed with the given
+    dictionary (unless they already are), and all others are stored as plain
+    text. If `threshold` is None, every message is decompressed.
+
+    Each batch is committed separately, so this can be interrupted and rerun.
+    """
+    dictionary_id = dictionary[0] if dictionary else None
+    async with get_session() as session:
+        count = await session.execute(text("SELECT count(*) FROM message"))
+        progress.total_messages = count.scalar_one()
+    after = 0
+    while True:
+        async with get_session() as session:
+            rows = (
+                await session.execute(
+                    text(
+                        "SELECT id, content, compressed_content FROM message "
+                        "WHERE id > :after ORDER BY id LIMIT :limit"
+                    ),
+                    {"after": after, "limit": RECOMPRESS_BATCH_SIZE},
+                )
+            ).all()
+            if not rows:
+                progress.done = True
+                return
+
+            updates = []
+            for message_id, content, compressed_content in rows:
+                stored_size = len(content.encode()) + len(compressed_content or b"")
+                progress.bytes_before += stored_size
+                full_content = message_content(content, compressed_content)
+                should_compress = (
+                    threshold is not None and len(full_content) >= threshold
+                )
+                if should_compress and (
+                    compressed_content is None
+                    or dictionary_id_of(compressed_content) != dictionary_id
+                ):
+                    new_compressed = compress(full_content, dictionary)
+                    updates.append(
+                        {"id": message_id, "content": "", "compressed": new_compressed}
+                    )
+                    progress.bytes_after += len(new_compressed)
+                elif not should_compress and compressed_content is not None:
+                    updates.append(
+                        {"id": message_id, "content": full_content, "compressed": None}
+                    )
+                    progress.bytes_after += len(full_content.encode())
+                else:
+                    progress.bytes_after += stored_size
+
+            if updates:
+                # The search index is only updated if the text of the message
+                # changes, which it doesn't here.
+                await session.execute(
+                    text(
+                        "UPDATE message SET content = :content, "
+                        "compressed_content = :compressed WHERE id = :id"
+                    ),
+                    updates,
+                )
+                await session.commit()
+            progress.messages_checked += len(rows)
+            progress.messages_rewritten += len(updates)
+            after = rows[-1][0]
+
+
+async def vacuum() -> None:
+    """Rebuild the database file, returning the space freed by compression."""
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.exec_driver_sql("VACUUM")
+
+
+@dataclass
+class CodecBenchmark:
+    name: str
+    raw_bytes: int
+    compressed_bytes: int
+    decode_seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0
+
+    @property
+    def decode_mb_per_second(self) -> float:
+        if not self.decode_seconds:
+            return 0
+        return self.raw_bytes / self.decode_seconds / 1_000_000
+
+
+def benchmark_codecs(samples: list[str], threshold: int) -> list[CodecBenchmark]:
+    """Compare the size and decoding speed of the messages in `samples` which are
+    over the threshold, without a dictionary, and with one trained on half of
+    the samples (measured on the other half)."""
+    training, measured = samples[::2], samples[1::2]
+    measured = [sample for sample in measured if len(sample) >= threshold]
+    trained = train_dictionary(training)
+    dictionary = (0, trained)
+    # Don't look the benchmark dictionary up in the database.
+    _dictionaries[0] = trained
+
+    results = []
+    codecs: list[tuple[str, tuple[int, bytes] | None]] = [("zlib", None)]
+    if trained:
+        codecs.append((f"zlib + {naturalsize(len(trained))} dictionary", dictionary))
+    for name, codec_dictionary in codecs:
+        compressed = [compress(sample, codec_dictionary) for sample in measured]
+        start = time.perf_counter()
+        for value in compressed:
+            decompress(value)
+        decode_seconds = time.perf_counter() - start
+        results.append(
+            CodecBenchmark(
+                name=name,
+                raw_bytes=sum(len(sample.encode()) for sample in measured),
+                compressed_bytes=sum(map(len, compressed)),
+                decode_seconds=decode_seconds,
+            )
+        )
+    _dictionaries.pop(0, None)
+    return results
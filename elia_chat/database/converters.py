@@ -1,8 +1,17 @@
 from typing import TYPE_CHECKING, Any
 
+from sqlalchemy import Row
 
+from elia_chat.config import EliaChatModel
+from elia_chat.database.compression import compress_content, message_content
 from elia_chat.database.models import ChatDao, MessageDao
-from elia_chat.models import ChatData, ChatMessage, get_model
+from elia_chat.models import (
+    ChatData,
+    ChatMessage,
+    ChatSummary,
+    MessageSearchResult,
+    get_model,
+)
 
 if TYPE_CHECKING:
     from litellm.types.completion import ChatCompletionUserMessageParam
@@ -11,43 +20,122 @@ if TYPE_CHECKING:
 def chat_message_to_message_dao(
     message: ChatMessage,
     chat_id: int,
+    system_prompt_id: int | None = None,
 ) -> MessageDao:
-    """Convert a ChatMessage to a SQLModel message."""
+    """Convert a ChatMessage to a SQLModel message.
+
+    If `system_prompt_id` is given, the message refers to that stored system
+    prompt rather than storing its content.
+    """
     meta: dict[str, Any] = {}
+    if message.partial:
+        meta["partial"] = True
+    if message.token_counts:
+        meta["tokens"] = dict(message.token_counts)
     content = message.message.get("content", "")
+    if system_prompt_id is not None:
+        stored_content, compressed_content = "", None
+    else:
+        stored_content, compressed_content = compress_content(
+            content if isinstance(content, str) else ""
+        )
     return MessageDao(
         chat_id=chat_id,
         role=message.message["role"],
-        content=content if isinstance(content, str) else "",
+        content=stored_content,
+        compressed_content=compressed_content,
+        system_prompt_id=system_prompt_id,
         timestamp=message.timestamp,
         model=message.model.lookup_key,
         meta=meta,
     )
 
 
-def chat_dao_to_chat_data(chat_dao: ChatDao) -> ChatData:
-    """Convert the SQLModel chat to a ChatData."""
-    model = chat_dao.model
+def chat_message_to_message_row(
+    message: ChatMessage, chat_id: int, system_prompt_id: int | None = None
+) -> dict[str, Any]:
+    """Convert a ChatMessage to the column values of a row in the message table,
+    for use with bulk inserts."""
+    message_dao = chat_message_to_message_dao(message, chat_id, system_prompt_id)
+    return message_dao.model_dump(exclude={"id"})
+
+
+def chat_dao_to_chat_data(
+    chat_dao: ChatDao,
+    message_daos: list[MessageDao] | None = None,
+    older_message_count: int = 0,
+    first_user_message_preview: str | None = None,
+) -> ChatData:
+    """Convert the SQLModel chat to a ChatData.
+
+    By default the chat's active messages are used, but a subset of them can be
+    given as `message_daos` (see `ChatDao.from_id_with_recent_messages`).
+    """
+    # Every message is given the chat's model, so look it up once.
+    model = get_model(chat_dao.model)
+    if message_daos is None:
+        message_daos = chat_dao.active_messages
     return ChatData(
         id=chat_dao.id,
         title=chat_dao.title,
-        model=get_model(model),
+        model=model,
         create_timestamp=chat_dao.started_at if chat_dao.started_at else None,
         messages=[
-            message_dao_to_chat_message(message, model) for message in chat_dao.messages
+            message_dao_to_chat_message(message, model) for message in message_daos
         ],
+        older_message_count=older_message_count,
+        first_user_message_preview=first_user_message_preview,
     )
 
 
-def message_dao_to_chat_message(message_dao: MessageDao, model: str) -> ChatMessage:
-    """Convert the SQLModel message to a ChatMessage."""
+def chat_summary_row_to_chat_summary(row: Row[Any]) -> ChatSummary:
+    """Convert a row returned by `ChatDao.summaries_page` to a ChatSummary."""
+    return ChatSummary(
+        id=row.id,
+        title=row.title,
+        model=get_model(row.model),
+        create_timestamp=row.started_at,
+        last_message_timestamp=row.last_message_at,
+        message_count=row.message_count,
+        first_user_message_preview=row.preview or "",
+    )
+
+
+def message_dao_to_chat_message(
+    message_dao: MessageDao, model: EliaChatModel
+) -> ChatMessage:
+    """Convert the SQLModel message to a ChatMessage.
+
+    If the message refers to a stored system prompt, `message_dao.system_prompt`
+    must have been loaded.
+    """
+    if message_dao.system_prompt_id is not None and message_dao.system_prompt:
+        content = message_dao.system_prompt.prompt
+    else:
+        content = message_content(message_dao.content, message_dao.compressed_content)
     message: ChatCompletionUserMessageParam = {
-        "content": message_dao.content,
+        "content": content,
         "role": message_dao.role,  # type: ignore
     }
+    meta = message_dao.meta or {}
 
     return ChatMessage(
         message=message,
         timestamp=message_dao.timestamp,
-        model=get_model(model),
+        model=model,
+        id=message_dao.id,
+        partial=bool(meta.get("partial")),
+        token_counts=dict(meta.get("tokens") or {}),
+    )
+
+
+def search_row_to_message_search_result(row: Row[Any]) -> MessageSearchResult:
+    """Convert a row returned by `MessageDao.search` to a MessageSearchResult."""
+    return MessageSearchResult(
+        chat_id=row.chat_id,
+        message_id=row.message_id,
+        chat_title=row.chat_title,
+        role=row.role,
+        timestamp=row.timestamp,
+        snippet=row.snippet or "",
     )
@@ -1,6 +1,9 @@
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, TypeVar
+from sqlalchemy import Executable, event
 from sqlmodel import SQLModel
+from elia_chat.config import DatabaseConfig
+from elia_chat.database.migrations import upgrade_schema
 from elia_chat.locations import data_directory
 
 from sqlmodel.ext.asyncio.session import AsyncSession
@@ -8,20 +11,92 @@ from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
 
 sqlite_file_name = data_directory() / "elia.sqlite"
+archive_file_name = data_directory() / "archive.sqlite"
+"""Archived chats are moved to this database, which is attached to every
+connection to the main database. See `elia_chat.database.archive`."""
+ARCHIVE_SCHEMA = "archive"
+"""The name the archive database is attached as."""
 sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
 engine = create_async_engine(sqlite_url)
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+"""The factory used to create all sessions, shared for the lifetime of the app."""
+
+_database_config = DatabaseConfig()
+
+
+def configure_database(config: DatabaseConfig) -> None:
+    """Set the options which are applied to new database connections.
+
+    This should be called before the database is first used, since existing
+    pooled connections are not reconfigured.
+    """
+    global _database_config
+    _database_config = config
+
+
+def database_config() -> DatabaseConfig:
+    """Return the database options currently in use."""
+    return _database_config
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _configure_connection(dbapi_connection: Any, _connection_record: Any) -> None:
+    config = _database_config
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(config.busy_timeout_ms)}")
+    # Only takes effect when the database is created (or rebuilt, which
+    # `elia db optimize` does). Free pages can then be released cheaply.
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute(f"PRAGMA journal_mode = {config.journal_mode}")
+    cursor.execute(f"PRAGMA synchronous = {config.synchronous}")
+    # A negative cache size is in KiB, rather than a number of pages.
+    cursor.execute(f"PRAGMA cache_size = {-int(config.cache_size_kib)}")
+    cursor.execute(f"PRAGMA mmap_size = {int(config.mmap_size)}")
+    cursor.execute(f"PRAGMA temp_store = {config.temp_store}")
+    cursor.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (str(archive_file_name),))
+    cursor.execute(f"PRAGMA {ARCHIVE_SCHEMA}.auto_vacuum = INCREMENTAL")
+    cursor.execute(f"PRAGMA {ARCHIVE_SCHEMA}.journal_mode = {config.journal_mode}")
+    cursor.execute(f"PRAGMA {ARCHIVE_SCHEMA}.synchronous = {config.synchronous}")
+    cursor.close()
+
+    # Used by queries, triggers and the search index to read message content,
+    # whether or not it's compressed.
+    from elia_chat.database.compression import message_content
+
+    dbapi_connection.create_function(
+        "message_content", 2, message_content, deterministic=True
+    )
 
 
 async def create_database():
+    """Create the database if required, and apply any pending migrations."""
+    # Ensure the tables are registered on the metadata before creating them.
+    import elia_chat.database.models  # noqa: F401
+
+    from elia_chat.database.archive import archive_pending_chats, sync_archive_schema
+
     async with engine.begin() as conn:
-        # TODO - check if exists, use Alembic.
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
+        await conn.run_sync(sync_archive_schema)
+    # Chats archived before archived chats were moved to the archive database.
+    await archive_pending_chats()
+
+    # The CLI creates the database in a separate event loop to the app,
+    # so don't keep hold of any connections opened here.
+    await engine.dispose()
+
+
+ExecutableT = TypeVar("ExecutableT", bound=Executable)
+
+
+def in_archive(statement: ExecutableT) -> ExecutableT:
+    """Make a statement use the tables in the archive database, rather than
+    the tables in the main database with the same names."""
+    return statement.execution_options(schema_translate_map={None: ARCHIVE_SCHEMA})
 
 
 @asynccontextmanager
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async_session = async_sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
-    )
     async with async_session() as session:
         yield session
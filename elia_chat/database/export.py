@@ -0,0 +1,292 @@
+"""Export chats and their messages from the database.
+
+Chats are streamed from the database in a single query, a few hundred rows at a
+time, and written out one chat at a time. Only one chat is held in memory, so
+databases of any size can be exported.
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import re
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Any, AsyncIterator, Iterator, Literal
+
+from rich.console import Console
+from rich.live import Live
+from rich.text import Text
+from sqlalchemy import asc, func
+from sqlmodel import col, select
+
+from elia_chat.database.database import get_session, in_archive
+from elia_chat.database.models import ChatDao, MessageDao, SystemPromptsDao
+
+ExportFormat = Literal["jsonl", "markdown"]
+Compression = Literal["gzip", "zstd"]
+ArchivedFilter = Literal["include", "exclude", "only"]
+
+ROWS_PER_FETCH = 500
+"""The number of rows fetched from the database at a time."""
+
+PROGRESS_REFRESH_INTERVAL = 0.25
+"""The minimum number of seconds between updates to the progress display."""
+
+COMPRESSION_SUFFIXES: dict[Compression, str] = {"gzip": ".gz", "zstd": ".zst"}
+
+
+class ExportError(Exception):
+    """The export couldn't be written with the given options."""
+
+
+@dataclass
+class ExportFilters:
+    """Which chats to export."""
+
+    since: datetime | None = None
+    """Only export chats started at or after this time."""
+    until: datetime | None = None
+    """Only export chats started before this time."""
+    models: tuple[str, ...] = ()
+    """Only export chats using one of these models (all models if empty)."""
+    archived: ArchivedFilter = "include"
+    """Whether to include archived chats, exclude them, or export only them."""
+
+
+@dataclass
+class ExportedChat:
+    """A chat and all of its messages, as written to the export."""
+
+    id: int
+    title: str | None
+    model: str
+    started_at: datetime | None
+    archived: bool
+    messages: list[dict[str, Any]] = field(default_factory=list)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "title": self.title,
+            "model": self.model,
+            "started_at": _isoformat(self.started_at),
+            "archived": self.archived,
+            "messages": self.messages,
+        }
+
+    def to_markdown(self) -> str:
+        lines = [f"# {self.title or 'Untitled chat'}", ""]
+        details = [f"Model: `{self.model}`"]
+        if self.started_at:
+            details.append(f"Started: {self.started_at:%Y-%m-%d %H:%M}")
+        if self.archived:
+            details.append("Archived")
+        lines += [" · ".join(details), ""]
+        # Only the branch of the chat which is shown in Elia is included.
+        for message in self.messages:
+            if not message["active"]:
+                continue
+            heading = message["role"].capitalize()
+            if message["role"] == "assistant" and message["model"]:
+                heading += f" ({message['model']})"
+            lines += [f"## {heading}", "", message["content"], ""]
+        return "\n".join(lines)
+
+    @property
+    def file_name(self) -> str:
+        # Archived chats are numbered separately (in the archive database), so
+        # they're prefixed to keep them apart from chats with the same ID.
+        name = f"archive-{self.id:06d}" if self.archived else f"{self.id:06d}"
+        slug = re.sub(r"[^a-z0-9]+", "-", (self.title or "").lower()).strip("-")
+        return f"{name}-{slug[:60]}.md" if slug else f"{name}.md"
+
+
+@dataclass
+class ExportProgress:
+    chat_count: int = 0
+    message_count: int = 0
+    done: bool = False
+    started_at: float = field(default_factory=time.monotonic)
+
+    def __rich__(self) -> Text:
+        elapsed = time.monotonic() - self.started_at
+        return Text.from_markup(
+            f"Exported [b]{self.chat_count}[/] chats "
+            f"([b]{self.message_count}[/] messages) · {elapsed:.1f}s",
+            style="green" if self.done else "yellow",
+        )
+
+
+def _isoformat(value: datetime | None) -> str | None:
+    return value.isoformat() if value else None
+
+
+@contextmanager
+def open_output(
+    path: Path | None, compression: Compression | None
+) -> Iterator[IO[bytes]]:
+    """Open a file (or stdout if `path` is None) for writing, compressing
+    everything written to it if required."""
+    with ExitStack() as stack:
+        file: IO[bytes] = (
+            sys.stdout.buffer if path is None else stack.enter_context(open(path, "wb"))
+        )
+        if compression == "gzip":
+            file = stack.enter_context(
+                gzip.GzipFile(fileobj=file, mode="wb", compresslevel=6)
+            )
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ExportError(
+                    "zstd compression requires the zstandard package "
+                    "(install elia with the 'zstd' extra)."
+                ) from None
+            compressor = zstandard.ZstdCompressor(level=3)
+            file = stack.enter_context(compressor.stream_writer(file, closefd=False))
+        yield file
+        file.flush()
+
+
+async def iter_chats(filters: ExportFilters) -> AsyncIterator[ExportedChat]:
+    """Stream the chats matching the filters, each with all of its messages.
+
+    Chats are ordered by ID (non-archived chats first), and messages in the
+    order they were sent.
+    """
+    statement = (
+        select(
+            ChatDao.id,
+            ChatDao.title,
+            ChatDao.model,
+            ChatDao.started_at,
+            ChatDao.archived,
+            MessageDao.id.label("message_id"),  # type: ignore[union-attr]
+            MessageDao.parent_id,
+            MessageDao.role,
+            func.coalesce(
+                SystemPromptsDao.prompt,
+                func.message_content(MessageDao.content, MessageDao.compressed_content),
+            ).label("content"),
+            MessageDao.timestamp,
+            MessageDao.model.label("message_model"),  # type: ignore[union-attr]
+            MessageDao.meta,
+            MessageDao.active,
+        )
+        .outerjoin(MessageDao, MessageDao.chat_id == ChatDao.id)
+        .outerjoin(SystemPromptsDao, SystemPromptsDao.id == MessageDao.system_prompt_id)
+        # This order follows the (chat_id, timestamp) index, so the rows
+        # are streamed without being sorted first.
+        .order_by(asc(ChatDao.id), asc(MessageDao.timestamp), asc(MessageDao.id))
+    )
+    if filters.since is not None:
+        statement = statement.where(col(ChatDao.started_at) >= filters.since)
+    if filters.until is not None:
+        statement = statement.where(col(ChatDao.started_at) < filters.until)
+    if filters.models:
+        statement = statement.where(col(ChatDao.model).in_(filters.models))
+
+    # Archived chats are in the archive database, so they're exported after
+    # the chats in the main database.
+    statements = []
+    if filters.archived != "only":
+        statements.append(statement)
+    if filters.archived != "exclude":
+        statements.append(in_archive(statement))
+
+    async with get_session() as session:
+        for statement in statements:
+            chat: ExportedChat | None = None
+            result = await session.stream(
+                statement.execution_options(yield_per=ROWS_PER_FETCH)
+            )
+            async for row in result:
+                if chat is None or chat.id != row.id:
+                    if chat is not None:
+                        yield chat
+                    chat = ExportedChat(
+                        id=row.id,
+                        title=row.title,
+                        model=row.model,
+                        started_at=row.started_at,
+                        archived=row.archived,
+                    )
+                if row.message_id is not None:
+                    chat.messages.append(
+                        {
+                            "id": row.message_id,
+                            "parent_id": row.parent_id,
+                            "role": row.role,
+                            "content": row.content,
+                            "timestamp": _isoformat(row.timestamp),
+                            "model": row.message_model,
+                            "meta": row.meta,
+                            "active": row.active,
+                        }
+                    )
+            if chat is not None:
+                yield chat
+
+
+async def export_chats(
+    output: Path | None,
+    export_format: ExportFormat = "jsonl",
+    compression: Compression | None = None,
+    filters: ExportFilters | None = None,
+) -> ExportProgress:
+    """Export chats to a file.
+
+    Args:
+        output: For JSONL, the file to write, with one chat per line (or None
+            to write to stdout). For Markdown, the directory to write one file
+            per chat into.
+        export_format: The format to export chats in.
+        compression: How to compress the output (each file, for Markdown).
+        filters: Which chats to export. All chats are exported by default.
+    """
+    filters = filters or ExportFilters()
+    progress = ExportProgress()
+    # When writing to stdout, the progress goes to stderr.
+    console = Console(stderr=output is None)
+    chats = iter_chats(filters)
+
+    if export_format == "markdown":
+        if output is None:
+            raise ExportError("Markdown exports must be written to a directory.")
+        output.mkdir(parents=True, exist_ok=True)
+        suffix = COMPRESSION_SUFFIXES[compression] if compression else ""
+
+    last_refresh = 0.0
+    with Live(progress, console=console, auto_refresh=False) as live:
+
+        def exported(chat: ExportedChat) -> None:
+            nonlocal last_refresh
+            progress.chat_count += 1
+            progress.message_count += len(chat.messages)
+            if time.monotonic() - last_refresh >= PROGRESS_REFRESH_INTERVAL:
+                live.refresh()
+                last_refresh = time.monotonic()
+
+        if export_format == "jsonl":
+            with open_output(output, compression) as file:
+                async for chat in chats:
+                    file.write(
+                        json.dumps(chat.to_json(), ensure_ascii=False).encode() + b"\n"
+                    )
+                    exported(chat)
+        else:
+            assert output is not None
+            async for chat in chats:
+                path = output / (chat.file_name + suffix)
+                with open_output(path, compression) as file:
+                    file.write(chat.to_markdown().encode())
+                exported(chat)
+        progress.done = True
+        live.refresh()
+    return progress
@@ -1,85 +1,693 @@
+"""Import conversations exported from ChatGPT.
+
+The export's `conversations.json` is a single JSON array which may be more than
+a gigabyte in size, so it's never loaded all at once. Conversations are decoded
+one at a time from a bounded buffer, converted into rows (optionally in a pool
+of worker processes), and inserted in large batches, each in one transaction.
+
+Imports are idempotent. Each chat records the ID of the conversation it came
+from and a hash of its content, so importing a newer export skips conversations
+which haven't changed and adds the new messages of those which have. After each
+batch, the position reached in the file is saved, so an interrupted import
+resumes from where it stopped.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import codecs
+import gc
+import hashlib
 import json
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
+from typing import Any, BinaryIO, Iterator
 
 from rich.console import Console
 from rich.live import Live
 from rich.text import Text
+from sqlalchemy import func, insert, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import col, delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from elia_chat.database.database import get_session
-from elia_chat.database.models import MessageDao, ChatDao
+from elia_chat.database.compression import compress_content, message_content
+from elia_chat.database.database import get_session, in_archive
+from elia_chat.database.models import (
+    ChatDao,
+    ImportCheckpointDao,
+    MessageDao,
+    SystemPromptsDao,
+)
 
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+"""The number of bytes read from the export file at a time."""
+
+BATCH_CHATS = 500
+"""Insert the chats once this many have been converted..."""
+
+BATCH_MESSAGES = 10_000
+"""...or once this many messages have been converted, whichever comes first."""
+
+PROGRESS_REFRESH_INTERVAL = 0.25
+"""The minimum number of seconds between updates to the progress display."""
+
+WORKER_CHUNK_SIZE = 32
+"""The number of conversations sent to a worker process at a time."""
+
+SEARCH_INDEX_TRIGGER = "message_fts_after_insert"
+"""The trigger which adds newly inserted messages to the full-text search index."""
+
+_WHITESPACE = " \t\n\r"
+
+
+class ImportFormatError(Exception):
+    """The file being imported isn't a ChatGPT conversations export."""
 
-async def import_chatgpt_data(file: Path) -> None:
-    console = Console()
 
-    with open(file, "r") as f:
-        data = json.load(f)
+@dataclass
+class ImportedChat:
+    """A conversation converted into the rows to be inserted into the database."""
 
-    console.print("[green]Loaded and parsed JSON.")
+    chat: dict[str, Any]
+    messages: list[dict[str, Any]] = field(default_factory=list)
+    """The messages of every branch, with each parent before its replies."""
+    parent_nodes: list[str | None] = field(default_factory=list)
+    """The ChatGPT node ID of the message each message replies to."""
 
-    def output_progress(
-        imported_count: int, total_count: int, message_count: int
-    ) -> Text:
-        style = "green" if imported_count == total_count else "yellow"
+
+@dataclass
+class ImportProgress:
+    chat_count: int = 0
+    updated_count: int = 0
+    skipped_count: int = 0
+    message_count: int = 0
+    bytes_read: int = 0
+    total_bytes: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    def __rich__(self) -> Text:
+        done = self.bytes_read >= self.total_bytes
+        percent = 100 * self.bytes_read / self.total_bytes if self.total_bytes else 100
+        elapsed = time.monotonic() - self.started_at
         return Text.from_markup(
-            f"Imported [b]{imported_count}[/] of [b]{total_count}[/] chats.\n"
-            f"[b]{message_count}[/] messages in total.",
-            style=style,
+            f"Imported [b]{self.chat_count}[/] new chats "
+            f"([b]{self.message_count}[/] messages), "
+            f"updated [b]{self.updated_count}[/], "
+            f"skipped [b]{self.skipped_count}[/] unchanged · "
+            f"{percent:.0f}% of file read · {elapsed:.1f}s",
+            style="green" if done else "yellow",
         )
 
-    message_count = 0
-    with Live(output_progress(0, len(data), message_count)) as live:
+
+def iter_json_array(
+    file: BinaryIO, chunk_size: int = READ_CHUNK_SIZE, resume_offset: int = 0
+) -> Iterator[tuple[Any, int]]:
+    """Decode the elements of a top-level JSON array in a UTF-8 file one at a time.
+
+    Only the element currently being decoded (and at most one chunk beyond it)
+    is held in memory, regardless of the size of the file.
+
+    Args:
+        file: The file to read, opened in binary mode.
+        chunk_size: The number of bytes to read at a time.
+        resume_offset: If not 0, the offset of the end of an element previously
+            yielded by this function. Decoding continues from the next element.
+
+    Yields:
+        Each element of the array, and the offset in the file of its end.
+    """
+    json_decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    # The offset in the file corresponding to `position` in the buffer.
+    offset = resume_offset
+    read_size = chunk_size
+    at_end = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, at_end
+        chunk = file.read(read_size)
+        if not chunk:
+            at_end = True
+            return False
+        # Drop the part of the buffer which has already been decoded.
+        buffer = buffer[position:] + utf8_decoder.decode(chunk)
+        position = 0
+        return True
+
+    def advance(end: int) -> None:
+        nonlocal position, offset
+        offset += len(buffer[position:end].encode("utf-8"))
+        position = end
+
+    def skip_whitespace() -> str:
+        """Skip whitespace, returning the next character (or "" at the end)."""
+        while True:
+            end = position
+            while end < len(buffer) and buffer[end] in _WHITESPACE:
+                end += 1
+            advance(end)
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more():
+                return ""
+
+    def skip_separator() -> bool:
+        """Skip the separator after an element, returning False at the array's end."""
+        separator = skip_whitespace()
+        advance(position + 1)
+        if separator == "]":
+            return False
+        if separator != ",":
+            raise ImportFormatError(
+                f"Expected ',' or ']' after an array element, found {separator!r}."
+            )
+        return True
+
+    file.seek(resume_offset)
+    if resume_offset:
+        if not skip_separator():
+            return
+    else:
+        if skip_whitespace() != "[":
+            raise ImportFormatError("Expected the file to contain a JSON array.")
+        advance(position + 1)
+        if skip_whitespace() == "]":
+            return
+
+    while True:
+        skip_whitespace()
+        try:
+            element, end = json_decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as error:
+            # The element may continue beyond the end of the buffer. Read
+            # progressively more so that huge elements aren't rescanned often.
+            if at_end or not read_more():
+                raise ImportFormatError(f"Invalid JSON: {error}") from error
+            read_size *= 2
+            continue
+        read_size = chunk_size
+        advance(end)
+        yield element, offset
+        if not skip_separator():
+            return
+
+
+def _timestamp(value: float | None) -> datetime:
+    return datetime.fromtimestamp(value or 0)
+
+
+def _latest_leaf(mapping: dict[str, Any]) -> str | None:
+    """Return the ID of the most recently created node with no replies."""
+    leaves = [node_id for node_id, node in mapping.items() if not node.get("children")]
+
+    def create_time(node_id: str) -> float:
+        message_info = mapping[node_id].get("message") or {}
+        return message_info.get("create_time") or 0
+
+    return max(leaves, key=create_time, default=None)
+
+
+def convert_conversation(conversation: dict[str, Any]) -> ImportedChat:
+    """Convert a ChatGPT conversation into rows for the chat and message tables.
+
+    ChatGPT stores each conversation as a tree of nodes, branching wherever a
+    message was edited or a response regenerated. Every branch is imported, and
+    the messages on the path to the conversation's `current_node` (the branch
+    which was last shown in ChatGPT) are marked as active.
+
+    This is a pure function of the conversation, so it can run in a worker process.
+    """
+    mapping: dict[str, Any] = conversation["mapping"]
+
+    current_node = conversation.get("current_node")
+    if current_node not in mapping:
+        current_node = _latest_leaf(mapping)
+    active_nodes: set[str] = set()
+    node_id = current_node
+    while node_id in mapping and node_id not in active_nodes:
+        active_nodes.add(node_id)
+        node_id = mapping[node_id].get("parent")
+
+    # Walk the tree depth-first, so parents are inserted before their replies.
+    # Nodes without a message (e.g. the root) are skipped, and their children
+    # reply to the nearest ancestor which has one.
+    roots = [
+        node_id
+        for node_id, node in mapping.items()
+        if node.get("parent") not in mapping
+    ]
+    stack: list[tuple[str, str | None]] = [(root, None) for root in reversed(roots)]
+    visited: set[str] = set()
+
+    # Messages in ChatGPT are never modified (editing one creates a new branch),
+    # so the hash only covers what can change: the title, the messages which
+    # exist, and which branch is current.
+    title = conversation.get("title")
+    content_hash = hashlib.blake2b(digest_size=16)
+    content_hash.update(f"{title}\0{current_node}\0".encode())
+
+    chat_model = "gpt-3.5-turbo"
+    imported = ImportedChat(chat={})
+    while stack:
+        node_id, parent_node_id = stack.pop()
+        if node_id in visited:
+            continue
+        visited.add(node_id)
+        node = mapping[node_id]
+
+        message_info = node.get("message")
+        if message_info:
+            metadata = message_info.get("metadata", {})
+            model = "gpt-3.5-turbo"
+            if metadata:
+                model = metadata.get("model_slug")
+                chat_model = "gpt-4-turbo" if model == "gpt-4" else "gpt-3.5-turbo"
+
+            content = str(message_info["content"].get("parts", [""])[0])
+            imported.messages.append(
+                {
+                    "role": message_info["author"]["role"],
+                    "content": content,
+                    "timestamp": _timestamp(message_info.get("create_time")),
+                    "model": model,
+                    "meta": metadata,
+                    "active": node_id in active_nodes,
+                    "source_id": node_id,
+                }
+            )
+            imported.parent_nodes.append(parent_node_id)
+            content_hash.update(f"{node_id}\0{parent_node_id}\0".encode())
+            content_hash.update(content.encode("utf-8", "surrogatepass"))
+            parent_node_id = node_id
+
+        children = [child for child in node.get("children", []) if child in mapping]
+        stack.extend((child, parent_node_id) for child in reversed(children))
+
+    source_hash = content_hash.hexdigest()
+    imported.chat = {
+        "title": title,
+        "model": chat_model,
+        "started_at": _timestamp(conversation.get("create_time")),
+        # Without an ID, identical conversations can still be recognised.
+        "source_id": conversation.get("conversation_id")
+        or conversation.get("id")
+        or source_hash,
+        "source_hash": source_hash,
+    }
+    return imported
+
+
+@dataclass(frozen=True)
+class ImportCheckpoint:
+    """Identifies the file being imported, to record how much has been imported."""
+
+    path: str
+    size: int
+    modified_ns: int
+
+    @classmethod
+    def for_file(cls, file: Path) -> "ImportCheckpoint":
+        stat = file.stat()
+        return cls(str(file.resolve()), stat.st_size, stat.st_mtime_ns)
+
+    async def load_offset(self) -> int:
+        """Return the offset an interrupted import of this file reached, or 0.
+
+        If the file has been modified since, the import starts from the beginning.
+        """
         async with get_session() as session:
-            for chat_number, chat_data in enumerate(data, start=1):
-                chat = ChatDao(
-                    title=chat_data.get("title"),
-                    model="gpt-3.5-turbo",
-                    started_at=datetime.fromtimestamp(
-                        chat_data.get("create_time", 0) or 0
-                    ),
+            checkpoint = await session.get(ImportCheckpointDao, self.path)
+        if (
+            checkpoint is None
+            or checkpoint.size != self.size
+            or checkpoint.modified_ns != self.modified_ns
+        ):
+            return 0
+        return checkpoint.offset
+
+    async def save_offset(self, session: AsyncSession, offset: int) -> None:
+        statement = sqlite_insert(ImportCheckpointDao).values(
+            path=self.path, size=self.size, modified_ns=self.modified_ns, offset=offset
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[ImportCheckpointDao.path],
+            set_={
+                "size": statement.excluded.size,
+                "modified_ns": statement.excluded.modified_ns,
+                "offset": statement.excluded.offset,
+                "updated_at": func.now(),
+            },
+        )
+        await session.execute(statement)
+
+    async def clear(self) -> None:
+        async with get_session() as session:
+            await session.exec(
+                delete(ImportCheckpointDao).where(
+                    col(ImportCheckpointDao.path) == self.path
+                )
+            )
+            await session.commit()
+
+
+async def insert_imported_chats(
+    chats: list[ImportedChat],
+    progress: ImportProgress,
+    checkpoint: ImportCheckpoint | None = None,
+    offset: int = 0,
+) -> None:
+    """Insert or update a batch of converted chats in one transaction.
+
+    Chats which were imported before are skipped if they haven't changed.
+    Otherwise their new messages are added, and they're updated to show
+    the current branch.
+
+    Args:
+        chats: The converted chats.
+        progress: Updated with the number of chats and messages imported.
+        checkpoint: If set, the offset is saved as part of the transaction.
+        offset: The offset in the file of the end of the last chat in the batch.
+    """
+    async with get_session() as session:
+        # Indexing each message for search as it's inserted is several times
+        # slower than indexing the whole batch afterwards, so the trigger is
+        # dropped for the duration of this transaction. The transaction is
+        # begun explicitly, as the sqlite3 module would otherwise commit the
+        # DROP TRIGGER straight away, and the trigger would stay dropped if the
+        # batch failed or was cancelled.
+        await session.execute(text("BEGIN"))
+        trigger = await session.execute(
+            text(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = :name"
+            ),
+            {"name": SEARCH_INDEX_TRIGGER},
+        )
+        trigger_sql = trigger.scalar()
+        if trigger_sql:
+            await session.execute(text(f"DROP TRIGGER {SEARCH_INDEX_TRIGGER}"))
+
+        # If a conversation appears more than once, the last copy wins.
+        by_source_id = {imported.chat["source_id"]: imported for imported in chats}
+        existing = await session.execute(
+            select(ChatDao.source_id, ChatDao.id, ChatDao.source_hash).where(
+                col(ChatDao.source_id).in_(by_source_id)
+            )
+        )
+        new_chats = dict(by_source_id)
+        changed_chats: list[tuple[int, ImportedChat]] = []
+        for source_id, chat_id, source_hash in existing:
+            imported = new_chats.pop(source_id)
+            if source_hash == imported.chat["source_hash"]:
+                progress.skipped_count += 1
+            else:
+                changed_chats.append((chat_id, imported))
+        # Chats which have been archived since they were imported are left
+        # in the archive, as they are.
+        archived = await session.execute(
+            in_archive(
+                select(ChatDao.source_id).where(col(ChatDao.source_id).in_(new_chats))
+            )
+        )
+        for source_id in archived.scalars():
+            del new_chats[source_id]
+            progress.skipped_count += 1
+
+        last_message_id = await session.scalar(select(func.max(MessageDao.id)))
+        chat_ids = await _insert_chats(session, list(new_chats.values()))
+        message_rows: list[dict[str, Any]] = []
+        linked_chats = list(zip(chat_ids, new_chats.values()))
+        for chat_id, imported in linked_chats:
+            message_rows.extend(
+                {**message, "chat_id": chat_id} for message in imported.messages
+            )
+        if changed_chats:
+            message_rows.extend(await _update_chats(session, changed_chats))
+            linked_chats.extend(changed_chats)
+
+        if message_rows:
+            await _link_system_prompts(session, message_rows)
+            await session.execute(insert(MessageDao), message_rows)
+        if linked_chats:
+            # Changed chats may only have switched branch, without new messages.
+            await _link_replies(session, linked_chats)
+            await ChatDao.refresh_activity(
+                session, [chat_id for chat_id, _ in linked_chats]
+            )
+
+        if trigger_sql:
+            await session.execute(
+                text(
+                    "INSERT INTO message_fts (rowid, content) "
+                    "SELECT id, content FROM message_text WHERE id > :last_message_id"
+                ),
+                {"last_message_id": last_message_id or 0},
+            )
+            await session.execute(text(trigger_sql))
+        if checkpoint is not None:
+            await checkpoint.save_offset(session, offset)
+        await session.commit()
+
+    progress.chat_count += len(new_chats)
+    progress.updated_count += len(changed_chats)
+    progress.message_count += len(message_rows)
+
+
+async def _link_system_prompts(
+    session: AsyncSession, message_rows: list[dict[str, Any]]
+) -> None:
+    """Point system messages at the stored copy of their prompt (e.g. the
+    custom instructions, which are repeated in every conversation)."""
+    system_rows = [row for row in message_rows if row["role"] == "system"]
+    prompts = [
+        message_content(row["content"], row["compressed_content"])
+        for row in system_rows
+    ]
+    prompt_ids = await SystemPromptsDao.ids_for_prompts(session, prompts)
+    for row in message_rows:
+        row["system_prompt_id"] = None
+    for row, prompt in zip(system_rows, prompts):
+        row.update(content="", compressed_content=None)
+        row["system_prompt_id"] = prompt_ids[prompt]
+
+
+async def _insert_chats(session: AsyncSession, chats: list[ImportedChat]) -> list[int]:
+    """Insert new chats, returning their IDs in the same order."""
+    if not chats:
+        return []
+    # SQLAlchemy can only return the IDs of rows inserted into SQLite in
+    # order by inserting them one at a time. Instead, the new IDs are read
+    # back afterwards: this transaction holds the write lock, so they're
+    # exactly the IDs after the largest existing one, in insertion order.
+    last_chat_id = await session.scalar(select(func.max(ChatDao.id)))
+    await session.execute(insert(ChatDao), [imported.chat for imported in chats])
+    new_chat_ids = await session.scalars(
+        select(ChatDao.id).where(ChatDao.id > (last_chat_id or 0)).order_by(ChatDao.id)
+    )
+    return list(new_chat_ids)
+
+
+async def _update_chats(
+    session: AsyncSession, chats: list[tuple[int, ImportedChat]]
+) -> list[dict[str, Any]]:
+    """Update chats which have changed since they were imported.
+
+    Returns:
+        The rows of the messages which haven't been imported yet.
+    """
+    await session.execute(
+        text(
+            "UPDATE chat SET title = :title, model = :model, "
+            "source_hash = :source_hash WHERE id = :id"
+        ),
+        [
+            {
+                "id": chat_id,
+                "title": imported.chat["title"],
+                "model": imported.chat["model"],
+                "source_hash": imported.chat["source_hash"],
+            }
+            for chat_id, imported in chats
+        ],
+    )
+    existing = await session.execute(
+        select(MessageDao.chat_id, MessageDao.source_id).where(
+            col(MessageDao.chat_id).in_([chat_id for chat_id, _ in chats]),
+            col(MessageDao.source_id).is_not(None),
+        )
+    )
+    imported_nodes = set(existing.tuples())
+    return [
+        {**message, "chat_id": chat_id}
+        for chat_id, imported in chats
+        for message in imported.messages
+        if (chat_id, message["source_id"]) not in imported_nodes
+    ]
+
+
+async def _link_replies(
+    session: AsyncSession, chats: list[tuple[int, ImportedChat]]
+) -> None:
+    """Set the `parent_id` and `active` flag of the messages of imported chats.
+
+    The ChatGPT node ID of each message's parent is recorded in a temporary
+    table, so that every parent is resolved by a single UPDATE.
+    """
+    await session.execute(
+        text(
+            "CREATE TEMP TABLE IF NOT EXISTS import_message_node ("
+            "chat_id INTEGER NOT NULL, "
+            "node_id TEXT NOT NULL, "
+            "parent_node_id TEXT, "
+            "active BOOLEAN NOT NULL, "
+            "PRIMARY KEY (chat_id, node_id))"
+        )
+    )
+    node_rows = [
+        (chat_id, message["source_id"], parent_node_id, message["active"])
+        for chat_id, imported in chats
+        for message, parent_node_id in zip(imported.messages, imported.parent_nodes)
+    ]
+    connection = await session.connection()
+    await connection.exec_driver_sql(
+        "INSERT INTO import_message_node "
+        "(chat_id, node_id, parent_node_id, active) VALUES (?, ?, ?, ?)",
+        node_rows,
+    )
+    await session.execute(
+        text(
+            "UPDATE message SET active = node.active, parent_id = ("
+            "SELECT parent.id FROM message AS parent "
+            "WHERE parent.chat_id = node.chat_id "
+            "AND parent.source_id = node.parent_node_id) "
+            "FROM import_message_node AS node "
+            "WHERE message.chat_id = node.chat_id AND message.source_id = node.node_id"
+        )
+    )
+    await session.execute(text("DELETE FROM import_message_node"))
+
+
+def _batches(
+    conversations: Iterator[tuple[Any, int]], progress: ImportProgress
+) -> Iterator[tuple[list[dict[str, Any]], int]]:
+    """Group conversations into batches, updating the number of bytes read.
+
+    Yields:
+        Each batch, and the offset in the file of the end of its last conversation.
+    """
+    batch: list[dict[str, Any]] = []
+    batch_messages = 0
+    offset = 0
+    for conversation, offset in conversations:
+        if not isinstance(conversation, dict) or "mapping" not in conversation:
+            raise ImportFormatError(
+                "Expected each element of the array to be a ChatGPT conversation."
+            )
+        progress.bytes_read = offset
+        batch.append(conversation)
+        batch_messages += len(conversation["mapping"])
+        if len(batch) >= BATCH_CHATS or batch_messages >= BATCH_MESSAGES:
+            yield batch, offset
+            batch = []
+            batch_messages = 0
+    if batch:
+        yield batch, offset
+
+
+def _convert_batch(
+    batch: list[dict[str, Any]], executor: Executor | None
+) -> list[ImportedChat]:
+    if executor is None:
+        chats = [convert_conversation(conversation) for conversation in batch]
+    else:
+        chats = list(
+            executor.map(convert_conversation, batch, chunksize=WORKER_CHUNK_SIZE)
+        )
+    # Long messages are compressed here, rather than when they're inserted,
+    # so it overlaps with inserting the previous batch.
+    for imported in chats:
+        for message in imported.messages:
+            message["content"], message["compressed_content"] = compress_content(
+                message["content"]
+            )
+    return chats
+
+
+async def import_chatgpt_data(file: Path, workers: int = 0) -> None:
+    """Import the conversations from a ChatGPT `conversations.json` export.
+
+    If a previous import of the same file was interrupted, it's resumed.
+
+    Args:
+        file: The path to the export.
+        workers: The number of worker processes used to convert conversations.
+            If 0, conversations are converted in this process.
+    """
+    console = Console()
+    checkpoint = ImportCheckpoint.for_file(file)
+    resume_offset = await checkpoint.load_offset()
+    progress = ImportProgress(bytes_read=resume_offset, total_bytes=checkpoint.size)
+    if resume_offset:
+        console.print(
+            f"[yellow]Resuming an interrupted import "
+            f"({100 * resume_offset / checkpoint.size:.0f}% of the file was imported)."
+        )
+
+    executor = ProcessPoolExecutor(workers) if workers > 0 else None
+    last_refresh = 0.0
+    insert_task: asyncio.Task[None] | None = None
+
+    # The decoded conversations contain no reference cycles, but allocating
+    # so many objects would otherwise trigger frequent, slow full collections.
+    gc.disable()
+    try:
+        with (
+            open(file, "rb") as f,
+            Live(progress, console=console, auto_refresh=False) as live,
+        ):
+            conversations = iter_json_array(f, resume_offset=resume_offset)
+            batches = _batches(conversations, progress)
+
+            def next_batch() -> tuple[list[ImportedChat], int] | None:
+                batch = next(batches, None)
+                if batch is None:
+                    return None
+                conversations, offset = batch
+                return _convert_batch(conversations, executor), offset
+
+            while True:
+                # Decode the next batch in a thread while the previous batch is
+                # being inserted (SQLite releases the GIL while it works).
+                batch = await asyncio.to_thread(next_batch)
+                if insert_task is not None:
+                    await insert_task
+                if batch is None:
+                    break
+                chats, offset = batch
+                insert_task = asyncio.create_task(
+                    insert_imported_chats(chats, progress, checkpoint, offset)
                 )
-                session.add(chat)
-                await (
-                    session.commit()
-                )  # Make sure to commit so that chat.id is assigned
-
-                for _message_id, message_data in chat_data["mapping"].items():
-                    message_info = message_data.get("message")
-                    if message_info:
-                        metadata = message_info.get("metadata", {})
-                        model = "gpt-3.5-turbo"
-                        if metadata:
-                            model = metadata.get("model_slug")
-                            chat.model = (
-                                "gpt-4-turbo" if model == "gpt-4" else "gpt-3.5-turbo"
-                            )
-                            session.add(chat)
-                            await session.commit()
-
-                        role = message_info["author"]["role"]
-                        chat_id = chat.id
-                        message = MessageDao(
-                            chat_id=chat_id,
-                            role=role,
-                            content=str(message_info["content"].get("parts", [""])[0]),
-                            timestamp=datetime.fromtimestamp(
-                                message_info.get("create_time", 0) or 0
-                            ),
-                            model=model,
-                            meta=metadata,
-                        )
-                        session.add(message)
-                        message_count += 1
-                        live.update(
-                            output_progress(chat_number, len(data), message_count)
-                        )
-
-                await session.commit()
+                now = time.monotonic()
+                if now - last_refresh >= PROGRESS_REFRESH_INTERVAL:
+                    live.refresh()
+                    last_refresh = now
+            live.refresh()
+    finally:
+        if insert_task is not None and not insert_task.done():
+            insert_task.cancel()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        gc.enable()
+
+    await checkpoint.clear()
 
 
 if __name__ == "__main__":
     path = Path("resources/conversations.json")
-    import asyncio
 
     asyncio.run(import_chatgpt_data(path))
@@ -0,0 +1,454 @@
+"""Diagnostics and routine maintenance for the database, used by `elia db`.
+
+`database_stats` reports how big each table and index is, which chats take up
+the most space, how much of each database file is free pages, and how SQLite
+plans the queries the app makes most often. `optimize_database` refreshes the
+query planner's statistics, merges the search index, and returns free pages to
+the filesystem. `check_database` looks for corruption.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from sqlalchemy import Executable, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlmodel import col, select
+
+from elia_chat.database.archive import MAIN_SCHEMA
+from elia_chat.database.compression import DecompressionError, decompress
+from elia_chat.database.database import (
+    ARCHIVE_SCHEMA,
+    archive_file_name,
+    engine,
+    sqlite_file_name,
+)
+from elia_chat.database.models import ChatDao, MessageDao
+
+SCHEMAS = (MAIN_SCHEMA, ARCHIVE_SCHEMA)
+
+SEARCH_INDEX_TABLE = "message_fts"
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+QUICK_ANALYSIS_LIMIT = 400
+"""The number of rows `PRAGMA optimize` examines per index when it's run on exit,
+so that it finishes quickly however large the database is."""
+
+CHECK_BATCH_SIZE = 1000
+
+
+@dataclass
+class DatabaseFileStats:
+    schema: str
+    path: Path
+    file_size: int
+    wal_size: int
+    page_size: int
+    page_count: int
+    freelist_count: int
+    auto_vacuum: str
+
+    @property
+    def free_bytes(self) -> int:
+        return self.freelist_count * self.page_size
+
+    @property
+    def fragmentation(self) -> float:
+        """The fraction of the file made up of free pages."""
+        return self.freelist_count / self.page_count if self.page_count else 0
+
+
+@dataclass
+class TableStats:
+    schema: str
+    name: str
+    type: str
+    """Either 'table' or 'index'."""
+    table: str
+    """For an index, the table it indexes."""
+    rows: int | None
+    """The number of rows, for tables. `None` for indexes."""
+    size: int | None
+    """The number of bytes used, or `None` if SQLite wasn't compiled with the
+    `dbstat` virtual table."""
+    unused: int | None
+    """The number of bytes which are allocated but unused, within the pages."""
+    stat: str | None = None
+    """For an index, the statistics `ANALYZE` gathered on it: the number of rows,
+    then the average number of rows matching each prefix of its columns."""
+
+
+@dataclass
+class ChatSize:
+    schema: str
+    chat_id: int
+    title: str | None
+    message_count: int
+    size: int
+    """The number of bytes of message content, as stored (i.e. compressed)."""
+
+
+@dataclass
+class QueryPlan:
+    name: str
+    steps: list[str]
+    full_scans: list[str]
+    """The steps which read a whole table without using an index."""
+
+
+@dataclass
+class DatabaseStats:
+    files: list[DatabaseFileStats]
+    tables: list[TableStats]
+    largest_chats: list[ChatSize]
+    query_plans: list[QueryPlan]
+
+
+@dataclass
+class OptimizeStep:
+    description: str
+    seconds: float
+
+
+@dataclass
+class OptimizeResult:
+    steps: list[OptimizeStep] = field(default_factory=list)
+    size_before: int = 0
+    size_after: int = 0
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _total_size() -> int:
+    return sum(
+        _file_size(path.with_name(path.name + suffix))
+        for path in (sqlite_file_name, archive_file_name)
+        for suffix in ("", "-wal")
+    )
+
+
+async def _pragma(connection: AsyncConnection, pragma: str) -> int:
+    return (await connection.exec_driver_sql(f"PRAGMA {pragma}")).scalar_one()
+
+
+def _compile(statement: Executable) -> str:
+    return str(
+        statement.compile(
+            dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def _common_queries() -> dict[str, str]:
+    """The queries made most often by the app, by what they're for."""
+    load_chat = (
+        select(MessageDao)
+        .where(col(MessageDao.chat_id).in_([1]), MessageDao.active)
+        .order_by(MessageDao.id)
+    )
+    return {
+        "Chat list (first page)": _compile(ChatDao.summaries_statement()),
+        "Opening a chat": _compile(load_chat),
+    }
+
+
+async def _file_stats(connection: AsyncConnection) -> list[DatabaseFileStats]:
+    files = []
+    for schema, path in zip(SCHEMAS, (sqlite_file_name, archive_file_name)):
+        auto_vacuum = await _pragma(connection, f"{schema}.auto_vacuum")
+        files.append(
+            DatabaseFileStats(
+                schema=schema,
+                path=path,
+                file_size=_file_size(path),
+                wal_size=_file_size(path.with_name(path.name + "-wal")),
+                page_size=await _pragma(connection, f"{schema}.page_size"),
+                page_count=await _pragma(connection, f"{schema}.page_count"),
+                freelist_count=await _pragma(connection, f"{schema}.freelist_count"),
+                auto_vacuum=AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+            )
+        )
+    return files
+
+
+async def _table_stats(connection: AsyncConnection) -> list[TableStats]:
+    index_stats: dict[str, str] = {}
+    if await connection.scalar(
+        text("SELECT 1 FROM main.sqlite_master WHERE name = 'sqlite_stat1'")
+    ):
+        rows = await connection.exec_driver_sql(
+            "SELECT idx, stat FROM main.sqlite_stat1 WHERE idx IS NOT NULL"
+        )
+        index_stats = dict(rows.tuples().all())
+
+    tables = []
+    for schema in SCHEMAS:
+        sizes: dict[str, tuple[int, int]] = {}
+        try:
+            rows = await connection.exec_driver_sql(
+                "SELECT name, sum(pgsize), sum(unused) FROM dbstat(?) GROUP BY name",
+                (schema,),
+            )
+        except DBAPIError:
+            pass
+        else:
+            sizes = {name: (size, unused) for name, size, unused in rows}
+
+        objects = await connection.exec_driver_sql(
+            f"SELECT type, name, tbl_name, sql FROM {schema}.sqlite_master "
+            "WHERE type IN ('table', 'index') ORDER BY tbl_name, type DESC, name"
+        )
+        for object_type, name, table, sql in objects.all():
+            rows_count = None
+            virtual = sql is not None and sql.startswith("CREATE VIRTUAL TABLE")
+            if object_type == "table" and not virtual:
+                rows_count = await connection.scalar(
+                    text(f'SELECT count(*) FROM {schema}."{name}"')
+                )
+            size, unused = sizes.get(name, (None, None))
+            tables.append(
+                TableStats(
+                    schema=schema,
+                    name=name,
+                    type=object_type,
+                    table=table,
+                    rows=rows_count,
+                    size=size,
+                    unused=unused,
+                    stat=index_stats.get(name) if schema == MAIN_SCHEMA else None,
+                )
+            )
+    return tables
+
+
+async def _largest_chats(connection: AsyncConnection, limit: int) -> list[ChatSize]:
+    chats = []
+    for schema in SCHEMAS:
+        rows = await connection.execute(
+            text(
+                "SELECT chat.id, chat.title, stats.message_count, stats.size "
+                "FROM ("
+                "    SELECT chat_id, count(*) AS message_count, "
+                "           sum(length(CAST(content AS BLOB)) "
+                "               + coalesce(length(compressed_content), 0)) AS size "
+                f"    FROM {schema}.message GROUP BY chat_id"
+                ") AS stats "
+                f"JOIN {schema}.chat ON chat.id = stats.chat_id "
+                "ORDER BY stats.size DESC LIMIT :limit"
+            ),
+            {"limit": limit},
+        )
+        chats.extend(ChatSize(schema, *row) for row in rows)
+    chats.sort(key=lambda chat: chat.size, reverse=True)
+    return chats[:limit]
+
+
+async def _query_plans(connection: AsyncConnection) -> list[QueryPlan]:
+    tables = set(
+        (
+            await connection.exec_driver_sql(
+                "SELECT name FROM main.sqlite_master WHERE type = 'table'"
+            )
+        ).scalars()
+    )
+    plans = []
+    for name, query in _common_queries().items():
+        rows = await connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {query}")
+        steps = [row.detail for row in rows]
+        full_scans = [
+            step
+            for step in steps
+            if step.startswith("SCAN ")
+            and step.split()[1] in tables
+            and " INDEX " not in step
+        ]
+        plans.append(QueryPlan(name, steps, full_scans))
+    return plans
+
+
+async def database_stats(largest_chats: int = 10) -> DatabaseStats:
+    """Gather statistics about the main and archive databases."""
+    async with engine.connect() as connection:
+        return DatabaseStats(
+            files=await _file_stats(connection),
+            tables=await _table_stats(connection),
+            largest_chats=await _largest_chats(connection, largest_chats),
+            query_plans=await _query_plans(connection),
+        )
+
+
+async def optimize_database(
+    full_vacuum: bool = False, quick: bool = False
+) -> OptimizeResult:
+    """Refresh the query planner's statistics and reclaim unused space.
+
+    Args:
+        full_vacuum: Rebuild each database file with `VACUUM`, rather than only
+            truncating its free pages. Slower, but also defragments the file.
+        quick: Only run a bounded `PRAGMA optimize`, which is cheap enough to run
+            every time Elia exits.
+    """
+    result = OptimizeResult(size_before=_total_size())
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+
+        async def run(description: str, *statements: str) -> None:
+            start = time.perf_counter()
+            for statement in statements:
+                # Fetch the results, since some PRAGMAs only make progress as
+                # the rows they return are stepped through.
+                cursor = await connection.exec_driver_sql(statement)
+                if cursor.returns_rows:
+                    cursor.all()
+            result.steps.append(OptimizeStep(description, time.perf_counter() - start))
+
+        if quick:
+            await run(
+                "Optimized the query planner statistics",
+                f"PRAGMA analysis_limit = {QUICK_ANALYSIS_LIMIT}",
+                "PRAGMA optimize",
+            )
+            result.size_after = _total_size()
+            return result
+
+        await run("Analyzed tables and indexes", "ANALYZE")
+        has_search_index = await connection.scalar(
+            text("SELECT 1 FROM main.sqlite_master WHERE name = :name"),
+            {"name": SEARCH_INDEX_TABLE},
+        )
+        if has_search_index:
+            await run(
+                "Merged the search index",
+                f"INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}) "
+                "VALUES ('optimize')",
+            )
+
+        for schema in SCHEMAS:
+            incremental = await _pragma(connection, f"{schema}.auto_vacuum") == 2
+            if full_vacuum or not incremental:
+                # Changing the auto-vacuum mode of an existing database only
+                # takes effect once it has been rebuilt.
+                await run(
+                    f"Rebuilt the {schema} database",
+                    f"PRAGMA {schema}.auto_vacuum = INCREMENTAL",
+                    f"VACUUM {schema}",
+                )
+            else:
+                await run(
+                    f"Released free pages from the {schema} database",
+                    f"PRAGMA {schema}.incremental_vacuum",
+                )
+
+        await run("Optimized the query planner statistics", "PRAGMA optimize")
+        await run(
+            "Checkpointed the write-ahead log",
+            *(f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)" for schema in SCHEMAS),
+        )
+    result.size_after = _total_size()
+    return result
+
+
+async def _integrity_problems(connection: AsyncConnection) -> list[str]:
+    problems = []
+    for schema in SCHEMAS:
+        rows = await connection.exec_driver_sql(f"PRAGMA {schema}.integrity_check")
+        problems.extend(
+            f"{schema}: {message}" for (message,) in rows if message != "ok"
+        )
+
+    rows = await connection.exec_driver_sql(f"PRAGMA {MAIN_SCHEMA}.foreign_key_check")
+    problems.extend(
+        f"{MAIN_SCHEMA}: {table} row {rowid} refers to a missing {parent} row"
+        for table, rowid, parent, _ in rows
+    )
+    # Archived messages refer to the system prompts in the main database, which
+    # SQLite can't enforce (or check) as a foreign key.
+    missing_prompts = await connection.scalar(
+        text(
+            f"SELECT count(*) FROM {ARCHIVE_SCHEMA}.message "
+            "WHERE system_prompt_id IS NOT NULL AND system_prompt_id NOT IN "
+            f"(SELECT id FROM {MAIN_SCHEMA}.system_prompt)"
+        )
+    )
+    if missing_prompts:
+        problems.append(
+            f"{ARCHIVE_SCHEMA}: {missing_prompts} messages refer to "
+            "a missing system prompt"
+        )
+
+    has_search_index = await connection.scalar(
+        text("SELECT 1 FROM main.sqlite_master WHERE name = :name"),
+        {"name": SEARCH_INDEX_TABLE},
+    )
+    if has_search_index:
+        try:
+            # With a rank of 1, the index is also compared against the messages.
+            await connection.exec_driver_sql(
+                f"INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}, rank) "
+                "VALUES ('integrity-check', 1)"
+            )
+        except DBAPIError as error:
+            problems.append(
+                f"{MAIN_SCHEMA}: the search index doesn't match the messages "
+                f"({error.orig}). Rebuild it with "
+                f"INSERT INTO {SEARCH_INDEX_TABLE}({SEARCH_INDEX_TABLE}) "
+                "VALUES ('rebuild')"
+            )
+    return problems
+
+
+async def _compression_problems(connection: AsyncConnection) -> list[str]:
+    problems = []
+    for schema in SCHEMAS:
+        last_id = 0
+        while True:
+            rows = (
+                await connection.exec_driver_sql(
+                    f"SELECT id, compressed_content FROM {schema}.message "
+                    "WHERE compressed_content IS NOT NULL AND id > ? "
+                    "ORDER BY id LIMIT ?",
+                    (last_id, CHECK_BATCH_SIZE),
+                )
+            ).all()
+            if not rows:
+                break
+            for message_id, compressed in rows:
+                try:
+                    decompress(compressed)
+                except (
+                    DecompressionError,
+                    ValueError,
+                    IndexError,
+                    zlib.error,
+                ) as error:
+                    problems.append(
+                        f"{schema}: message {message_id} can't be decompressed "
+                        f"({error})"
+                    )
+            last_id = rows[-1][0]
+    return problems
+
+
+async def check_database() -> list[str]:
+    """Check the main and archive databases for corruption.
+
+    Returns:
+        A description of each problem found, or an empty list.
+    """
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        problems = await _integrity_problems(connection)
+        problems.extend(await _compression_problems(connection))
+    return problems
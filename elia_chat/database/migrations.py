@@ -0,0 +1,447 @@
+"""Versioned schema migrations for the Elia database.
+
+`SQLModel.metadata.create_all` only creates tables which don't exist yet, so
+changes to existing tables (new columns, indexes, triggers, backfills) are made
+by migrations. Each migration upgrades the schema by one version, and pending
+migrations are applied in order at startup. Applied migrations are recorded in
+the `schema_version` table.
+
+Migrations also run against freshly created databases, so they must be safe to
+apply to tables which `create_all` has just created from the current models
+(e.g. use `IF NOT EXISTS`, and `add_column_if_missing` for new columns).
+"""
+
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import Connection, text
+from textual import log
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    """The schema version after this migration has been applied."""
+    description: str
+    upgrade: Callable[[Connection], None]
+    """Apply the migration using the given connection."""
+
+
+MIGRATIONS: list[Migration] = []
+"""All migrations, in the order they must be applied."""
+
+
+def migration(version: int, description: str):
+    """Register the decorated function as the migration to `version`."""
+
+    def decorator(upgrade: Callable[[Connection], None]) -> Callable:
+        expected_version = len(MIGRATIONS) + 1
+        assert (
+            version == expected_version
+        ), f"Migration {version} registered out of order (expected {expected_version})."
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+
+    return decorator
+
+
+def add_column_if_missing(
+    connection: Connection,
+    table: str,
+    column: str,
+    definition: str,
+    schema: str = "main",
+) -> None:
+    """Add a column to a table, unless `create_all` already created it.
+
+    Args:
+        connection: The connection to use.
+        table: The name of the table.
+        column: The name of the column to add.
+        definition: The SQL type and constraints of the column.
+        schema: The database containing the table.
+    """
+    columns = connection.execute(text(f"PRAGMA {schema}.table_info({table})")).all()
+    if column not in {row.name for row in columns}:
+        connection.execute(
+            text(f"ALTER TABLE {schema}.{table} ADD COLUMN {column} {definition}")
+        )
+
+
+def get_schema_version(connection: Connection) -> int:
+    """Return the version of the schema, or 0 if no migrations have run."""
+    connection.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "description TEXT NOT NULL, "
+            "applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+    )
+    version = connection.execute(text("SELECT max(version) FROM schema_version"))
+    return version.scalar() or 0
+
+
+def upgrade_schema(connection: Connection) -> list[Migration]:
+    """Apply all pending migrations in order.
+
+    Returns:
+        The migrations which were applied.
+    """
+    current_version = get_schema_version(connection)
+    pending = [m for m in MIGRATIONS if m.version > current_version]
+    for pending_migration in pending:
+        log.info(
+            f"Migrating database to version {pending_migration.version}: "
+            f"{pending_migration.description}"
+        )
+        pending_migration.upgrade(connection)
+        connection.execute(
+            text(
+                "INSERT INTO schema_version (version, description) "
+                "VALUES (:version, :description)"
+            ),
+            {
+                "version": pending_migration.version,
+                "description": pending_migration.description,
+            },
+        )
+    return pending
+
+
+@migration(1, "Add indexes for loading chats and messages")
+def _add_message_and_chat_indexes(connection: Connection) -> None:
+    # Loading the messages of a chat, and finding the latest message in each chat.
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_message_chat_id_timestamp "
+            "ON message (chat_id, timestamp)"
+        )
+    )
+    # Following replies from a message.
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_message_parent_id ON message (parent_id)")
+    )
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_chat_archived ON chat (archived)")
+    )
+
+
+@migration(2, "Add a full-text search index over message content")
+def _add_message_full_text_search(connection: Connection) -> None:
+    fts5_available = connection.execute(
+        text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+    ).scalar()
+    if not fts5_available:
+        log.warning("SQLite was built without FTS5, so search will be unavailable.")
+        return
+
+    # An external content table: the text lives only in the message table,
+    # and the triggers below keep the index in sync with it.
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+            "content, content='message', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER IF NOT EXISTS message_fts_after_insert "
+            "AFTER INSERT ON message BEGIN "
+            "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); "
+            "END"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER IF NOT EXISTS message_fts_after_delete "
+            "AFTER DELETE ON message BEGIN "
+            "INSERT INTO message_fts (message_fts, rowid, content) "
+            "VALUES ('delete', old.id, old.content); "
+            "END"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER IF NOT EXISTS message_fts_after_update "
+            "AFTER UPDATE OF content ON message BEGIN "
+            "INSERT INTO message_fts (message_fts, rowid, content) "
+            "VALUES ('delete', old.id, old.content); "
+            "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); "
+            "END"
+        )
+    )
+    # Index the messages which existed before this migration.
+    connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+
+
+@migration(3, "Track which branch of each chat is shown")
+def _add_message_active_branch(connection: Connection) -> None:
+    # Existing chats have a single branch, so every message is on it.
+    add_column_if_missing(connection, "message", "active", "BOOLEAN NOT NULL DEFAULT 1")
+
+
+@migration(4, "Record where imported chats and messages came from")
+def _add_import_source_columns(connection: Connection) -> None:
+    add_column_if_missing(connection, "chat", "source_id", "VARCHAR")
+    add_column_if_missing(connection, "chat", "source_hash", "VARCHAR")
+    add_column_if_missing(connection, "message", "source_id", "VARCHAR")
+    # Each conversation and message is only imported once. (NULLs are distinct,
+    # so chats and messages which weren't imported are unaffected.)
+    connection.execute(
+        text("CREATE UNIQUE INDEX IF NOT EXISTS ix_chat_source_id ON chat (source_id)")
+    )
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_message_chat_id_source_id "
+            "ON message (chat_id, source_id)"
+        )
+    )
+
+
+@migration(5, "Allow message content to be stored compressed")
+def _add_compressed_message_content(connection: Connection) -> None:
+    add_column_if_missing(connection, "message", "compressed_content", "BLOB")
+    # The text of each message, whether or not it's compressed. The
+    # `message_content` function is registered on each connection by Elia, so
+    # this view (and the triggers below) can't be used by other SQLite clients.
+    connection.execute(
+        text(
+            "CREATE VIEW IF NOT EXISTS message_text AS "
+            "SELECT id, message_content(content, compressed_content) AS content "
+            "FROM message"
+        )
+    )
+    search_index = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'message_fts'")
+    ).scalar()
+    if not search_index:
+        return
+
+    # Rebuild the search index over the decompressed text, rather than the
+    # (possibly empty) content column.
+    for trigger in ("insert", "delete", "update"):
+        connection.execute(text(f"DROP TRIGGER IF EXISTS message_fts_after_{trigger}"))
+    connection.execute(text("DROP TABLE message_fts"))
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE message_fts USING fts5("
+            "content, content='message_text', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER message_fts_after_insert "
+            "AFTER INSERT ON message BEGIN "
+            "INSERT INTO message_fts (rowid, content) "
+            "VALUES (new.id, message_content(new.content, new.compressed_content)); "
+            "END"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TRIGGER message_fts_after_delete "
+            "AFTER DELETE ON message BEGIN "
+            "INSERT INTO message_fts (message_fts, rowid, content) "
+            "VALUES ('delete', old.id, "
+            "message_content(old.content, old.compressed_content)); "
+            "END"
+        )
+    )
+    # (Re)compressing a message changes how it's stored, but not its text,
+    # so it doesn't need to be reindexed.
+    connection.execute(
+        text(
+            "CREATE TRIGGER message_fts_after_update "
+            "AFTER UPDATE OF content, compressed_content ON message "
+            "WHEN message_content(old.content, old.compressed_content) "
+            "IS NOT message_content(new.content, new.compressed_content) BEGIN "
+            "INSERT INTO message_fts (message_fts, rowid, content) "
+            "VALUES ('delete', old.id, "
+            "message_content(old.content, old.compressed_content)); "
+            "INSERT INTO message_fts (rowid, content) "
+            "VALUES (new.id, message_content(new.content, new.compressed_content)); "
+            "END"
+        )
+    )
+    connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+
+
+SYSTEM_PROMPT_BATCH_SIZE = 1000
+
+
+@migration(6, "Store each distinct system prompt once")
+def _deduplicate_system_prompts(connection: Connection) -> None:
+    from elia_chat.database.models import SYSTEM_PROMPT_TITLE_LENGTH, hash_system_prompt
+
+    add_column_if_missing(connection, "system_prompt", "prompt_hash", "VARCHAR")
+    add_column_if_missing(
+        connection,
+        "message",
+        "system_prompt_id",
+        "INTEGER REFERENCES system_prompt (id)",
+    )
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_system_prompt_prompt_hash "
+            "ON system_prompt (prompt_hash)"
+        )
+    )
+
+    # Point each system message at the stored copy of its prompt, a batch at
+    # a time, since every chat has a (possibly long) system message.
+    prompt_ids: dict[str, int] = {}
+    after = 0
+    while True:
+        messages = connection.execute(
+            text(
+                "SELECT id, message_content(content, compressed_content) AS prompt "
+                "FROM message WHERE role = 'system' AND system_prompt_id IS NULL "
+                "AND id > :after ORDER BY id LIMIT :limit"
+            ),
+            {"after": after, "limit": SYSTEM_PROMPT_BATCH_SIZE},
+        ).all()
+        if not messages:
+            break
+        updates = []
+        for message_id, prompt in messages:
+            prompt_hash = hash_system_prompt(prompt)
+            if prompt_hash not in prompt_ids:
+                connection.execute(
+                    text(
+                        "INSERT INTO system_prompt (title, prompt, prompt_hash) "
+                        "VALUES (:title, :prompt, :prompt_hash) "
+                        "ON CONFLICT (prompt_hash) DO NOTHING"
+                    ),
+                    {
+                        "title": prompt.strip().partition("\n")[0][
+                            :SYSTEM_PROMPT_TITLE_LENGTH
+                        ],
+                        "prompt": prompt,
+                        "prompt_hash": prompt_hash,
+                    },
+                )
+                prompt_ids[prompt_hash] = connection.execute(
+                    text("SELECT id FROM system_prompt WHERE prompt_hash = :hash"),
+                    {"hash": prompt_hash},
+                ).scalar_one()
+            updates.append({"id": message_id, "prompt_id": prompt_ids[prompt_hash]})
+        connection.execute(
+            text(
+                "UPDATE message SET system_prompt_id = :prompt_id, content = '', "
+                "compressed_content = NULL WHERE id = :id"
+            ),
+            updates,
+        )
+        after = messages[-1].id
+
+
+@migration(7, "Record the latest activity and message count of each chat")
+def _add_chat_activity_columns(connection: Connection) -> None:
+    from elia_chat.database.database import ARCHIVE_SCHEMA
+
+    # The latest timestamps are stored in SQLAlchemy's format, including
+    # microseconds (see `stored_timestamp`), as they're used as keyset bounds.
+    # Archived chats are listed the same way, so the archive (if it has been
+    # created yet) is upgraded too.
+    schemas = ["main"]
+    archive_exists = connection.execute(
+        text(f"SELECT 1 FROM {ARCHIVE_SCHEMA}.sqlite_master WHERE name = 'chat'")
+    ).scalar()
+    if archive_exists:
+        schemas.append(ARCHIVE_SCHEMA)
+
+    for schema in schemas:
+        add_column_if_missing(
+            connection, "chat", "last_activity_at", "DATETIME", schema=schema
+        )
+        add_column_if_missing(
+            connection,
+            "chat",
+            "message_count",
+            "INTEGER NOT NULL DEFAULT 0",
+            schema=schema,
+        )
+        connection.execute(
+            text(
+                f"UPDATE {schema}.chat SET "
+                "last_activity_at = (SELECT strftime("
+                "'%Y-%m-%d %H:%M:%f', max(timestamp)) || '000' "
+                f"FROM {schema}.message AS message "
+                "WHERE message.chat_id = chat.id AND message.active), "
+                "message_count = (SELECT count(*) "
+                f"FROM {schema}.message AS message "
+                "WHERE message.chat_id = chat.id AND message.active)"
+            )
+        )
+        # The chat list is ordered by the latest activity, so it can be read
+        # in order from this index. It replaces the index on `archived` alone.
+        connection.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS "
+                f"{schema}.ix_chat_archived_last_activity_at "
+                "ON chat (archived, last_activity_at)"
+            )
+        )
+        connection.execute(text(f"DROP INDEX IF EXISTS {schema}.ix_chat_archived"))
+
+
+@migration(8, "Don't count system prompts in the message count of each chat")
+def _exclude_system_prompts_from_message_count(connection: Connection) -> None:
+    from elia_chat.database.database import ARCHIVE_SCHEMA
+
+    schemas = ["main"]
+    archive_exists = connection.execute(
+        text(f"SELECT 1 FROM {ARCHIVE_SCHEMA}.sqlite_master WHERE name = 'chat'")
+    ).scalar()
+    if archive_exists:
+        schemas.append(ARCHIVE_SCHEMA)
+
+    for schema in schemas:
+        connection.execute(
+            text(
+                f"UPDATE {schema}.chat SET message_count = (SELECT count(*) "
+                f"FROM {schema}.message AS message "
+                "WHERE message.chat_id = chat.id AND message.active "
+                "AND message.role != 'system')"
+            )
+        )
+
+
+@migration(9, "Restore the search index trigger if an interrupted import dropped it")
+def _restore_search_index_trigger(connection: Connection) -> None:
+    search_index = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'message_fts'")
+    ).scalar()
+    trigger = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'message_fts_after_insert'")
+    ).scalar()
+    if not search_index or trigger:
+        return
+
+    connection.execute(
+        text(
+            "CREATE TRIGGER message_fts_after_insert "
+            "AFTER INSERT ON message BEGIN "
+            "INSERT INTO message_fts (rowid, content) "
+            "VALUES (new.id, message_content(new.content, new.compressed_content)); "
+            "END"
+        )
+    )
+    # Messages inserted while the trigger was missing weren't indexed.
+    connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+
+
+@migration(10, "Index the messages whose tokens haven't been counted")
+def _add_uncounted_messages_index(connection: Connection) -> None:
+    # Token counts are backfilled at every startup (see `elia_chat.tokens`).
+    # Once every message has been counted, this index is empty, so finding
+    # that there's nothing to count doesn't scan the message table.
+    connection.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_message_uncounted ON message (id) "
+            "WHERE active AND json_type(meta, '$.tokens') IS NULL"
+        )
+    )
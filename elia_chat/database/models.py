@@ -1,24 +1,109 @@
 from datetime import datetime
-from typing import Any, Optional
+import hashlib
+from typing import Any, Iterable, Optional
 
-from sqlalchemy import Column, DateTime, func, JSON, desc
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Row,
+    func,
+    JSON,
+    delete,
+    desc,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncAttrs
-from sqlalchemy.orm import selectinload
-from sqlmodel import Field, Relationship, SQLModel, select
+from sqlalchemy.orm import aliased, selectinload
+from sqlmodel import Field, Relationship, SQLModel, col, select
+from sqlmodel.sql.expression import Select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from elia_chat.database.database import get_session
+from elia_chat.database.database import get_session, in_archive
+
+PREVIEW_LENGTH = 78
+"""The number of characters of the first user message loaded for chat summaries.
+One more than is displayed, so we know if the preview should be truncated."""
+
+
+SYSTEM_PROMPT_TITLE_LENGTH = 60
+"""The maximum length of the title generated for a stored system prompt."""
+
+
+def stored_timestamp(expression: Any) -> Any:
+    """Format a timestamp computed by SQLite the way SQLAlchemy stores datetimes.
+
+    SQLite's `CURRENT_TIMESTAMP` omits the fractional seconds which SQLAlchemy
+    writes, so the two formats don't compare correctly as strings. Timestamps
+    used as keyset bounds must round-trip through Python unchanged.
+    """
+    return func.strftime("%Y-%m-%d %H:%M:%f", expression).concat("000")
+
+
+def hash_system_prompt(prompt: str) -> str:
+    """Return the hash which identifies a system prompt in the `system_prompt` table."""
+    return hashlib.sha256(prompt.encode("utf-8", "surrogatepass")).hexdigest()
 
 
 class SystemPromptsDao(AsyncAttrs, SQLModel, table=True):
+    """A system prompt, stored once and referred to by each chat which uses it.
+
+    Prompts are identified by the hash of their content, so storing a prompt
+    which is already stored returns the existing row.
+    """
+
     __tablename__ = "system_prompt"
+    # Prompts are shared by chats in the main and archive databases, so queries
+    # made against the archive (see `in_archive`) still use this table.
+    __table_args__ = {"schema": "main"}
 
     id: int | None = Field(default=None, primary_key=True)
     title: str
     prompt: str
+    prompt_hash: str | None = None
+    """The `hash_system_prompt` of the prompt (unique)."""
     created_at: datetime | None = Field(
         sa_column=Column(DateTime(), server_default=func.now())
     )
 
+    @staticmethod
+    async def ids_for_prompts(
+        session: AsyncSession, prompts: Iterable[str]
+    ) -> dict[str, int]:
+        """Return the ID of each prompt, storing any which aren't stored yet.
+
+        Args:
+            session: The session to use. The caller must commit it.
+            prompts: The prompts (duplicates are allowed).
+        """
+        by_hash = {hash_system_prompt(prompt): prompt for prompt in prompts}
+        if not by_hash:
+            return {}
+        await session.execute(
+            sqlite_insert(SystemPromptsDao)
+            .values(
+                [
+                    {
+                        "title": prompt.strip().partition("\n")[0][
+                            :SYSTEM_PROMPT_TITLE_LENGTH
+                        ],
+                        "prompt": prompt,
+                        "prompt_hash": prompt_hash,
+                    }
+                    for prompt_hash, prompt in by_hash.items()
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["prompt_hash"])
+        )
+        results = await session.execute(
+            select(SystemPromptsDao.prompt_hash, SystemPromptsDao.id).where(
+                col(SystemPromptsDao.prompt_hash).in_(by_hash)
+            )
+        )
+        return {by_hash[prompt_hash]: prompt_id for prompt_hash, prompt_id in results}
+
 
 class MessageDao(AsyncAttrs, SQLModel, table=True):
     __tablename__ = "message"
@@ -46,6 +131,199 @@ class MessageDao(AsyncAttrs, SQLModel, table=True):
     """
     model: str | None
     """The model that wrote this response. (Could switch models mid-chat, possibly)"""
+    active: bool = Field(default=True, sa_column_kwargs={"server_default": "1"})
+    """Whether this message is on the branch of the conversation which is shown.
+
+    Messages on other branches (e.g. responses which were regenerated in ChatGPT
+    before the chat was imported) are kept, linked to the rest of the chat by
+    `parent_id`, but aren't loaded into the chat.
+    """
+    source_id: str | None = None
+    """If the message was imported, the ID it had in the source (e.g. ChatGPT)."""
+    compressed_content: bytes | None = None
+    """The content of the message, if it's stored compressed (in which case
+    `content` is empty). See `elia_chat.database.compression`."""
+    system_prompt_id: int | None = Field(
+        default=None, foreign_key="main.system_prompt.id"
+    )
+    """For system messages, the stored system prompt which is the content of the
+    message (in which case `content` is empty)."""
+    system_prompt: Optional[SystemPromptsDao] = Relationship()
+
+    @staticmethod
+    async def search(
+        match_query: str, snippet_start: str, snippet_end: str, limit: int = 50
+    ) -> list[Row[Any]]:
+        """Search the content of messages in non-archived chats, best matches first.
+
+        Args:
+            match_query: An FTS5 query string.
+            snippet_start: Inserted before each matching term in the snippet.
+            snippet_end: Inserted after each matching term in the snippet.
+            limit: The maximum number of results to return.
+        """
+        # The full-text index is searched and ranked first, so only the best
+        # matches are joined against the message and chat tables.
+        statement = text("""\
+SELECT message.id AS message_id, message.chat_id, message.role,
+       message.timestamp, chat.title AS chat_title, hit.snippet
+FROM (
+    SELECT rowid,
+           snippet(message_fts, 0, :snippet_start, :snippet_end, '…', 16) AS snippet,
+           rank
+    FROM message_fts
+    WHERE message_fts MATCH :match_query
+    ORDER BY rank
+    LIMIT :candidate_limit
+) AS hit
+JOIN message ON message.id = hit.rowid
+JOIN chat ON chat.id = message.chat_id
+WHERE chat.archived = 0 AND message.active AND message.role != 'system'
+ORDER BY hit.rank
+LIMIT :limit
+""").columns(timestamp=DateTime())
+        async with get_session() as session:
+            results = await session.execute(
+                statement,
+                {
+                    "match_query": match_query,
+                    "snippet_start": snippet_start,
+                    "snippet_end": snippet_end,
+                    # Leave room for hits in system prompts and archived chats.
+                    "candidate_limit": limit * 4,
+                    "limit": limit,
+                },
+            )
+            return list(results)
+
+    @staticmethod
+    async def without_token_counts(after_id: int, limit: int) -> list[Row[Any]]:
+        """Return up to `limit` active messages of non-archived chats which
+        haven't had their tokens counted (see `elia_chat.tokens`), in order of
+        ID, starting after `after_id`.
+
+        Each row has the message's `id`, `chat_id`, `role`, `content` (the
+        decompressed content, or the stored system prompt), `meta`, and the
+        `model` of the chat.
+
+        The messages are found with the partial index `ix_message_uncounted`,
+        which only holds the messages this matches, so this is quick once every
+        message has been counted. (`CROSS JOIN` makes SQLite read the messages
+        first, rather than every message of every non-archived chat.)
+        """
+        statement = text("""\
+SELECT message.id, message.chat_id, message.role, message.meta, chat.model,
+       coalesce(system_prompt.prompt,
+                message_content(message.content, message.compressed_content))
+           AS content
+FROM message
+CROSS JOIN chat ON chat.id = message.chat_id
+LEFT JOIN system_prompt ON system_prompt.id = message.system_prompt_id
+WHERE message.id > :after_id AND message.active AND chat.archived = 0
+  AND json_type(message.meta, '$.tokens') IS NULL
+ORDER BY message.id
+LIMIT :limit
+""").columns(meta=JSON())
+        async with get_session() as session:
+            results = await session.execute(
+                statement, {"after_id": after_id, "limit": limit}
+            )
+            return list(results)
+
+    @staticmethod
+    def active_messages_statement(
+        chat_id: int,
+        after: tuple[datetime, int] | None = None,
+        before: tuple[datetime, int] | None = None,
+    ) -> Select[Any]:
+        """Build a query for the active messages of a chat, optionally only those
+        between two `(timestamp, id)` keys (exclusive).
+
+        Messages are ordered by `(timestamp, id)`, which the
+        `(chat_id, timestamp)` index can return in order.
+        """
+        statement = (
+            select(MessageDao)
+            .where(
+                MessageDao.chat_id == chat_id,
+                MessageDao.active == True,  # noqa: E712
+            )
+            .options(selectinload(MessageDao.system_prompt))  # type: ignore
+        )
+        key = tuple_(MessageDao.timestamp, MessageDao.id)
+        if after is not None:
+            statement = statement.where(key > tuple_(*after))
+        if before is not None:
+            statement = statement.where(key < tuple_(*before))
+        return statement
+
+    @staticmethod
+    async def messages_page(
+        chat_id: int,
+        after: tuple[datetime, int] | None,
+        before: tuple[datetime, int] | None,
+        limit: int | None,
+    ) -> list["MessageDao"]:
+        """Return the latest `limit` (or all) active messages of a chat between
+        two `(timestamp, id)` keys, oldest first."""
+        statement = MessageDao.active_messages_statement(chat_id, after, before)
+        statement = statement.order_by(
+            desc(MessageDao.timestamp), desc(MessageDao.id)
+        ).limit(limit)
+        async with get_session() as session:
+            results = await session.exec(statement)
+            return list(reversed(results.all()))
+
+    @staticmethod
+    async def token_totals(
+        chat_id: int,
+        model_name: str,
+        after: tuple[datetime, int] | None,
+        before: tuple[datetime, int] | None,
+    ) -> tuple[int, int]:
+        """Add up the stored token counts (for the LiteLLM model `model_name`)
+        of the active messages of a chat between two `(timestamp, id)` keys
+        (exclusive), without loading the messages.
+
+        Returns:
+            The total of the counts, and the number of the messages which
+            haven't been counted for the model.
+        """
+        tokens = func.json_extract(MessageDao.meta, f'$.tokens."{model_name}"')
+        messages = MessageDao.active_messages_statement(chat_id, after, before)
+        statement = messages.with_only_columns(
+            func.coalesce(func.sum(tokens), 0), func.count() - func.count(tokens)
+        )
+        async with get_session() as session:
+            result = await session.execute(statement)
+            total, uncounted = result.one()
+            return total, uncounted
+
+    @staticmethod
+    async def count_recent_within_tokens(
+        chat_id: int,
+        model_name: str,
+        after: tuple[datetime, int] | None,
+        before: tuple[datetime, int] | None,
+        tokens: int,
+    ) -> int:
+        """Count how many of the most recent active messages of a chat between
+        two `(timestamp, id)` keys (exclusive) fit in `tokens`, according to
+        their stored token counts for the LiteLLM model `model_name`, without
+        loading the messages."""
+        running_tokens = (
+            func.sum(func.json_extract(MessageDao.meta, f'$.tokens."{model_name}"'))
+            .over(order_by=(desc(MessageDao.timestamp), desc(MessageDao.id)))
+            .label("running_tokens")
+        )
+        recent = (
+            MessageDao.active_messages_statement(chat_id, after, before)
+            .with_only_columns(running_tokens)
+            .subquery()
+        )
+        statement = select(func.count()).where(recent.c.running_tokens <= tokens)
+        async with get_session() as session:
+            return await session.scalar(statement) or 0
 
 
 class ChatDao(AsyncAttrs, SQLModel, table=True):
@@ -58,41 +336,297 @@ class ChatDao(AsyncAttrs, SQLModel, table=True):
         sa_column=Column(DateTime(), server_default=func.now())
     )
     messages: list[MessageDao] = Relationship(back_populates="chat")
+    active_messages: list[MessageDao] = Relationship(
+        sa_relationship_kwargs={
+            "primaryjoin": "and_(ChatDao.id == MessageDao.chat_id, MessageDao.active)",
+            "order_by": "MessageDao.id",
+            "viewonly": True,
+        }
+    )
+    """The messages on the branch of the chat which is shown, in order."""
     archived: bool = Field(default=False)
+    source_id: str | None = None
+    """If the chat was imported, the ID of the conversation it came from."""
+    source_hash: str | None = None
+    """If the chat was imported, a hash of the conversation's content, used to
+    detect whether it has changed when it's imported again."""
+    last_activity_at: datetime | None = Field(
+        default=None, sa_column=Column(DateTime())
+    )
+    """The timestamp of the latest message on the branch of the chat which is
+    shown. Chats without any messages have none, and aren't listed."""
+    message_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    """The number of messages on the branch of the chat which is shown, not
+    counting the system prompt (like `ChatData.message_count`).
+
+    This and `last_activity_at` are kept up to date as messages are added (see
+    `update_activity` and `refresh_activity`), so that the chat list doesn't
+    need to aggregate over the message table.
+    """
 
     @staticmethod
     async def all() -> list["ChatDao"]:
         async with get_session() as session:
-            # Create a subquery that finds the maximum
-            # (most recent) timestamp for each chat.
-            max_timestamp: Any = func.max(MessageDao.timestamp).label("max_timestamp")
-            subquery = (
-                select(MessageDao.chat_id, max_timestamp)
-                .group_by(MessageDao.chat_id)
-                .alias("subquery")
-            )
-
             statement = (
                 select(ChatDao)
-                .join(subquery, subquery.c.chat_id == ChatDao.id)
-                .where(ChatDao.archived == False)  # noqa: E712
-                .order_by(desc(subquery.c.max_timestamp))
-                .options(selectinload(ChatDao.messages))
+                .where(
+                    ChatDao.archived == False,  # noqa: E712
+                    col(ChatDao.last_activity_at).is_not(None),
+                )
+                .order_by(desc(ChatDao.last_activity_at), desc(ChatDao.id))
+                .options(
+                    selectinload(ChatDao.active_messages).selectinload(
+                        MessageDao.system_prompt
+                    )
+                )
             )
             results = await session.exec(statement)
             return list(results)
 
+    @staticmethod
+    async def summaries_page(
+        after: tuple[datetime, int] | None = None,
+        limit: int = 100,
+        archived: bool = False,
+    ) -> list[Row[Any]]:
+        """Return a page of lightweight summary rows for non-archived chats.
+
+        Only the columns required to render the chat list are selected: no
+        `MessageDao` objects are loaded. The most recent chats come first.
+
+        Args:
+            after: The `(last_message_at, id)` of the last chat on the previous
+                page. Only chats which come after it will be returned.
+            limit: The maximum number of chats to return.
+            archived: Return archived chats (from the archive database) instead.
+        """
+        statement = ChatDao.summaries_statement(after, limit, archived)
+        async with get_session() as session:
+            results = await session.exec(statement)
+            return list(results)
+
+    @staticmethod
+    def summaries_statement(
+        after: tuple[datetime, int] | None = None,
+        limit: int = 100,
+        archived: bool = False,
+    ) -> Select[Any]:
+        """Build the query made by `summaries_page`."""
+        # The chats are read in order from the (archived, last_activity_at)
+        # index, so only the chats on the page are visited.
+        preview = (
+            select(
+                func.substr(
+                    func.message_content(
+                        MessageDao.content, MessageDao.compressed_content
+                    ),
+                    1,
+                    PREVIEW_LENGTH,
+                )
+            )
+            .where(
+                MessageDao.chat_id == ChatDao.id,
+                MessageDao.active == True,  # noqa: E712
+                MessageDao.role == "user",
+            )
+            .order_by(MessageDao.timestamp, MessageDao.id)
+            .limit(1)
+            .correlate(ChatDao)
+            .scalar_subquery()
+        )
+        statement = (
+            select(
+                ChatDao.id,
+                ChatDao.title,
+                ChatDao.model,
+                ChatDao.started_at,
+                col(ChatDao.last_activity_at).label("last_message_at"),
+                ChatDao.message_count,
+                preview.label("preview"),
+            )
+            .where(
+                ChatDao.archived == archived,
+                col(ChatDao.last_activity_at).is_not(None),
+            )
+            .order_by(desc(ChatDao.last_activity_at), desc(ChatDao.id))
+            .limit(limit)
+        )
+        if after is not None:
+            statement = statement.where(
+                tuple_(ChatDao.last_activity_at, ChatDao.id) < tuple_(*after)
+            )
+        if archived:
+            statement = in_archive(statement)
+        return statement
+
+    @staticmethod
+    async def update_activity(
+        session: AsyncSession,
+        chat_id: int,
+        timestamps: list[datetime | None],
+        message_count: int,
+    ) -> None:
+        """Record that active messages with the given `timestamps` have just
+        been added to a chat, `message_count` of which aren't system messages."""
+        known = [timestamp for timestamp in timestamps if timestamp is not None]
+        latest: Any = (
+            max(known) if known else stored_timestamp(func.current_timestamp())
+        )
+        await session.execute(
+            update(ChatDao)
+            .where(col(ChatDao.id) == chat_id)
+            .values(
+                last_activity_at=func.max(
+                    func.coalesce(ChatDao.last_activity_at, latest), latest
+                ),
+                message_count=ChatDao.message_count + message_count,
+            )
+        )
+
+    @staticmethod
+    async def refresh_activity(session: AsyncSession, chat_ids: list[int]) -> None:
+        """Recalculate `last_activity_at` and `message_count` from the messages
+        of the given chats, e.g. after changing which of their messages are active."""
+        active_messages = select(MessageDao).where(
+            MessageDao.chat_id == ChatDao.id,
+            MessageDao.active == True,  # noqa: E712
+        )
+        await session.execute(
+            update(ChatDao)
+            .where(col(ChatDao.id).in_(chat_ids))
+            .values(
+                last_activity_at=active_messages.with_only_columns(
+                    stored_timestamp(func.max(MessageDao.timestamp))
+                ).scalar_subquery(),
+                message_count=active_messages.with_only_columns(func.count())
+                .where(MessageDao.role != "system")
+                .scalar_subquery(),
+            )
+        )
+
+    @staticmethod
+    async def count(archived: bool = False) -> int:
+        """Return the number of non-archived (or archived) chats."""
+        async with get_session() as session:
+            statement = select(func.count(ChatDao.id))
+            if archived:
+                statement = in_archive(statement)
+            else:
+                statement = statement.where(ChatDao.archived == False)  # noqa: E712
+            result = await session.exec(statement)
+            return result.one()
+
     @staticmethod
     async def from_id(chat_id: int) -> "ChatDao":
         async with get_session() as session:
             statement = (
                 select(ChatDao)
                 .where(ChatDao.id == int(chat_id))
-                .options(selectinload(ChatDao.messages))
+                .options(
+                    selectinload(ChatDao.active_messages).selectinload(
+                        MessageDao.system_prompt
+                    )
+                )
             )
             result = await session.exec(statement)
             return result.one()
 
+    @staticmethod
+    async def from_id_with_recent_messages(
+        chat_id: int, limit: int, include_message_id: int | None = None
+    ) -> tuple["ChatDao", list[MessageDao], int, str]:
+        """Load a chat with only its first message (the system prompt) and its
+        `limit` most recent messages, rather than every message.
+
+        Args:
+            chat_id: The ID of the chat.
+            limit: The number of recent messages to load.
+            include_message_id: Load enough messages to include this one, even
+                if it's older than the `limit` most recent messages.
+
+        Returns:
+            The chat, the messages loaded (oldest first), the number of messages
+            between the first message and those loaded, and a preview of the
+            first user message (which may not have been loaded).
+        """
+        async with get_session() as session:
+            chat = (
+                await session.exec(select(ChatDao).where(ChatDao.id == int(chat_id)))
+            ).one()
+            messages_statement = MessageDao.active_messages_statement(chat.id)
+            first_message = (
+                await session.exec(
+                    messages_statement.order_by(
+                        MessageDao.timestamp, MessageDao.id
+                    ).limit(1)
+                )
+            ).one_or_none()
+            if first_message is None:
+                return chat, [], 0, ""
+            first_key = (first_message.timestamp, first_message.id)
+
+            if include_message_id is not None:
+                included = await session.get(MessageDao, include_message_id)
+                if included is not None and included.chat_id == chat.id:
+                    newer_count = await session.scalar(
+                        select(func.count(MessageDao.id)).where(
+                            MessageDao.chat_id == chat.id,
+                            MessageDao.active == True,  # noqa: E712
+                            tuple_(MessageDao.timestamp, MessageDao.id)
+                            >= tuple_(included.timestamp, included.id),
+                        )
+                    )
+                    limit = max(limit, newer_count or 0)
+
+            recent_messages = list(
+                reversed(
+                    (
+                        await session.exec(
+                            MessageDao.active_messages_statement(
+                                chat.id, after=first_key
+                            )
+                            .order_by(desc(MessageDao.timestamp), desc(MessageDao.id))
+                            .limit(limit)
+                        )
+                    ).all()
+                )
+            )
+
+            older_count = 0
+            if recent_messages:
+                oldest_loaded = recent_messages[0]
+                older_count = await session.scalar(
+                    select(func.count(MessageDao.id)).where(
+                        MessageDao.chat_id == chat.id,
+                        MessageDao.active == True,  # noqa: E712
+                        tuple_(MessageDao.timestamp, MessageDao.id)
+                        > tuple_(*first_key),
+                        tuple_(MessageDao.timestamp, MessageDao.id)
+                        < tuple_(oldest_loaded.timestamp, oldest_loaded.id),
+                    )
+                )
+
+            preview = await session.scalar(
+                select(
+                    func.substr(
+                        func.message_content(
+                            MessageDao.content, MessageDao.compressed_content
+                        ),
+                        1,
+                        PREVIEW_LENGTH,
+                    )
+                )
+                .where(
+                    MessageDao.chat_id == chat.id,
+                    MessageDao.active == True,  # noqa: E712
+                    MessageDao.role == "user",
+                )
+                .order_by(MessageDao.timestamp, MessageDao.id)
+                .limit(1)
+            )
+            messages = [first_message, *recent_messages]
+            return chat, messages, older_count or 0, preview or ""
+
     @staticmethod
     async def rename_chat(chat_id: int, new_title: str) -> None:
         async with get_session() as session:
@@ -100,3 +634,50 @@ class ChatDao(AsyncAttrs, SQLModel, table=True):
             chat.title = new_title
             session.add(chat)
             await session.commit()
+
+    @staticmethod
+    async def delete_chats(chat_ids: list[int], archived: bool = False) -> None:
+        """Permanently delete chats and all of their messages."""
+        statements = [
+            delete(MessageDao).where(col(MessageDao.chat_id).in_(chat_ids)),
+            delete(ChatDao).where(col(ChatDao.id).in_(chat_ids)),
+        ]
+        async with get_session() as session:
+            for statement in statements:
+                await session.execute(in_archive(statement) if archived else statement)
+            await session.commit()
+
+
+class ImportCheckpointDao(AsyncAttrs, SQLModel, table=True):
+    """How far through a file an import has progressed, so it can be resumed."""
+
+    __tablename__ = "import_checkpoint"
+
+    path: str = Field(primary_key=True)
+    """The absolute path of the file being imported."""
+    size: int
+    modified_ns: int
+    """The size and modification time of the file, to check it hasn't changed."""
+    offset: int
+    """The offset in the file up to which everything has been imported."""
+    updated_at: datetime | None = Field(
+        sa_column=Column(DateTime(), server_default=func.now())
+    )
+
+
+class CompressionDictionaryDao(AsyncAttrs, SQLModel, table=True):
+    """A dictionary used to compress message content.
+
+    Dictionaries are never modified or deleted, since messages compressed with
+    them can only be decompressed with them.
+    """
+
+    __tablename__ = "compression_dictionary"
+
+    id: int | None = Field(default=None, primary_key=True)
+    data: bytes
+    sample_count: int
+    """The number of messages the dictionary was trained on."""
+    created_at: datetime | None = Field(
+        sa_column=Column(DateTime(), server_default=func.now())
+    )
@@ -0,0 +1,35 @@
+"""Importing LiteLLM, which takes a while, without blocking the UI.
+
+LiteLLM is imported in a thread the first time it's needed. Importing it in
+several threads at once isn't safe (a thread can find it partially
+initialized, and fail), so it's only ever imported through `import_litellm`,
+and code which uses LiteLLM in other threads must await that first.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import importlib
+import threading
+from types import ModuleType
+
+_litellm: ModuleType | None = None
+"""The LiteLLM module, once it has been imported."""
+
+_import_lock = threading.Lock()
+
+
+def _import_litellm() -> ModuleType:
+    global _litellm
+    with _import_lock:
+        if _litellm is None:
+            _litellm = importlib.import_module("litellm")
+        return _litellm
+
+
+async def import_litellm() -> ModuleType:
+    """Import LiteLLM in a thread (only once, however many tasks are waiting
+    for it), and return the module."""
+    if _litellm is not None:
+        return _litellm
+    return await asyncio.to_thread(_import_litellm)
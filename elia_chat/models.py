@@ -1,8 +1,8 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import UTC, datetime
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Iterable
 
 
 from elia_chat.config import LaunchConfig, EliaChatModel
@@ -17,6 +17,45 @@ class UnknownModel(EliaChatModel):
     pass
 
 
+class ModelRegistry:
+    """The models available in a `LaunchConfig`, indexed for fast lookup.
+
+    Built once per config (see `LaunchConfig.model_registry`), since a model is
+    looked up for every chat loaded from the database. Lookups always return
+    the same `EliaChatModel` instance for a model, including for unknown models.
+    """
+
+    def __init__(self, models: Iterable[EliaChatModel]) -> None:
+        self.models = list(models)
+        self.by_id: dict[str, EliaChatModel] = {}
+        self.by_name: dict[str, EliaChatModel] = {}
+        self.by_alias: dict[str, EliaChatModel] = {}
+        """Other names a model can be referred to by: its display name, and
+        `provider/name` (as LiteLLM names models)."""
+        self.by_provider: dict[str, list[EliaChatModel]] = {}
+        # Where models share an ID or name, the last one wins.
+        for model in self.models:
+            if model.id is not None:
+                self.by_id[model.id] = model
+            self.by_name[model.name] = model
+            if model.display_name:
+                self.by_alias.setdefault(model.display_name, model)
+            if model.provider:
+                self.by_alias.setdefault(f"{model.provider}/{model.name}", model)
+                self.by_provider.setdefault(model.provider, []).append(model)
+        self.unknown_model = UnknownModel(id="unknown", name="unknown model")
+
+    def get(self, model_id_or_name: str) -> EliaChatModel:
+        """Return the model with the given ID, name or alias (in that order of
+        precedence), or `unknown_model` if there isn't one."""
+        return (
+            self.by_id.get(model_id_or_name)
+            or self.by_name.get(model_id_or_name)
+            or self.by_alias.get(model_id_or_name)
+            or self.unknown_model
+        )
+
+
 def get_model(
     model_id_or_name: str, config: LaunchConfig | None = None
 ) -> EliaChatModel:
@@ -26,14 +65,7 @@ def get_model(
     """
     if config is None:
         config = active_app.get().launch_config
-    try:
-        return {model.id: model for model in config.all_models}[model_id_or_name]
-    except KeyError:
-        try:
-            return {model.name: model for model in config.all_models}[model_id_or_name]
-        except KeyError:
-            pass
-    return UnknownModel(id="unknown", name="unknown model")
+    return config.model_registry.get(model_id_or_name)
 
 
 @dataclass
@@ -41,6 +73,20 @@ class ChatMessage:
     message: ChatCompletionMessageParam
     timestamp: datetime | None
     model: EliaChatModel
+    id: int | None = None
+    """The ID of the message in the database, if it has been saved."""
+    partial: bool = False
+    """True if this is a response which is still streaming in, or which
+    was interrupted before it completed."""
+    token_counts: dict[str, int] = field(default_factory=dict)
+    """The number of tokens in the message, for each LiteLLM model name it has
+    been counted for. See `elia_chat.tokens`."""
+
+    @property
+    def is_empty_response(self) -> bool:
+        """True if this is a response which was interrupted before any of it
+        arrived (which older versions of Elia saved)."""
+        return self.partial and not self.message.get("content")
 
 
 @dataclass
@@ -50,9 +96,19 @@ class ChatData:
     title: str | None
     create_timestamp: datetime | None
     messages: list[ChatMessage]
+    older_message_count: int = 0
+    """The number of messages between the first message (the system prompt)
+    and the rest of `messages`, which haven't been loaded. Long chats are
+    opened with only their most recent messages loaded."""
+    first_user_message_preview: str | None = None
+    """The start of the first user message, if it may not have been loaded."""
 
     @property
     def short_preview(self) -> str:
+        if self.first_user_message_preview is not None:
+            preview = self.first_user_message_preview
+            return preview[:77] + "..." if len(preview) > 77 else preview
+
         first_message = self.first_user_message.message
 
         if "content" in first_message:
@@ -82,7 +138,64 @@ class ChatData:
     ) -> list[ChatMessage]:
         return self.messages[1:]
 
+    @property
+    def message_count(self) -> int:
+        """The number of messages in the chat, excluding the system prompt,
+        whether or not they've been loaded."""
+        return len(self.messages) - 1 + self.older_message_count
+
     @property
     def update_time(self) -> datetime:
         message_timestamp = self.messages[-1].timestamp
         return message_timestamp.astimezone().replace(tzinfo=UTC)
+
+
+@dataclass
+class ChatSummary:
+    """A lightweight view of a chat used to render the chat history.
+
+    Unlike `ChatData`, this doesn't hold any messages, so many of them can be
+    loaded cheaply. The full `ChatData` is only loaded when a chat is opened.
+    """
+
+    id: int
+    model: EliaChatModel
+    title: str | None
+    create_timestamp: datetime | None
+    last_message_timestamp: datetime | None
+    message_count: int
+    first_user_message_preview: str
+    """The start of the first user message in the chat. May be truncated, so
+    use `short_preview` for display purposes."""
+
+    @property
+    def short_preview(self) -> str:
+        preview = self.first_user_message_preview
+        if len(preview) > 77:
+            return preview[:77] + "..."
+        return preview
+
+    @property
+    def update_time(self) -> datetime:
+        timestamp = self.last_message_timestamp or self.create_timestamp
+        if timestamp is None:
+            return datetime.now(UTC)
+        return timestamp.astimezone().replace(tzinfo=UTC)
+
+
+SEARCH_MATCH_START = "\x02"
+SEARCH_MATCH_END = "\x03"
+
+
+@dataclass
+class MessageSearchResult:
+    """A message which matched a full-text search."""
+
+    chat_id: int
+    message_id: int
+    chat_title: str | None
+    role: str
+    timestamp: datetime | None
+    snippet: str
+    """An excerpt of the message around the matching terms. The matching terms
+    are surrounded by `SEARCH_MATCH_START` and `SEARCH_MATCH_END`."""
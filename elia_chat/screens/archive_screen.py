@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+from textual import on
+from textual.app import ComposeResult
+from textual.binding import Binding
+from textual.containers import Vertical
+from textual.screen import ModalScreen
+from textual.widgets import Footer
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.models import ChatSummary
+from elia_chat.widgets.chat_list import ChatList
+
+
+class ArchivedChatList(ChatList):
+    """The archived chats, which are paged in from the archive database."""
+
+    BINDINGS = [
+        Binding("escape,A", "app.pop_screen", "Close", key_display="esc"),
+        Binding(
+            "a",
+            "unarchive_chat",
+            "Unarchive chat",
+            key_display="a",
+            tooltip="Move the selected chats, or the highlighted chat,"
+            " back into the chat history.",
+        ),
+    ]
+
+    async def load_chats(
+        self, after: ChatSummary | None, limit: int
+    ) -> list[ChatSummary]:
+        return await ChatsManager.archived_chat_summaries_page(after=after, limit=limit)
+
+    async def count_chats(self) -> int:
+        return await ChatsManager.count_archived_chats()
+
+    def get_border_title(self) -> str:
+        return f"Archived ({self.total_chat_count})"
+
+    async def delete_chats_from_database(self, chat_ids: list[int]) -> None:
+        await ChatsManager.delete_chats(chat_ids, archived=True)
+
+    async def action_unarchive_chat(self) -> None:
+        items = self.get_target_items()
+        if not items:
+            return
+
+        chat_ids = {item.chat.id for item in items}
+        await ChatsManager.unarchive_chats(list(chat_ids))
+        self.remove_chats(chat_ids)
+        self.notify_chats_changed(items, "unarchived")
+
+
+class ArchiveScreen(ModalScreen[int]):
+    """Browse archived chats. Selecting a chat unarchives it, and returns its ID
+    so that it can be opened."""
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="archive-container"):
+            yield ArchivedChatList()
+        yield Footer()
+
+    @on(ChatList.ChatOpened)
+    async def unarchive_and_open(self, event: ChatList.ChatOpened) -> None:
+        event.stop()
+        chat_id = await ChatsManager.unarchive_chat(event.chat.id)
+        self.dismiss(chat_id)
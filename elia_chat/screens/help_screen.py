@@ -54,11 +54,23 @@ but if you just wish to scroll a little, you can use `shift+up` and `shift+down`
 ### The chat list
 
 - `up,down,k,j`: Navigate through chats.
-- `a`: Archive the highlighted chat.
+- `a`: Archive the highlighted chat (or the selected chats).
+- `d,delete`: Permanently delete the highlighted chat (or the selected chats). Press again to confirm.
+- `space`: Select or deselect the highlighted chat.
+- `shift+up,shift+down,K,J`: Select a range of chats.
+- `esc`: Clear the selection.
+- `A`: Browse archived chats. Select a chat to unarchive and open it, or press `a` to unarchive it.
 - `pageup,pagedown`: Up/down a page.
 - `home,end`: Go to first/last chat.
 - `g,G`: Go to first/last chat.
 - `enter,l`: Open chat.
+- `/`: Search the messages of all chats.
+
+### Searching
+
+Press `ctrl+s` on the home screen (or `/` with the chat list focused) to search
+the content of every message. Results are ranked by relevance, and selecting
+one opens the chat with the matching message focused.
 
 ### The options window
 
@@ -142,6 +154,8 @@ _With a message focused_:
     - The amount of details available may vary depending on the model
         or provider being used.
 - `g`: Focus the first message.
+    - Long chats open with only their most recent messages loaded. Pressing `g`
+        (or scrolling to the top) loads earlier messages, a page at a time.
 - `G`: Focus the latest message.
 - `m`: Move focus to the prompt box.
 - `up,down,k,j`: Navigate through messages.
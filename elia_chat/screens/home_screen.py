@@ -7,12 +7,16 @@ from textual.screen import Screen
 from textual.signal import Signal
 from textual.widgets import Footer
 
+from elia_chat.models import MessageSearchResult
 from elia_chat.runtime_config import RuntimeConfig
 from elia_chat.widgets.chat_list import ChatList
 from elia_chat.widgets.prompt_input import PromptInput
 from elia_chat.chats_manager import ChatsManager
 from elia_chat.widgets.app_header import AppHeader
+from elia_chat.screens.archive_screen import ArchiveScreen
 from elia_chat.screens.chat_screen import ChatScreen
+from elia_chat.screens.search_screen import SearchScreen
+from elia_chat.widgets.chat import Chat
 from elia_chat.widgets.chat_options import OptionsModal
 from elia_chat.widgets.welcome import Welcome
 
@@ -23,6 +27,15 @@ if TYPE_CHECKING:
 class HomePromptInput(PromptInput):
     BINDINGS = [Binding("escape", "app.quit", "Quit", key_display="esc")]
 
+    def on_mount(self) -> None:
+        elia = cast("Elia", self.app)
+        self.token_model = elia.runtime_config.selected_model.name
+
+        def on_config_change(config: RuntimeConfig) -> None:
+            self.token_model = config.selected_model.name
+
+        elia.runtime_config_signal.subscribe(self, on_config_change)
+
 
 class HomeScreen(Screen[None]):
     CSS = """\
@@ -51,6 +64,13 @@ ChatList {
             tooltip="Change the model, system prompt, and check where Elia"
             " is storing your data.",
         ),
+        Binding(
+            "ctrl+s",
+            "search",
+            "Search",
+            key_display="^s",
+            tooltip="Search the messages of all chats.",
+        ),
     ]
 
     def __init__(
@@ -84,9 +104,35 @@ ChatList {
     async def open_chat_screen(self, event: ChatList.ChatOpened):
         chat_id = event.chat.id
         assert chat_id is not None
-        chat = await self.chats_manager.get_chat(chat_id)
+        chat = await self.chats_manager.get_chat(
+            chat_id, message_limit=Chat.MESSAGE_PAGE_SIZE
+        )
         await self.app.push_screen(ChatScreen(chat))
 
+    async def action_search(self) -> None:
+        await self.app.push_screen(SearchScreen(), callback=self.open_search_result)
+
+    async def action_archived_chats(self) -> None:
+        await self.app.push_screen(ArchiveScreen(), callback=self.open_unarchived_chat)
+
+    async def open_unarchived_chat(self, chat_id: int | None) -> None:
+        if chat_id is None:
+            return
+        chat = await self.chats_manager.get_chat(
+            chat_id, message_limit=Chat.MESSAGE_PAGE_SIZE
+        )
+        await self.app.push_screen(ChatScreen(chat))
+
+    async def open_search_result(self, result: MessageSearchResult | None) -> None:
+        if result is None:
+            return
+        chat = await self.chats_manager.get_chat(
+            result.chat_id,
+            message_limit=Chat.MESSAGE_PAGE_SIZE,
+            include_message_id=result.message_id,
+        )
+        await self.app.push_screen(ChatScreen(chat, focus_message_id=result.message_id))
+
     @on(ChatList.CursorEscapingTop)
     def cursor_escaping_top(self):
         self.query_one(HomePromptInput).focus()
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import datetime
+
+import humanize
+from rich.console import Console, ConsoleOptions, RenderResult
+from rich.padding import Padding
+from rich.text import Text
+from sqlalchemy.exc import OperationalError
+from textual import on, work
+from textual.app import ComposeResult
+from textual.binding import Binding
+from textual.containers import Vertical
+from textual.screen import ModalScreen
+from textual.timer import Timer
+from textual.widgets import Footer, Input, OptionList
+from textual.widgets.option_list import Option
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.models import SEARCH_MATCH_END, SEARCH_MATCH_START, MessageSearchResult
+
+
+@dataclass
+class SearchResultRenderable:
+    result: MessageSearchResult
+
+    def __rich_console__(
+        self, console: Console, options: ConsoleOptions
+    ) -> RenderResult:
+        result = self.result
+        title = Text(result.chat_title or f"Chat {result.chat_id}", style="b")
+        author = "You" if result.role == "user" else "Agent"
+        details = f"{author}"
+        if result.timestamp:
+            timestamp = result.timestamp.replace(tzinfo=datetime.timezone.utc)
+            details += f" · {humanize.naturaltime(timestamp)}"
+        yield Padding(
+            Text.assemble(
+                title,
+                " ",
+                Text(details, style="dim i"),
+                "\n",
+                self.snippet_text(),
+            ),
+            pad=(0, 0, 0, 1),
+        )
+
+    def snippet_text(self) -> Text:
+        """Convert the snippet to Text, highlighting the matching terms."""
+        parts = self.result.snippet.replace("\n", " ").split(SEARCH_MATCH_START)
+        snippet = Text(parts[0], style="dim")
+        for part in parts[1:]:
+            matched, _, rest = part.partition(SEARCH_MATCH_END)
+            snippet.append(matched, style="not dim b u")
+            snippet.append(rest)
+        return snippet
+
+
+class SearchResultItem(Option):
+    def __init__(self, result: MessageSearchResult) -> None:
+        super().__init__(SearchResultRenderable(result))
+        self.result = result
+
+
+class SearchScreen(ModalScreen[MessageSearchResult]):
+    """Search the content of all messages, returning the selected result."""
+
+    BINDINGS = [
+        Binding("escape", "app.pop_screen", "Close search", key_display="esc"),
+        Binding("down", "focus_results", "Results", show=False),
+    ]
+
+    SEARCH_DELAY = 0.15
+    """Seconds to wait after the user stops typing before searching."""
+
+    def __init__(
+        self,
+        name: str | None = None,
+        id: str | None = None,
+        classes: str | None = None,
+    ) -> None:
+        super().__init__(name, id, classes)
+        self._search_timer: Timer | None = None
+
+    def compose(self) -> ComposeResult:
+        with Vertical(id="search-container") as container:
+            container.border_title = "Search messages"
+            yield Input(placeholder="Search all chats...", id="search-input")
+            yield OptionList(id="search-results")
+        yield Footer()
+
+    @on(Input.Changed)
+    def schedule_search(self, event: Input.Changed) -> None:
+        if self._search_timer is not None:
+            self._search_timer.stop()
+        self._search_timer = self.set_timer(
+            self.SEARCH_DELAY, lambda: self.search(event.value)
+        )
+
+    @work(exclusive=True, group="search")
+    async def search(self, search_text: str) -> None:
+        results_list = self.query_one("#search-results", OptionList)
+        try:
+            results = await ChatsManager.search(search_text)
+        except OperationalError as error:
+            results_list.clear_options()
+            results_list.border_subtitle = "Search is unavailable"
+            self.log.error(f"Search failed: {error}")
+            return
+
+        results_list.clear_options()
+        results_list.add_options(SearchResultItem(result) for result in results)
+        if search_text.strip():
+            results_list.border_subtitle = f"{len(results)} results"
+        else:
+            results_list.border_subtitle = None
+
+    @on(Input.Submitted)
+    def action_focus_results(self) -> None:
+        results_list = self.query_one("#search-results", OptionList)
+        if results_list.option_count:
+            results_list.focus()
+            if results_list.highlighted is None:
+                results_list.highlighted = 0
+
+    @on(OptionList.OptionSelected)
+    def open_result(self, event: OptionList.OptionSelected) -> None:
+        assert isinstance(event.option, SearchResultItem)
+        self.dismiss(event.option.result)
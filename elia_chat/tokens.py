@@ -0,0 +1,190 @@
+"""Counting the tokens in messages, and trimming conversations to fit a model.
+
+Re-tokenizing a whole conversation before every request (as LiteLLM's
+`trim_messages` does) takes a noticeable time in long chats. Instead, each
+message is counted once, and its count is stored with it in the database (see
+`ChatMessage.token_counts`). Counts are keyed by the LiteLLM model name, since
+LiteLLM chooses which tokenizer to use for each model.
+
+Messages which were saved before their tokens were counted (e.g. imported
+chats) are counted in the background by `backfill_token_counts`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from textual import log
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.litellm_import import import_litellm
+from elia_chat.models import ChatMessage
+
+if TYPE_CHECKING:
+    from litellm.types.completion import ChatCompletionMessageParam
+
+REPLY_PRIMING_TOKENS = 3
+"""The tokens LiteLLM adds to the count of every list of messages, for the
+start of the reply. A conversation is counted as the sum of the counts of its
+messages plus this."""
+
+TRIM_RATIO = 0.75
+"""Conversations are trimmed to this fraction of the model's context window,
+leaving the rest for the response (the same default as LiteLLM)."""
+
+MIN_SHORTENED_MESSAGE_TOKENS = 3
+"""Rather than shortening a message to fit in fewer tokens than this, leave
+it out."""
+
+BACKFILL_BATCH_SIZE = 500
+"""The number of messages `backfill_token_counts` counts and saves at a time."""
+
+BACKFILL_WORKERS = 4
+"""The number of threads `backfill_token_counts` counts messages in. The
+tokenizers release the GIL, so this doesn't hold up the UI."""
+
+
+def count_message_tokens(message: ChatCompletionMessageParam, model_name: str) -> int:
+    """Count the tokens in a message, as LiteLLM does for `model_name`."""
+    from litellm import token_counter
+
+    return token_counter(model=model_name, messages=[message]) - REPLY_PRIMING_TOKENS
+
+
+def count_missing_tokens(
+    messages: list[ChatMessage], model_name: str
+) -> list[ChatMessage]:
+    """Count the tokens of the messages which haven't been counted for
+    `model_name`, and return them."""
+    counted: list[ChatMessage] = []
+    for message in messages:
+        if model_name not in message.token_counts:
+            tokens = count_message_tokens(message.message, model_name)
+            message.token_counts[model_name] = tokens
+            counted.append(message)
+    return counted
+
+
+def total_tokens(messages: list[ChatMessage], model_name: str) -> int:
+    """The number of tokens in a conversation. Every message must have been
+    counted for `model_name`."""
+    counts = (message.token_counts[model_name] for message in messages)
+    return sum(counts) + REPLY_PRIMING_TOKENS
+
+
+def context_budget(model_name: str) -> int | None:
+    """The number of tokens conversations are trimmed to for a model, or None
+    if LiteLLM doesn't know the size of its context window."""
+    import litellm
+
+    model_info = litellm.model_cost.get(model_name)
+    if model_info is None:
+        return None
+    max_tokens = model_info.get("max_input_tokens") or model_info.get("max_tokens")
+    if not max_tokens:
+        return None
+    return int(max_tokens * TRIM_RATIO)
+
+
+def trim_messages(
+    messages: list[ChatMessage], model_name: str
+) -> list[ChatCompletionMessageParam]:
+    """Return the messages of a conversation which fit in the model's
+    `context_budget`, using the messages' token counts.
+
+    The system prompt is always kept, along with as many of the most recent
+    messages as fit. The oldest of those is shortened (by removing text from
+    its middle) if only part of it fits. Every message must have been counted
+    for `model_name`.
+    """
+    raw_messages = [message.message for message in messages]
+    budget = context_budget(model_name)
+    if budget is None or total_tokens(messages, model_name) < budget:
+        return raw_messages
+
+    from litellm.utils import shorten_message_to_fit_limit
+
+    system_messages = [
+        message for message in messages if message.message["role"] == "system"
+    ]
+    available = (
+        budget - REPLY_PRIMING_TOKENS - total_tokens(system_messages, model_name)
+    )
+    if available <= 0:
+        # The system prompt doesn't fit on its own.
+        system_message = copy.deepcopy(system_messages[0].message)
+        return [shorten_message_to_fit_limit(system_message, budget, model_name)]
+
+    kept: list[ChatCompletionMessageParam] = []
+    for message in reversed(messages):
+        if message.message["role"] == "system":
+            continue
+        tokens = message.token_counts[model_name]
+        if tokens <= available:
+            kept.append(message.message)
+            available -= tokens
+            continue
+        content = message.message.get("content")
+        if available >= MIN_SHORTENED_MESSAGE_TOKENS and isinstance(content, str):
+            shortened = shorten_message_to_fit_limit(
+                copy.deepcopy(message.message),
+                available + REPLY_PRIMING_TOKENS,
+                model_name,
+            )
+            if count_message_tokens(shortened, model_name) <= available:
+                kept.append(shortened)
+        # Older messages would leave a gap in the conversation.
+        break
+
+    return [message.message for message in system_messages] + kept[::-1]
+
+
+async def backfill_token_counts(workers: int = BACKFILL_WORKERS) -> int:
+    """Count the tokens of every message in non-archived chats which hasn't
+    been counted, for the model of its chat, in a pool of threads.
+
+    Returns:
+        The number of messages counted.
+    """
+    batch = await ChatsManager.messages_without_token_counts(limit=BACKFILL_BATCH_SIZE)
+    if not batch:
+        return 0
+
+    # LiteLLM must be imported before it's used in several threads at once.
+    await import_litellm()
+    counted = 0
+    executor = ThreadPoolExecutor(workers, thread_name_prefix="token-backfill")
+    try:
+        while batch:
+            await _count_batch(batch, executor)
+            counted += len(batch)
+            batch = await ChatsManager.messages_without_token_counts(
+                after_id=batch[-1][0], limit=BACKFILL_BATCH_SIZE
+            )
+    finally:
+        executor.shutdown(cancel_futures=True)
+    log.debug(f"Counted the tokens of {counted} messages")
+    return counted
+
+
+async def _count_batch(
+    batch: list[tuple[int, int, str, ChatCompletionMessageParam]],
+    executor: Executor,
+) -> None:
+    loop = asyncio.get_running_loop()
+    counts = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, count_message_tokens, message, model_name)
+            for _, _, model_name, message in batch
+        ]
+    )
+    await ChatsManager.save_token_counts(
+        {
+            message_id: {model_name: tokens}
+            for (message_id, _, model_name, _), tokens in zip(batch, counts)
+        },
+        chat_ids=[chat_id for _, chat_id, _, _ in batch],
+    )
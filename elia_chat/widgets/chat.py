@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
+import time
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING, Callable, ClassVar, cast
 
 from textual.widgets import Label
 
@@ -10,7 +12,7 @@ from elia_chat import constants
 from textual import log, on, work, events
 from textual.app import ComposeResult
 from textual.binding import Binding
-from textual.containers import Horizontal, VerticalScroll
+from textual.containers import Horizontal
 from textual.css.query import NoMatches
 from textual.message import Message
 from textual.reactive import reactive
@@ -18,12 +20,20 @@ from textual.widget import Widget
 from textual.widgets import Label
 
 from elia_chat.chats_manager import ChatsManager
+from elia_chat.litellm_import import import_litellm
 from elia_chat.models import ChatData, ChatMessage
+from elia_chat.tokens import (
+    context_budget,
+    count_missing_tokens,
+    total_tokens,
+    trim_messages,
+)
 from elia_chat.screens.chat_details import ChatDetails
 from elia_chat.widgets.agent_is_typing import ResponseStatus
 from elia_chat.widgets.chat_header import ChatHeader, TitleStatic
 from elia_chat.widgets.prompt_input import PromptInput
 from elia_chat.widgets.chatbox import Chatbox
+from elia_chat.widgets.chat_transcript import ChatTranscript
 
 
 if TYPE_CHECKING:
@@ -38,6 +48,50 @@ class ChatPromptInput(PromptInput):
     BINDINGS = [Binding("escape", "app.pop_screen", "Close chat", key_display="esc")]
 
 
+class ChunkCoalescer:
+    """Buffers the chunks of a streaming response, and passes them on together
+    at most `frame_rate` times per second.
+
+    Fast models can send hundreds of chunks per second, and updating the UI
+    for each of them would leave it unable to keep up.
+    """
+
+    def __init__(self, flush: Callable[[str], None], frame_rate: float) -> None:
+        """
+        Args:
+            flush: Called with the text which has been buffered.
+            frame_rate: The maximum number of flushes per second. If this isn't
+                positive, every chunk is passed on immediately.
+        """
+        self._flush = flush
+        self._interval = 1 / frame_rate if frame_rate > 0 else 0
+        self._chunks: list[str] = []
+        self._last_flush_time = float("-inf")
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    def add(self, chunk: str) -> None:
+        """Buffer a chunk. It's flushed straight away if a frame has passed
+        since the last flush, or otherwise once one has."""
+        self._chunks.append(chunk)
+        wait = self._last_flush_time + self._interval - time.monotonic()
+        if wait <= 0:
+            self.flush()
+        elif self._flush_handle is None:
+            # Don't hold on to the chunks if no more arrive for a while.
+            self._flush_handle = asyncio.get_running_loop().call_later(wait, self.flush)
+
+    def flush(self) -> None:
+        """Pass on any buffered chunks now."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._chunks:
+            text = "".join(self._chunks)
+            self._chunks.clear()
+            self._last_flush_time = time.monotonic()
+            self._flush(text)
+
+
 class Chat(Widget):
     BINDINGS = [
         Binding("ctrl+r", "rename", "Rename", key_display="^r"),
@@ -62,11 +116,28 @@ class Chat(Widget):
     allow_input_submit = reactive(True)
     """Used to lock the chat input while the agent is responding."""
 
-    def __init__(self, chat_data: ChatData) -> None:
+    SAVE_PARTIAL_RESPONSE_INTERVAL: ClassVar[float] = 0.5
+    """While a response is streaming, save it to the database at most this
+    often (in seconds), so it isn't lost if Elia exits unexpectedly."""
+
+    SAVE_PARTIAL_RESPONSE_CHARS: ClassVar[int] = 4096
+    """Save a streaming response before the interval has elapsed if this
+    many characters have arrived since it was last saved."""
+
+    MESSAGE_PAGE_SIZE: ClassVar[int] = 50
+    """The number of messages loaded when a chat is opened, and each time the
+    user scrolls to the top of the messages which have been loaded."""
+
+    def __init__(
+        self, chat_data: ChatData, focus_message_id: int | None = None
+    ) -> None:
         super().__init__()
         self.chat_data = chat_data
+        self.focus_message_id = focus_message_id
+        """The ID of a message to focus once the chat has loaded."""
         self.elia = cast("Elia", self.app)
         self.model = chat_data.model
+        self._loading_older_messages = False
 
     @dataclass
     class AgentResponseStarted(Message):
@@ -76,7 +147,6 @@ class Chat(Widget):
     class AgentResponseComplete(Message):
         chat_id: int | None
         message: ChatMessage
-        chatbox: Chatbox
 
     @dataclass
     class AgentResponseFailed(Message):
@@ -94,8 +164,9 @@ class Chat(Widget):
             yield ChatHeader(chat=self.chat_data, model=self.model)
             yield ResponseStatus()
 
-        with VerticalScroll(id="chat-container") as vertical_scroll:
-            vertical_scroll.can_focus = False
+        transcript = ChatTranscript(id="chat-container")
+        transcript.can_focus = False
+        yield transcript
 
         yield ChatPromptInput(id="prompt")
 
@@ -104,10 +175,16 @@ class Chat(Widget):
         When the component is mounted, we need to check if there is a new chat to start
         """
         await self.load_chat(self.chat_data)
+        self.watch(
+            self.chat_container,
+            "scroll_y",
+            self._load_older_messages_at_top,
+            init=False,
+        )
 
     @property
-    def chat_container(self) -> VerticalScroll:
-        return self.query_one("#chat-container", VerticalScroll)
+    def chat_container(self) -> ChatTranscript:
+        return self.query_one("#chat-container", ChatTranscript)
 
     @property
     def is_empty(self) -> bool:
@@ -121,9 +198,11 @@ class Chat(Widget):
 
     @on(AgentResponseFailed)
     def restore_state_on_agent_failure(self, event: Chat.AgentResponseFailed) -> None:
+        prompt = self.query_one(ChatPromptInput)
         original_prompt = event.last_message.message.get("content", "")
         if isinstance(original_prompt, str):
-            self.query_one(ChatPromptInput).text = original_prompt
+            prompt.text = original_prompt
+        prompt.submit_ready = True
 
     async def new_user_message(self, content: str) -> None:
         log.debug(f"User message submitted in chat {self.chat_data.id!r}: {content!r}")
@@ -136,13 +215,12 @@ class Chat(Widget):
 
         user_chat_message = ChatMessage(user_message, now_utc, self.chat_data.model)
         self.chat_data.messages.append(user_chat_message)
-        user_message_chatbox = Chatbox(user_chat_message, self.chat_data.model)
 
         assert (
             self.chat_container is not None
         ), "Textual has mounted container at this point in the lifecycle."
 
-        await self.chat_container.mount(user_message_chatbox)
+        self.chat_container.add_message(user_chat_message)
 
         self.scroll_to_latest_message()
         self.post_message(self.NewUserMessage(content))
@@ -155,19 +233,107 @@ class Chat(Widget):
         prompt.submit_ready = False
         self.stream_agent_response()
 
-    @work(thread=True, group="agent_response")
+    async def _count_tokens(self, chat_messages: list[ChatMessage]) -> None:
+        """Count the tokens of any of the messages which haven't been counted
+        for the chat's model, and save the counts."""
+        # Most messages were counted before, so only new ones are tokenized.
+        counted = await asyncio.to_thread(
+            count_missing_tokens, chat_messages, self.chat_data.model.name
+        )
+        token_counts = {
+            message.id: message.token_counts
+            for message in counted
+            if message.id is not None
+        }
+        if self.chat_data.id is not None:
+            await ChatsManager.save_token_counts(token_counts, [self.chat_data.id])
+
+    async def _older_message_tokens(self) -> int:
+        """The number of tokens in the messages which haven't been loaded (see
+        `ChatData.older_message_count`).
+
+        They're added up from the counts stored in the database, so the messages
+        are only loaded if some of them haven't been counted yet.
+        """
+        model_name = self.chat_data.model.name
+        tokens, uncounted = await ChatsManager.older_message_tokens(
+            self.chat_data, model_name
+        )
+        if uncounted:
+            older_messages = await ChatsManager.get_older_messages(self.chat_data)
+            await self._count_tokens(older_messages)
+            tokens = sum(message.token_counts[model_name] for message in older_messages)
+        return tokens
+
+    async def _update_context_tokens(self) -> int:
+        """Count the tokens in the whole conversation, and show the total in
+        the prompt input's meter.
+
+        Returns:
+            The number of tokens in the messages which have been loaded.
+        """
+        await import_litellm()
+        chat_messages = self.chat_data.messages
+        await self._count_tokens(chat_messages)
+        loaded_tokens = total_tokens(chat_messages, self.chat_data.model.name)
+        prompt = self.query_one(ChatPromptInput)
+        prompt.context_tokens = loaded_tokens + await self._older_message_tokens()
+        return loaded_tokens
+
+    async def _older_messages_to_send(self, loaded_tokens: int) -> list[ChatMessage]:
+        """Load the messages which haven't been loaded, and could be sent along
+        with the loaded ones, which total `loaded_tokens`.
+
+        Conversations are trimmed to the model's context budget by keeping the
+        most recent messages (see `trim_messages`), so only as many of the older
+        messages as their stored token counts say could fit are loaded.
+        """
+        model_name = self.chat_data.model.name
+        budget = context_budget(model_name)
+        limit: int | None = None
+        if budget is not None:
+            if loaded_tokens >= budget:
+                return []
+            older_tokens, uncounted = await ChatsManager.older_message_tokens(
+                self.chat_data, model_name
+            )
+            if not uncounted and loaded_tokens + older_tokens >= budget:
+                fitting = await ChatsManager.count_older_messages_within_tokens(
+                    self.chat_data, model_name, budget - loaded_tokens
+                )
+                # The next oldest message may be shortened to fit, too.
+                limit = fitting + 1
+        older_messages = await ChatsManager.get_older_messages(
+            self.chat_data, limit=limit
+        )
+        await self._count_tokens(older_messages)
+        return older_messages
+
+    @work(exclusive=True, group="context_tokens")
+    async def update_context_tokens(self) -> None:
+        """Count the tokens in the conversation, for the prompt input's meter."""
+        await self._update_context_tokens()
+
+    @work(group="agent_response")
     async def stream_agent_response(self) -> None:
         model = self.chat_data.model
         log.debug(f"Creating streaming response with model {model.name!r}")
 
-        import litellm
+        litellm = await import_litellm()
         from litellm import ModelResponse, acompletion
-        from litellm.utils import trim_messages
-
-        raw_messages = [message.message for message in self.chat_data.messages]
 
-        messages: list[ChatCompletionUserMessageParam] = trim_messages(
-            raw_messages, model.name
+        loaded_tokens = await self._update_context_tokens()
+        chat_messages = self.chat_data.messages
+        if self.chat_data.older_message_count:
+            # Only the most recent messages were loaded when the chat was opened,
+            # but some of the older ones may fit in the model's context too.
+            older_messages = await self._older_messages_to_send(loaded_tokens)
+            chat_messages = [chat_messages[0], *older_messages, *chat_messages[1:]]
+        chat_messages = [
+            message for message in chat_messages if not message.is_empty_response
+        ]
+        messages: list[ChatCompletionUserMessageParam] = await asyncio.to_thread(
+            trim_messages, chat_messages, model.name
         )  # type: ignore
 
         litellm.organization = model.organization
@@ -197,42 +363,77 @@ class Chat(Widget):
         }
         now = datetime.datetime.now(datetime.timezone.utc)
 
-        message = ChatMessage(message=ai_message, model=model, timestamp=now)
-        response_chatbox = Chatbox(
-            message=message,
-            model=self.chat_data.model,
-            classes="response-in-progress",
+        message = ChatMessage(
+            message=ai_message, model=model, timestamp=now, partial=True
         )
-        self.post_message(self.AgentResponseStarted())
-        self.app.call_from_thread(self.chat_container.mount, response_chatbox)
+        # Save the response as soon as some of it arrives, and then update it
+        # periodically, so it survives a crash or disconnect. A response which
+        # fails before anything arrives isn't saved at all.
+        last_saved_time = time.monotonic()
+        last_saved_length = 0
+
+        async def save_partial_response() -> None:
+            nonlocal last_saved_time, last_saved_length
+            content = ai_message["content"] or ""
+            if len(content) == last_saved_length:
+                return
+            if message.id is None:
+                await ChatsManager.add_message_to_chat(self.chat_data.id, message)
+            else:
+                await ChatsManager.update_message_content(message.id, content, True)
+            last_saved_time = time.monotonic()
+            last_saved_length = len(content)
 
         assert (
             self.chat_container is not None
         ), "Textual has mounted container at this point in the lifecycle."
 
+        container = self.chat_container
+        self.post_message(self.AgentResponseStarted())
+        container.add_message(message, responding=True)
+
+        def append_to_response(text: str) -> None:
+            # Keep following the response, unless the user has scrolled up.
+            following = container.scroll_y >= container.max_scroll_y - 3
+            container.append_chunk(message, text)
+            if following:
+                container.scroll_end(animate=False)
+
+        coalescer = ChunkCoalescer(
+            append_to_response, self.app.launch_config.stream_frame_rate
+        )
         try:
-            chunk_count = 0
             async for chunk in response:
                 chunk = cast(ModelResponse, chunk)
-                response_chatbox.border_title = "Agent is responding..."
-
                 chunk_content = chunk.choices[0].delta.content
                 if isinstance(chunk_content, str):
-                    self.app.call_from_thread(
-                        response_chatbox.append_chunk, chunk_content
-                    )
+                    coalescer.add(chunk_content)
                 else:
                     break
 
-                scroll_y = self.chat_container.scroll_y
-                max_scroll_y = self.chat_container.max_scroll_y
-                if scroll_y in range(max_scroll_y - 3, max_scroll_y + 1):
-                    self.app.call_from_thread(
-                        self.chat_container.scroll_end, animate=False
-                    )
-
-                chunk_count += 1
+                unsaved_chars = len(ai_message["content"] or "") - last_saved_length
+                if (
+                    message.id is None
+                    or time.monotonic() - last_saved_time
+                    >= self.SAVE_PARTIAL_RESPONSE_INTERVAL
+                    or unsaved_chars >= self.SAVE_PARTIAL_RESPONSE_CHARS
+                ):
+                    await save_partial_response()
+        except asyncio.CancelledError:
+            # The chat was closed while the response was streaming in.
+            coalescer.flush()
+            await save_partial_response()
+            raise
         except Exception:
+            # Keep whatever arrived before the failure. It stays marked as partial.
+            coalescer.flush()
+            await save_partial_response()
+            user_message = self.chat_data.messages[-1]
+            if message.id is None:
+                container.remove_message(message)
+            else:
+                self.chat_data.messages.append(message)
+                container.finish_response(message)
             self.notify(
                 "There was a problem using this model. "
                 "Please check your configuration file.",
@@ -240,14 +441,11 @@ class Chat(Widget):
                 severity="error",
                 timeout=constants.ERROR_NOTIFY_TIMEOUT_SECS,
             )
-            self.post_message(self.AgentResponseFailed(self.chat_data.messages[-1]))
+            self.post_message(self.AgentResponseFailed(user_message))
         else:
+            coalescer.flush()
             self.post_message(
-                self.AgentResponseComplete(
-                    chat_id=self.chat_data.id,
-                    message=response_chatbox.message,
-                    chatbox=response_chatbox,
-                )
+                self.AgentResponseComplete(chat_id=self.chat_data.id, message=message)
             )
 
     @on(AgentResponseFailed)
@@ -266,9 +464,9 @@ class Chat(Widget):
     @on(AgentResponseComplete)
     def agent_finished_responding(self, event: AgentResponseComplete) -> None:
         # Ensure the thread is updated with the message from the agent
+        event.message.partial = False
         self.chat_data.messages.append(event.message)
-        event.chatbox.border_title = "Agent"
-        event.chatbox.remove_class("response-in-progress")
+        self.chat_container.finish_response(event.message)
         prompt = self.query_one(ChatPromptInput)
         prompt.submit_ready = True
 
@@ -298,14 +496,9 @@ class Chat(Widget):
             header.update_header(self.chat_data, self.model)
             await ChatsManager.rename_chat(event.chat_id, event.new_title)
 
-    def get_latest_chatbox(self) -> Chatbox:
-        return self.query(Chatbox).last()
-
     def focus_latest_message(self) -> None:
-        try:
-            self.get_latest_chatbox().focus()
-        except NoMatches:
-            pass
+        transcript = self.chat_container
+        transcript.focus_message(len(transcript.messages) - 1)
 
     def action_rename(self) -> None:
         title_static = self.query_one(TitleStatic)
@@ -314,11 +507,37 @@ class Chat(Widget):
     def action_focus_latest_message(self) -> None:
         self.focus_latest_message()
 
-    def action_focus_first_message(self) -> None:
+    async def action_focus_first_message(self) -> None:
+        await self.load_older_messages()
+        # After the older messages have been scrolled into place.
+        self.chat_container.call_after_refresh(self.chat_container.focus_message, 0)
+
+    async def _load_older_messages_at_top(self, scroll_y: float) -> None:
+        if scroll_y == 0:
+            await self.load_older_messages()
+
+    async def load_older_messages(self) -> None:
+        """Load and display the page of messages before the oldest one shown,
+        if the chat was opened without them, keeping the scroll position."""
+        chat_data = self.chat_data
+        if not chat_data.older_message_count or self._loading_older_messages:
+            return
+
+        self._loading_older_messages = True
         try:
-            self.query(Chatbox).first().focus()
-        except NoMatches:
-            pass
+            older_messages = await ChatsManager.get_older_messages(
+                chat_data, limit=self.MESSAGE_PAGE_SIZE
+            )
+            chat_data.messages[1:1] = older_messages
+            chat_data.older_message_count = max(
+                0, chat_data.older_message_count - len(older_messages)
+            )
+            if not chat_data.older_message_count:
+                chat_data.first_user_message_preview = None
+
+            self.chat_container.insert_older_messages(older_messages)
+        finally:
+            self._loading_older_messages = False
 
     def action_scroll_container_up(self) -> None:
         if self.chat_container:
@@ -332,24 +551,44 @@ class Chat(Widget):
         await self.app.push_screen(ChatDetails(self.chat_data))
 
     async def load_chat(self, chat_data: ChatData) -> None:
-        chatboxes = [
-            Chatbox(chat_message, chat_data.model)
-            for chat_message in chat_data.non_system_messages
-        ]
-        await self.chat_container.mount_all(chatboxes)
-        self.chat_container.scroll_end(animate=False, force=True)
+        messages = chat_data.messages
+        if len(messages) > 1 and messages[-1].is_empty_response:
+            # The last message didn't really receive a response, so it's
+            # requested again below.
+            empty_response = messages.pop()
+            if chat_data.id is not None and empty_response.id is not None:
+                await ChatsManager.delete_messages(chat_data.id, [empty_response.id])
+
+        transcript = self.chat_container
+        transcript.set_messages(chat_data.non_system_messages)
+        focus_index = next(
+            (
+                index
+                for index, chat_message in enumerate(transcript.messages)
+                if self.focus_message_id is not None
+                and chat_message.id == self.focus_message_id
+            ),
+            None,
+        )
+        if focus_index is not None:
+            self.call_after_refresh(transcript.focus_message, focus_index)
+        else:
+            transcript.scroll_end(animate=False, force=True)
         chat_header = self.query_one(ChatHeader)
         chat_header.update_header(
             chat=chat_data,
             model=chat_data.model,
         )
 
+        prompt = self.query_one(ChatPromptInput)
+        prompt.token_model = chat_data.model.name
+
         # If the last message didn't receive a response, try again.
-        messages = chat_data.messages
         if messages and messages[-1].message["role"] == "user":
-            prompt = self.query_one(ChatPromptInput)
             prompt.submit_ready = False
             self.stream_agent_response()
+        else:
+            self.update_context_tokens()
 
     def action_close(self) -> None:
         self.app.clear_notifications()
@@ -2,14 +2,15 @@ from __future__ import annotations
 
 import datetime
 from dataclasses import dataclass
-from typing import Self, cast
+import time
+from typing import ClassVar, Self, cast
 
 import humanize
 from rich.console import RenderResult, Console, ConsoleOptions
 from rich.markup import escape
 from rich.padding import Padding
 from rich.text import Text
-from textual import events, log, on
+from textual import events, log, on, work
 from textual.binding import Binding
 from textual.geometry import Region
 from textual.message import Message
@@ -18,13 +19,14 @@ from textual.widgets.option_list import Option
 
 from elia_chat.chats_manager import ChatsManager
 from elia_chat.config import LaunchConfig
-from elia_chat.models import ChatData
+from elia_chat.models import ChatSummary
 
 
 @dataclass
 class ChatListItemRenderable:
-    chat: ChatData
+    chat: ChatSummary
     config: LaunchConfig
+    selected: bool = False
 
     def __rich_console__(
         self, console: Console, options: ConsoleOptions
@@ -39,19 +41,23 @@ class ChatListItemRenderable:
             subtitle += f" [i]by[/] {escape(model.provider)}"
         model_text = Text.from_markup(subtitle)
         title = self.chat.title or self.chat.short_preview.replace("\n", " ")
+        marker = ("✔ ", "bold") if self.selected else ""
         yield Padding(
-            Text.assemble(title, "\n", model_text, "\n", time_ago_text),
+            Text.assemble(marker, title, "\n", model_text, "\n", time_ago_text),
             pad=(0, 0, 0, 1),
         )
 
 
 class ChatListItem(Option):
-    def __init__(self, chat: ChatData, config: LaunchConfig) -> None:
+    def __init__(
+        self, chat: ChatSummary, config: LaunchConfig, selected: bool = False
+    ) -> None:
         """
         Args:
             chat: The chat associated with this option.
+            selected: True if the chat is part of the multi-selection.
         """
-        super().__init__(ChatListItemRenderable(chat, config))
+        super().__init__(ChatListItemRenderable(chat, config, selected))
         self.chat = chat
         self.config = config
 
@@ -60,19 +66,37 @@ class ChatList(OptionList):
     BINDINGS = [
         Binding(
             "escape",
-            "screen.focus('#home-prompt')",
+            "clear_selection_or_leave",
             "Focus prompt",
             key_display="esc",
-            tooltip="Return focus to the prompt input.",
+            tooltip="Clear the selected chats, or return focus to the prompt input.",
         ),
         Binding(
             "a",
             "archive_chat",
             "Archive chat",
             key_display="a",
-            tooltip="Archive the highlighted chat"
-            " (without deleting it from Elia's database).",
+            tooltip="Archive the selected chats, or the highlighted chat"
+            " (without deleting them from Elia's database).",
         ),
+        Binding(
+            "d,delete",
+            "delete_chats",
+            "Delete",
+            key_display="d",
+            tooltip="Permanently delete the selected chats, or the highlighted chat.",
+        ),
+        Binding("space", "toggle_selection", "Select", show=False),
+        Binding("J,shift+down", "select_down", "Select down", show=False),
+        Binding("K,shift+up", "select_up", "Select up", show=False),
+        Binding(
+            "A",
+            "screen.archived_chats",
+            "Archived chats",
+            key_display="A",
+            tooltip="Browse archived chats, and unarchive them.",
+        ),
+        Binding("slash", "screen.search", "Search", show=False),
         Binding("j,down", "cursor_down", "Down", show=False),
         Binding("k,up", "cursor_up", "Up", show=False),
         Binding("l,right,enter", "select", "Select", show=False),
@@ -82,9 +106,41 @@ class ChatList(OptionList):
         Binding("pageup", "page_up", "Page Up", show=False),
     ]
 
+    PAGE_SIZE: ClassVar[int] = 100
+    """The number of chats to load from the database at a time."""
+
+    LOAD_MORE_THRESHOLD: ClassVar[int] = 20
+    """When the highlight gets this close to the end of the loaded chats,
+    the next page of chats is loaded."""
+
+    total_chat_count: int = 0
+    """The total number of (non-archived) chats in the database,
+    which may be more than the number of chats currently loaded."""
+
+    all_chats_loaded: bool = False
+    """True if there are no more chats to be paged in from the database."""
+
+    DELETE_CONFIRM_SECONDS: ClassVar[float] = 3.0
+    """How long after asking for confirmation that deleting chats can be
+    confirmed, by pressing the delete key again."""
+
+    selected_chat_ids: set[int]
+    """The IDs of the chats which are selected, to be archived or deleted together."""
+
+    _selection_anchor: int | None = None
+    """The index that a range selection (`shift+up/down`) extends from."""
+
+    _range_chat_ids: set[int]
+    """The chats selected by the current range selection, which are deselected
+    if the range shrinks."""
+
+    _pending_delete: tuple[frozenset[int], float] | None = None
+    """The chats which will be deleted if deleting is confirmed, and when
+    confirmation was requested."""
+
     @dataclass
     class ChatOpened(Message):
-        chat: ChatData
+        chat: ChatSummary
 
     class CursorEscapingTop(Message):
         """Cursor attempting to move out-of-bounds at top of list."""
@@ -93,6 +149,8 @@ class ChatList(OptionList):
         """Cursor attempting to move out-of-bounds at bottom of list."""
 
     async def on_mount(self) -> None:
+        self.selected_chat_ids = set()
+        self._range_chat_ids = set()
         await self.reload_and_refresh()
 
     @on(OptionList.OptionSelected)
@@ -110,6 +168,19 @@ class ChatList(OptionList):
         elif self.option_count > 0:
             self.highlighted = 0
 
+    @on(OptionList.OptionHighlighted)
+    def load_more_if_near_end(self) -> None:
+        if (
+            self.highlighted is not None
+            and self.highlighted >= self.option_count - self.LOAD_MORE_THRESHOLD
+        ):
+            self.load_next_page_in_background()
+
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        if self.max_scroll_y - new_value < self.scrollable_content_region.height:
+            self.load_next_page_in_background()
+
     def on_blur(self) -> None:
         self.border_subtitle = None
 
@@ -120,7 +191,12 @@ class ChatList(OptionList):
         Args:
             new_highlighted: The index to highlight after refresh.
         """
-        chat_items = await self.load_chat_list_items()
+        # Reload as many chats as were previously paged in, so that the
+        # highlighted chat doesn't disappear from the list.
+        limit = max(self.PAGE_SIZE, self.option_count)
+        chat_items = await self.load_chat_list_items(limit=limit)
+        self.total_chat_count = await self.count_chats()
+        self.all_chats_loaded = len(chat_items) < limit
         old_highlighted = self.highlighted
         self.clear_options()
         self.add_options(chat_items)
@@ -132,43 +208,220 @@ class ChatList(OptionList):
 
         self.refresh()
 
-    async def load_chat_list_items(self) -> list[ChatListItem]:
-        chats = await self.load_chats()
-        return [ChatListItem(chat, self.app.launch_config) for chat in chats]
+    async def load_chat_list_items(
+        self, after: ChatSummary | None = None, limit: int | None = None
+    ) -> list[ChatListItem]:
+        chats = await self.load_chats(after, limit or self.PAGE_SIZE)
+        return [
+            ChatListItem(
+                chat, self.app.launch_config, chat.id in self.selected_chat_ids
+            )
+            for chat in chats
+        ]
 
-    async def load_chats(self) -> list[ChatData]:
-        all_chats = await ChatsManager.all_chats()
-        return all_chats
+    async def load_chats(
+        self, after: ChatSummary | None, limit: int
+    ) -> list[ChatSummary]:
+        return await ChatsManager.chat_summaries_page(after=after, limit=limit)
 
-    async def action_archive_chat(self) -> None:
-        if self.highlighted is None:
+    async def count_chats(self) -> int:
+        return await ChatsManager.count_chats()
+
+    async def delete_chats_from_database(self, chat_ids: list[int]) -> None:
+        await ChatsManager.delete_chats(chat_ids)
+
+    async def load_next_page(self) -> None:
+        """Page in the next chats from the database, adding them to the end
+        of the list."""
+        if self.all_chats_loaded or self.option_count == 0:
             return
 
+        last_item = cast(ChatListItem, self.get_option_at_index(self.option_count - 1))
+        chat_items = await self.load_chat_list_items(after=last_item.chat)
+
+        # The list may have been reloaded while we were waiting on the database.
+        if (
+            self.option_count == 0
+            or self.get_option_at_index(self.option_count - 1) is not last_item
+        ):
+            return
+
+        self.all_chats_loaded = len(chat_items) < self.PAGE_SIZE
+        self.add_options(chat_items)
+        if self.highlighted is not None:
+            self.border_subtitle = self.get_border_subtitle()
+
+    @work(exclusive=True, group="load_next_page")
+    async def load_next_page_in_background(self) -> None:
+        await self.load_next_page()
+
+    async def action_last(self) -> None:
+        await self.load_next_page()
+        super().action_last()
+
+    def get_target_items(self) -> list[ChatListItem]:
+        """The items which actions apply to: the selected chats if there are
+        any, otherwise the highlighted chat."""
+        items = cast(list[ChatListItem], self.options)
+        if self.selected_chat_ids:
+            return [item for item in items if item.chat.id in self.selected_chat_ids]
+        if self.highlighted is None:
+            return []
+        return [items[self.highlighted]]
+
+    def set_selected(self, index: int, selected: bool) -> None:
+        item = cast(ChatListItem, self.get_option_at_index(index))
+        if selected:
+            self.selected_chat_ids.add(item.chat.id)
+        else:
+            self.selected_chat_ids.discard(item.chat.id)
+        renderable = cast(ChatListItemRenderable, item.prompt)
+        if renderable.selected != selected:
+            self.replace_option_prompt_at_index(
+                index, ChatListItemRenderable(item.chat, item.config, selected)
+            )
+
+    def action_toggle_selection(self) -> None:
+        if self.highlighted is None:
+            return
         item = cast(ChatListItem, self.get_option_at_index(self.highlighted))
-        self.options.pop(self.highlighted)
-        self.remove_option_at_index(self.highlighted)
+        self.set_selected(self.highlighted, item.chat.id not in self.selected_chat_ids)
+        self._selection_anchor = self.highlighted
+        self._range_chat_ids = set()
+        self.border_subtitle = self.get_border_subtitle()
+
+    def action_select_down(self) -> None:
+        self.extend_selection(1)
+
+    def action_select_up(self) -> None:
+        self.extend_selection(-1)
+
+    def extend_selection(self, direction: int) -> None:
+        """Move the highlight, selecting the chats between it and the anchor
+        (where the range selection started)."""
+        if self.highlighted is None:
+            return
+        if self._selection_anchor is None:
+            self._selection_anchor = self.highlighted
+            self._range_chat_ids = set()
+        self.highlighted = max(
+            0, min(self.highlighted + direction, self.option_count - 1)
+        )
+        start, end = sorted((self._selection_anchor, self.highlighted))
+        items = cast(list[ChatListItem], self.options)
+        range_chat_ids = {item.chat.id for item in items[start : end + 1]}
+        for index, item in enumerate(items):
+            if item.chat.id in range_chat_ids:
+                self.set_selected(index, True)
+            elif item.chat.id in self._range_chat_ids:
+                self.set_selected(index, False)
+        self._range_chat_ids = range_chat_ids
+        self.border_subtitle = self.get_border_subtitle()
+
+    def clear_selection(self) -> None:
+        for index, item in enumerate(cast(list[ChatListItem], self.options)):
+            if item.chat.id in self.selected_chat_ids:
+                self.set_selected(index, False)
+        self.selected_chat_ids.clear()
+        self._selection_anchor = None
+        self._range_chat_ids = set()
+        self.border_subtitle = self.get_border_subtitle()
+
+    def action_clear_selection_or_leave(self) -> None:
+        if self.selected_chat_ids:
+            self.clear_selection()
+        else:
+            self.screen.set_focus(self.screen.query_one("#home-prompt"))
 
-        chat_id = item.chat.id
-        await ChatsManager.archive_chat(chat_id)
+    def remove_chats(self, chat_ids: set[int]) -> None:
+        """Remove chats from the list, without reloading it from the database."""
+        items = cast(list[ChatListItem], self.options)
+        highlighted = self.highlighted
+        if len(chat_ids) == 1 and highlighted is not None:
+            if items[highlighted].chat.id in chat_ids:
+                self.remove_option_at_index(highlighted)
+                items = []
+        if items:
+            remaining = [item for item in items if item.chat.id not in chat_ids]
+            if highlighted is not None:
+                highlighted -= sum(
+                    1 for item in items[:highlighted] if item.chat.id in chat_ids
+                )
+            self.set_options(remaining)
+            if remaining and highlighted is not None:
+                self.highlighted = min(highlighted, len(remaining) - 1)
 
+        self.selected_chat_ids -= chat_ids
+        self._selection_anchor = None
+        self._range_chat_ids = set()
+        self.total_chat_count -= len(chat_ids)
         self.border_title = self.get_border_title()
         self.border_subtitle = self.get_border_subtitle()
-        self.app.notify(
-            item.chat.title or f"Chat [b]{chat_id!r}[/] archived.",
-            title="Chat archived",
-        )
+        self.load_more_if_near_end()
         self.refresh()
 
+    def notify_chats_changed(self, items: list[ChatListItem], action: str) -> None:
+        if len(items) == 1:
+            chat = items[0].chat
+            self.app.notify(
+                chat.title or f"Chat [b]{chat.id!r}[/] {action}.",
+                title=f"Chat {action}",
+            )
+        else:
+            self.app.notify(f"{len(items)} chats {action}.", title=f"Chats {action}")
+
+    async def action_archive_chat(self) -> None:
+        items = self.get_target_items()
+        if not items:
+            return
+
+        chat_ids = {item.chat.id for item in items}
+        await ChatsManager.archive_chats(list(chat_ids))
+        self.remove_chats(chat_ids)
+        self.notify_chats_changed(items, "archived")
+
+    async def action_delete_chats(self) -> None:
+        """Permanently delete the target chats, once the delete key has been
+        pressed a second time to confirm."""
+        items = self.get_target_items()
+        if not items:
+            return
+
+        chat_ids = frozenset(item.chat.id for item in items)
+        now = time.monotonic()
+        if (
+            self._pending_delete is None
+            or self._pending_delete[0] != chat_ids
+            or now - self._pending_delete[1] > self.DELETE_CONFIRM_SECONDS
+        ):
+            self._pending_delete = (chat_ids, now)
+            chats = "this chat" if len(items) == 1 else f"{len(items)} chats"
+            self.app.notify(
+                f"Press [b]d[/] again to permanently delete {chats}.",
+                title="Delete chats?",
+                severity="warning",
+                timeout=self.DELETE_CONFIRM_SECONDS,
+            )
+            return
+
+        self._pending_delete = None
+        await self.delete_chats_from_database(list(chat_ids))
+        self.remove_chats(set(chat_ids))
+        self.notify_chats_changed(items, "deleted")
+
     def get_border_title(self) -> str:
-        return f"History ({len(self.options)})"
+        return f"History ({self.total_chat_count})"
 
     def get_border_subtitle(self) -> str:
         if self.highlighted is None:
             return ""
-        return f"{self.highlighted + 1} / {self.option_count}"
+        subtitle = f"{self.highlighted + 1} / {self.total_chat_count}"
+        if self.selected_chat_ids:
+            subtitle += f" ({len(self.selected_chat_ids)} selected)"
+        return subtitle
 
-    def create_chat(self, chat_data: ChatData) -> None:
-        new_chat_list_item = ChatListItem(chat_data, self.app.launch_config)
+    def create_chat(self, chat_summary: ChatSummary) -> None:
+        new_chat_list_item = ChatListItem(chat_summary, self.app.launch_config)
         log.debug(f"Creating new chat {new_chat_list_item!r}")
 
         option_list = self.query_one(OptionList)
@@ -0,0 +1,397 @@
+from __future__ import annotations
+
+import bisect
+import math
+from itertools import accumulate
+
+from textual import events, on
+from textual.containers import VerticalScroll
+from textual.screen import Screen
+from textual.widget import Widget
+
+from elia_chat.models import ChatMessage
+from elia_chat.widgets.chatbox import Chatbox
+
+CHATBOX_CHROME_WIDTH = 9
+"""The columns of the transcript taken up by things other than the content of a
+message: the margin, border and padding of a chatbox, and the scrollbar."""
+
+CHATBOX_CHROME_HEIGHT = 2
+"""The lines of a chatbox taken up by its border."""
+
+
+def estimate_height(message: ChatMessage, width: int) -> int:
+    """Estimate the height of the chatbox for a message, before it's rendered.
+
+    Args:
+        message: The message.
+        width: The width available for the content of the message.
+    """
+    content = message.message.get("content")
+    if not isinstance(content, str):
+        return CHATBOX_CHROME_HEIGHT
+    lines = sum(max(1, math.ceil(len(line) / width)) for line in content.split("\n"))
+    return lines + CHATBOX_CHROME_HEIGHT
+
+
+class ChatTranscript(VerticalScroll):
+    """The messages of a chat, only mounting chatboxes for those in and near
+    the visible part of the transcript.
+
+    Messages above and below the mounted ones are stood in for by spacers, the
+    heights of which are the sum of the heights of those messages. A message's
+    height is measured once it has been mounted, and estimated from its length
+    until then. As the transcript scrolls, chatboxes which are no longer near
+    the visible part are reused for the messages which are.
+    """
+
+    def __init__(
+        self,
+        *,
+        name: str | None = None,
+        id: str | None = None,
+        classes: str | None = None,
+    ) -> None:
+        super().__init__(name=name, id=id, classes=classes)
+        self.messages: list[ChatMessage] = []
+        """The messages in the transcript, oldest first."""
+        self._heights: list[int] = []
+        """The height of the chatbox for each message, measured or estimated."""
+        self._offsets: list[int] | None = None
+        """The position of the top of each message, and the total height."""
+        self._content_width = 0
+        """The width heights are measured or estimated for."""
+
+        self._start = 0
+        """The index of the first message with a mounted chatbox."""
+        self._chatboxes: list[Chatbox] = []
+        """The mounted chatboxes, for the messages from `_start` onwards."""
+        self._responding_message: ChatMessage | None = None
+        """The response which is streaming in, if any."""
+        self._at_end = True
+        """True if the transcript was scrolled to the end, so it should stay there
+        when the heights of messages are measured."""
+
+        self._top_spacer = Widget(classes="transcript-spacer")
+        self._bottom_spacer = Widget(classes="transcript-spacer")
+        self._top_spacer.styles.height = 0
+        self._bottom_spacer.styles.height = 0
+
+    def compose(self):
+        yield self._top_spacer
+        yield self._bottom_spacer
+
+    def on_mount(self) -> None:
+        self.screen.screen_layout_refresh_signal.subscribe(
+            self, self._measure_chatboxes
+        )
+
+    def index_of(self, message: ChatMessage) -> int:
+        """Get the index of a message in the transcript.
+
+        Raises:
+            ValueError: If the message isn't in the transcript.
+        """
+        for index in range(len(self.messages) - 1, -1, -1):
+            if self.messages[index] is message:
+                return index
+        raise ValueError("Message not in transcript")
+
+    def get_chatbox(self, index: int) -> Chatbox | None:
+        """Get the chatbox for the message at an index, if it's mounted."""
+        if self._start <= index < self._start + len(self._chatboxes):
+            return self._chatboxes[index - self._start]
+        return None
+
+    def set_messages(self, messages: list[ChatMessage]) -> None:
+        """Replace the messages in the transcript, and scroll to the end."""
+        for chatbox in self._chatboxes:
+            chatbox.remove()
+        self._start = 0
+        self._chatboxes = []
+        self._at_end = True
+        self.messages = list(messages)
+        self._heights = [self._estimate_height(message) for message in messages]
+        self._offsets = None
+        self._update_window()
+
+    def add_message(self, message: ChatMessage, responding: bool = False) -> None:
+        """Add a message to the end of the transcript.
+
+        Args:
+            message: The message.
+            responding: True if the message is a response which is streaming in.
+        """
+        self.messages.append(message)
+        self._heights.append(self._estimate_height(message))
+        self._offsets = None
+        if responding:
+            self._responding_message = message
+        self._update_window()
+
+    def remove_message(self, message: ChatMessage) -> None:
+        """Remove a message from the transcript, e.g. a response which failed
+        before any of it arrived."""
+        index = self.index_of(message)
+        if self._responding_message is message:
+            self._responding_message = None
+        chatbox = self.get_chatbox(index)
+        if chatbox is not None:
+            del self._chatboxes[index - self._start]
+            chatbox.remove()
+        elif index < self._start:
+            self._start -= 1
+        del self.messages[index]
+        del self._heights[index]
+        self._offsets = None
+        self._update_spacers()
+        self._update_window()
+
+    def insert_older_messages(self, messages: list[ChatMessage]) -> None:
+        """Add messages to the start of the transcript, keeping the messages
+        currently in view where they are."""
+        if not messages:
+            return
+        heights = [self._estimate_height(message) for message in messages]
+        self.messages[0:0] = messages
+        self._heights[0:0] = heights
+        self._offsets = None
+        self._start += len(messages)
+        self._update_spacers()
+        self.scroll_to(y=self.scroll_y + sum(heights), animate=False)
+
+    def append_chunk(self, message: ChatMessage, chunk: str) -> None:
+        """Append a chunk of text to a message, e.g. a streaming response."""
+        index = self.index_of(message)
+        chatbox = self.get_chatbox(index)
+        if chatbox is not None:
+            chatbox.append_chunk(chunk)
+            return
+
+        content = message.message.get("content")
+        if isinstance(content, str):
+            message.message["content"] = content + chunk
+            self._heights[index] = self._estimate_height(message)
+            self._offsets = None
+            self._update_spacers()
+
+    def finish_response(self, message: ChatMessage) -> None:
+        """Mark a response which was streaming in as complete."""
+        if self._responding_message is message:
+            self._responding_message = None
+        chatbox = self.get_chatbox(self.index_of(message))
+        if chatbox is not None:
+            chatbox.show_message(message)
+
+    def focus_message(self, index: int, scroll_visible: bool = True) -> None:
+        """Focus the chatbox for a message, mounting it if necessary."""
+        if not 0 <= index < len(self.messages):
+            return
+        chatbox = self.get_chatbox(index)
+        if chatbox is not None:
+            chatbox.focus(scroll_visible=scroll_visible)
+            return
+
+        chatbox = self._mount_message(index)
+        if chatbox is not None:
+            chatbox.focus(scroll_visible=False)
+            if scroll_visible:
+                self.call_after_refresh(self.scroll_to_widget, chatbox, animate=False)
+
+    @on(Chatbox.MoveFocus)
+    def move_focus(self, event: Chatbox.MoveFocus) -> None:
+        event.stop()
+        index = self.index_of(event.chatbox.message) + event.step
+        if index >= len(self.messages):
+            self.post_message(Chatbox.CursorEscapingBottom())
+        else:
+            self.focus_message(index)
+
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        self._at_end = new_value >= self.max_scroll_y
+        self._update_window()
+
+    def on_resize(self, event: events.Resize) -> None:
+        content_width = max(1, self.size.width - CHATBOX_CHROME_WIDTH)
+        old_width = self._content_width
+        if content_width == old_width:
+            self._update_window()
+            return
+
+        # Keep the message at the top of the view in the same place.
+        offsets = self._get_offsets()
+        anchor = max(0, bisect.bisect_right(offsets, self.scroll_y) - 1)
+        anchor_fraction = 0.0
+        if anchor < len(self._heights) and self._heights[anchor]:
+            anchor_fraction = (self.scroll_y - offsets[anchor]) / self._heights[anchor]
+
+        self._content_width = content_width
+        if old_width:
+            # Scale the heights to the new width. They'll be measured again
+            # when the messages are mounted.
+            self._heights = [
+                CHATBOX_CHROME_HEIGHT
+                + math.ceil(
+                    max(0, height - CHATBOX_CHROME_HEIGHT) * old_width / content_width
+                )
+                for height in self._heights
+            ]
+        else:
+            self._heights = [
+                self._estimate_height(message) for message in self.messages
+            ]
+        self._offsets = None
+        self._update_spacers()
+
+        offsets = self._get_offsets()
+        if self._at_end:
+            self._update_window(max(0, offsets[-1] - self.size.height))
+        else:
+            scroll_y = offsets[anchor]
+            if anchor < len(self._heights):
+                scroll_y += round(anchor_fraction * self._heights[anchor])
+            self._update_window(scroll_y)
+            self.scroll_to(y=scroll_y, animate=False)
+
+    def _estimate_height(self, message: ChatMessage) -> int:
+        if not self._content_width:
+            # Until the width is known, on the first resize.
+            return CHATBOX_CHROME_HEIGHT
+        return estimate_height(message, self._content_width)
+
+    def _get_offsets(self) -> list[int]:
+        if self._offsets is None:
+            self._offsets = [0, *accumulate(self._heights)]
+        return self._offsets
+
+    def _mount_message(self, index: int) -> Chatbox | None:
+        """Scroll to where a message which isn't mounted is expected to be, so
+        that it's mounted. The position may be out until it's been measured."""
+        offsets = self._get_offsets()
+        if offsets[index] < self.scroll_y:
+            scroll_y = offsets[index]
+        else:
+            scroll_y = min(offsets[index], offsets[index + 1] - self.size.height)
+        self._at_end = False
+        self._update_window(scroll_y)
+        self.scroll_to(y=scroll_y, animate=False, immediate=True)
+        return self.get_chatbox(index)
+
+    def _update_window(self, scroll_y: float | None = None) -> None:
+        """Mount chatboxes for the messages in and near the visible part of the
+        transcript, reusing those which are no longer near it.
+
+        Args:
+            scroll_y: The scroll position to update for, if it's not the current one.
+        """
+        if not self.is_mounted or not self.size.height:
+            return
+        if scroll_y is None:
+            scroll_y = self.scroll_y
+
+        # Mount the messages within a screen height of the visible ones.
+        offsets = self._get_offsets()
+        view_height = self.size.height
+        top = scroll_y - view_height
+        bottom = scroll_y + 2 * view_height
+        start = max(0, bisect.bisect_right(offsets, top) - 1)
+        end = min(len(self.messages), bisect.bisect_left(offsets, bottom))
+        start = min(start, end)
+
+        old_start = self._start
+        old_end = old_start + len(self._chatboxes)
+        if start == old_start and end == old_end:
+            return
+
+        focused = self.screen.focused
+        focused_index: int | None = None
+        kept: dict[int, Chatbox] = {}
+        spare: list[Chatbox] = []
+        for index, chatbox in enumerate(self._chatboxes, old_start):
+            if start <= index < end:
+                kept[index] = chatbox
+            else:
+                if focused is not None and (
+                    focused is chatbox or chatbox in focused.ancestors
+                ):
+                    focused_index = index
+                spare.append(chatbox)
+
+        chatboxes: list[Chatbox] = []
+        new_chatboxes: list[Chatbox] = []
+        for index in range(start, end):
+            chatbox = kept.get(index)
+            if chatbox is None:
+                message = self.messages[index]
+                responding = message is self._responding_message
+                if spare:
+                    chatbox = spare.pop()
+                    chatbox.show_message(message, responding=responding)
+                else:
+                    chatbox = Chatbox(message, message.model)
+                    chatbox.set_class(responding, "response-in-progress")
+                    new_chatboxes.append(chatbox)
+            chatboxes.append(chatbox)
+
+        for chatbox in spare:
+            chatbox.remove()
+        self._start = start
+        self._chatboxes = chatboxes
+
+        # Put the chatboxes which weren't already in place between the spacers.
+        if kept:
+            first_kept = min(kept)
+            last_kept = max(kept)
+            before = chatboxes[: first_kept - start]
+            after = chatboxes[last_kept - start + 1 :]
+        else:
+            before = []
+            after = chatboxes
+        for chatbox in reversed(before):
+            if chatbox in new_chatboxes:
+                self.mount(chatbox, after=self._top_spacer)
+            else:
+                self.move_child(chatbox, after=self._top_spacer)
+        for chatbox in after:
+            if chatbox in new_chatboxes:
+                self.mount(chatbox, before=self._bottom_spacer)
+            else:
+                self.move_child(chatbox, before=self._bottom_spacer)
+
+        self._update_spacers()
+
+        if focused_index is not None and chatboxes:
+            # The focused message has been scrolled out of the way, so the
+            # focus follows the view, like a cursor.
+            if focused_index < start:
+                chatboxes[0].focus(scroll_visible=False)
+            else:
+                chatboxes[-1].focus(scroll_visible=False)
+
+    def _update_spacers(self) -> None:
+        offsets = self._get_offsets()
+        end = self._start + len(self._chatboxes)
+        self._top_spacer.styles.height = offsets[self._start]
+        self._bottom_spacer.styles.height = offsets[-1] - offsets[end]
+
+    def _measure_chatboxes(self, screen: Screen | None = None) -> None:
+        """Record the heights the mounted chatboxes were laid out at, keeping
+        the messages in view where they are if those above them changed."""
+        offsets = self._get_offsets()
+        scroll_y = self.scroll_y
+        shift = 0
+        for index, chatbox in enumerate(self._chatboxes, self._start):
+            height = chatbox.laid_out_height
+            if height is None:
+                continue
+            if height != self._heights[index]:
+                if offsets[index] < scroll_y:
+                    shift += height - self._heights[index]
+                self._heights[index] = height
+                self._offsets = None
+
+        if self._at_end:
+            self.scroll_end(animate=False, immediate=True)
+        elif shift:
+            self.scroll_to(y=scroll_y + shift, animate=False, immediate=True)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 import bisect
 from dataclasses import dataclass
+from typing import ClassVar, Hashable
 
 from rich.cells import cell_len
 from rich.console import RenderableType
@@ -19,6 +20,8 @@ from textual.document._syntax_aware_document import SyntaxAwareDocumentError
 
 from elia_chat.config import EliaChatModel
 from elia_chat.models import ChatMessage
+from elia_chat.widgets.render_cache import CachedRenderable, RenderCache
+from elia_chat.widgets.streaming_markdown import StreamingMarkdown
 
 
 class SelectionTextArea(TextArea):
@@ -237,8 +240,18 @@ class Chatbox(Widget, can_focus=True):
     class CursorEscapingBottom(Message):
         """Sent when the cursor moves down from the bottom message."""
 
+    @dataclass
+    class MoveFocus(Message):
+        """Sent to move the focus to the message before or after this one."""
+
+        chatbox: Chatbox
+        step: int
+
     selection_mode = reactive(False, init=False)
 
+    render_cache: ClassVar[RenderCache] = RenderCache()
+    """The rendered lines of messages, shared by every chatbox."""
+
     def __init__(
         self,
         message: ChatMessage,
@@ -256,25 +269,50 @@ class Chatbox(Widget, can_focus=True):
         )
         self.message = message
         self.model = model
+        self._streaming_markdown: StreamingMarkdown | None = None
+        """Renders the content incrementally, once chunks are being appended."""
+        self.laid_out_height: int | None = None
+        """The height, including the border, the chatbox was last laid out at.
+        None if it hasn't been laid out since it was given its message."""
 
     def on_mount(self) -> None:
-        litellm_message = self.message.message
-        role = litellm_message["role"]
-        if role == "assistant":
-            self.add_class("assistant-message")
-            self.border_title = "Agent"
-        else:
-            self.add_class("human-message")
+        self._update_role()
+
+    def _update_role(self) -> None:
+        role = self.message.message["role"]
+        self.set_class(role == "assistant", "assistant-message")
+        self.set_class(role != "assistant", "human-message")
+        if role != "assistant":
             self.border_title = "You"
+        elif self.has_class("response-in-progress"):
+            self.border_title = "Agent is responding..."
+        elif self.message.partial:
+            self.border_title = "Agent (incomplete)"
+        else:
+            self.border_title = "Agent"
+
+    def show_message(self, message: ChatMessage, responding: bool = False) -> None:
+        """Show a different message, or the same one after it has changed.
+
+        Args:
+            message: The message.
+            responding: True if the message is a response which is streaming in.
+        """
+        if self.selection_mode:
+            self.selection_mode = False
+            self.remove_class("selecting")
+        self.message = message
+        self._streaming_markdown = None
+        self.laid_out_height = None
+        self.set_class(responding, "response-in-progress")
+        self._update_role()
+        self.refresh(layout=True)
 
     def action_up(self) -> None:
-        self.screen.focus_previous(Chatbox)
+        self.post_message(self.MoveFocus(self, -1))
 
     def action_down(self) -> None:
-        if self.parent and self is self.parent.children[-1]:
-            self.post_message(self.CursorEscapingBottom())
-        else:
-            self.screen.focus_next(Chatbox)
+        self.post_message(self.MoveFocus(self, 1))
 
     def action_select(self) -> None:
         self.selection_mode = not self.selection_mode
@@ -355,12 +393,29 @@ class Chatbox(Widget, can_focus=True):
 
         return Markdown(content, code_theme=self.app.launch_config.message_code_theme)
 
+    @property
+    def render_key(self) -> tuple[Hashable, ...]:
+        """Everything the rendered message depends on, other than the width."""
+        content = self.message.message.get("content")
+        return (
+            self.message.message["role"],
+            hash(content) if isinstance(content, str) else None,
+            self.app.launch_config.message_code_theme,
+            self.app.theme,
+        )
+
     def render(self) -> RenderableType:
         if self.selection_mode:
             # When in selection mode, this widget has a SelectionTextArea child,
             # so we do not need to render anything.
             return ""
+        if self._streaming_markdown is not None:
+            return self._streaming_markdown
+        return CachedRenderable(
+            self.render_cache, self.render_key, self._render_message
+        )
 
+    def _render_message(self) -> RenderableType:
         message = self.message.message
         theme = self.app.theme_object
         if theme:
@@ -381,10 +436,20 @@ class Chatbox(Widget, can_focus=True):
                 return ""
         return self.markdown
 
+    def get_content_height(self, container: Size, viewport: Size, width: int) -> int:
+        height = super().get_content_height(container, viewport, width)
+        self.laid_out_height = height + self.gutter.height
+        return height
+
     def append_chunk(self, chunk: str) -> None:
         """Append a chunk of text to the end of the message."""
         content = self.message.message.get("content")
         if isinstance(content, str):
+            if self._streaming_markdown is None:
+                self._streaming_markdown = StreamingMarkdown(
+                    content, code_theme=self.app.launch_config.message_code_theme
+                )
+            self._streaming_markdown.append(chunk)
             content += chunk
             self.message.message["content"] = content
             self.refresh(layout=True)
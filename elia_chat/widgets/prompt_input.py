@@ -1,10 +1,15 @@
+import asyncio
 from dataclasses import dataclass
-from textual import events, on
+from textual import events, on, work
 from textual.binding import Binding
 from textual.reactive import reactive
 from textual.widgets import TextArea
 from textual.message import Message
 from textual.content import Content
+from textual.timer import Timer
+
+from elia_chat.litellm_import import import_litellm
+from elia_chat.tokens import context_budget, count_message_tokens
 
 
 class PromptInput(TextArea):
@@ -25,8 +30,20 @@ class PromptInput(TextArea):
         Binding("ctrl+j,alt+enter", "submit_prompt", "Send message", key_display="^j")
     ]
 
+    COUNT_TOKENS_DELAY = 0.3
+    """Seconds to wait after the user stops typing before counting the tokens
+    in their message."""
+
     submit_ready = reactive(True)
 
+    token_model: reactive[str | None] = reactive(None)
+    """The LiteLLM name of the model the message will be sent to. If set, the
+    border shows how much of the model's context budget (see
+    `elia_chat.tokens.context_budget`) the conversation and message use."""
+
+    context_tokens = reactive(0)
+    """The number of tokens in the conversation the message will be added to."""
+
     def __init__(
         self,
         name: str | None = None,
@@ -37,6 +54,10 @@ class PromptInput(TextArea):
         super().__init__(
             name=name, id=id, classes=classes, disabled=disabled, language="markdown"
         )
+        self._prompt_tokens = 0
+        """The number of tokens in the message, when they were last counted."""
+        self._context_budget: int | None = None
+        self._count_tokens_timer: Timer | None = None
 
     def on_key(self, event: events.Key) -> None:
         if self.cursor_location == (0, 0) and event.key == "up":
@@ -54,13 +75,67 @@ class PromptInput(TextArea):
     def on_mount(self):
         self.border_title = "Enter your [u]m[/]essage..."
 
+    def watch_token_model(self) -> None:
+        self._context_budget = None
+        self.count_tokens()
+
+    def watch_context_tokens(self) -> None:
+        if self._context_budget is None:
+            self.count_tokens()
+        else:
+            self._update_subtitle()
+
+    @work(exclusive=True, group="prompt_tokens")
+    async def count_tokens(self) -> None:
+        """Count the tokens in the message, in a thread so that typing in a long
+        message isn't held up."""
+        model_name = self.token_model
+        if model_name is None:
+            return
+        text = self.text
+        if not text.strip() and not self.context_tokens:
+            # There's nothing to count (and no need to import LiteLLM yet).
+            self._prompt_tokens = 0
+            self._update_subtitle()
+            return
+        await import_litellm()
+        if self._context_budget is None:
+            self._context_budget = context_budget(model_name)
+        if text.strip():
+            self._prompt_tokens = await asyncio.to_thread(
+                count_message_tokens, {"role": "user", "content": text}, model_name
+            )
+        else:
+            self._prompt_tokens = 0
+        self._update_subtitle()
+
+    def _update_subtitle(self) -> None:
+        parts: list[Content] = []
+        if self.text.strip() != "":
+            parts.append(Content.from_markup("[white]^j[/] Send message"))
+        tokens = self.context_tokens + self._prompt_tokens
+        if self.token_model is not None and tokens:
+            if self._context_budget is None:
+                meter = f"{tokens:,} tokens"
+            else:
+                meter = f"{tokens:,}/{self._context_budget:,} tokens"
+            if self._context_budget is not None and tokens > self._context_budget:
+                # The start of the conversation won't be sent to the model.
+                parts.append(Content.styled(meter, "$error"))
+            else:
+                parts.append(Content(meter))
+        self.border_subtitle = Content(" · ").join(parts) if parts else None
+
     @on(TextArea.Changed)
     async def prompt_changed(self, event: TextArea.Changed) -> None:
         text_area = event.text_area
-        if text_area.text.strip() != "":
-            text_area.border_subtitle = Content.from_markup("[white]^j[/] Send message")
-        else:
-            text_area.border_subtitle = None
+        self._update_subtitle()
+        if self.token_model is not None:
+            if self._count_tokens_timer is not None:
+                self._count_tokens_timer.stop()
+            self._count_tokens_timer = self.set_timer(
+                self.COUNT_TOKENS_DELAY, self.count_tokens
+            )
 
         text_area.set_class(text_area.wrapped_document.height > 1, "multiline")
 
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from functools import cached_property
+from typing import Callable, Hashable
+
+from rich.console import Console, ConsoleOptions, RenderableType, RenderResult
+from rich.measure import Measurement
+from rich.segment import Segment
+
+
+class RenderCache:
+    """The rendered lines of finished messages, so that scrolling, focus changes
+    and resizing back to a previous width don't parse and lay them out again.
+
+    Entries are keyed by whatever determines the output (the content, themes,
+    etc.) plus the width. The least recently used entries are evicted once
+    there are more than `max_entries` of them, or they add up to more than
+    `max_lines` lines.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_lines: int = 50_000) -> None:
+        self.max_entries = max_entries
+        self.max_lines = max_lines
+        self._entries: OrderedDict[Hashable, list[list[Segment]]] = OrderedDict()
+        self._line_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> list[list[Segment]] | None:
+        lines = self._entries.get(key)
+        if lines is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return lines
+
+    def put(self, key: Hashable, lines: list[list[Segment]]) -> None:
+        self._discard(key)
+        if len(lines) > self.max_lines:
+            return
+        self._entries[key] = lines
+        self._line_count += len(lines)
+        while (
+            len(self._entries) > self.max_entries or self._line_count > self.max_lines
+        ):
+            _, evicted_lines = self._entries.popitem(last=False)
+            self._line_count -= len(evicted_lines)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._line_count = 0
+
+    def _discard(self, key: Hashable) -> None:
+        lines = self._entries.pop(key, None)
+        if lines is not None:
+            self._line_count -= len(lines)
+
+
+class CachedRenderable:
+    """A Rich renderable which renders another one through a `RenderCache`.
+
+    The renderable is only created (e.g. Markdown parsed) if it's needed, i.e.
+    if there are no cached lines for `key` at the width being rendered.
+    """
+
+    def __init__(
+        self,
+        cache: RenderCache,
+        key: tuple[Hashable, ...],
+        get_renderable: Callable[[], RenderableType],
+    ) -> None:
+        self.cache = cache
+        self.key = key
+        self.get_renderable = get_renderable
+
+    @cached_property
+    def renderable(self) -> RenderableType:
+        return self.get_renderable()
+
+    def __rich_console__(
+        self, console: Console, options: ConsoleOptions
+    ) -> RenderResult:
+        options = options.update(height=None)
+        key = (*self.key, options.max_width)
+        lines = self.cache.get(key)
+        if lines is None:
+            lines = console.render_lines(
+                self.renderable, options, pad=False, new_lines=False
+            )
+            self.cache.put(key, lines)
+
+        new_line = Segment.line()
+        for line in lines:
+            yield from line
+            yield new_line
+
+    def __rich_measure__(
+        self, console: Console, options: ConsoleOptions
+    ) -> Measurement:
+        return Measurement.get(console, options, self.renderable)
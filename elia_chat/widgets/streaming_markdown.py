@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+
+from markdown_it import MarkdownIt
+from rich.console import Console, ConsoleOptions, RenderResult
+from rich.markdown import Markdown
+from rich.segment import Segment
+
+CONTAINER_BLOCKS = {
+    "blockquote_open",
+    "bullet_list_open",
+    "ordered_list_open",
+    "table_open",
+}
+"""Blocks containing other blocks, which Rich always puts a blank line before."""
+
+REFERENCE_DEFINITION = re.compile(r"^ {0,3}\[[^\]]+\]:", re.MULTILINE)
+"""The start of a line which may define a link reference."""
+
+MAX_CACHED_WIDTHS = 2
+"""How many widths to keep rendered lines for. The width of a message can flip
+back and forth, e.g. as the scrollbar of the container appears."""
+
+
+@dataclass
+class RenderedLines:
+    """The lines of the Markdown rendered at a particular width."""
+
+    finished_lines: list[list[Segment]] = field(default_factory=list)
+    rendered_group_count: int = 0
+    """How many groups of finished blocks have been rendered."""
+    ends_with_rule: bool = False
+    """True if the last finished block is a horizontal rule. Rich doesn't
+    put a blank line after those."""
+    open_block_lines: list[list[Segment]] | None = None
+
+
+class StreamingMarkdown:
+    """A Rich renderable for Markdown which is still being appended to.
+
+    Rendering a `rich.markdown.Markdown` parses and lays out the whole text, so
+    re-rendering a response after every chunk costs time proportional to its
+    length each time. Instead, this splits the text into top-level blocks
+    (paragraphs, lists, code blocks, etc.) as it arrives. Once a block is
+    followed by another, it can't change, so it's rendered once and its lines
+    are kept. Only the last block, which may still be growing, is parsed and
+    rendered again each time.
+
+    The result is the same as rendering the whole text with `Markdown`. Link
+    reference definitions (`[docs]: https://...`) are the exception to blocks
+    not changing, as they apply to links anywhere in the text, so once one
+    appears the whole text is treated as one open block.
+    """
+
+    def __init__(self, markup: str = "", code_theme: str = "monokai") -> None:
+        self.markup = ""
+        self.code_theme = code_theme
+        self._parser = MarkdownIt().enable("strikethrough").enable("table")
+
+        self._finished_length = 0
+        """The length of the start of `markup` made up of finished blocks."""
+        self._checked_length = 0
+        """How much of `markup` has been checked for finished blocks."""
+        self._finished_sources: list[str] = []
+        """The source of the finished blocks, in groups which were finished together."""
+        self._rendered: dict[int, RenderedLines] = {}
+        """The rendered lines for the most recently used widths."""
+        self._has_references = False
+        """Whether the text may contain a link reference definition."""
+
+        self.append(markup)
+
+    def append(self, text: str) -> None:
+        """Append text to the end of the Markdown."""
+        # A definition may have been started by the end of the previous text.
+        line_start = self.markup.rfind("\n") + 1
+        self.markup += text
+        if not self._has_references and REFERENCE_DEFINITION.search(
+            self.markup, line_start
+        ):
+            self._has_references = True
+            self._finished_length = 0
+            self._finished_sources.clear()
+            self._rendered.clear()
+        for rendered in self._rendered.values():
+            rendered.open_block_lines = None
+        self._finish_blocks()
+
+    def _finish_blocks(self) -> None:
+        if self._has_references:
+            return
+        # Only whole lines are considered, as the start of a line can look like
+        # the start of a block (e.g. `#`) until the rest of it arrives.
+        end = self.markup.rfind("\n") + 1
+        if end <= self._checked_length:
+            return
+        self._checked_length = end
+        pending = self.markup[self._finished_length : end]
+        if "\r" in pending:
+            # Line numbers wouldn't match markdown-it's, which treats a lone
+            # "\r" as a line break, so just treat it all as one open block.
+            return
+
+        blocks = [
+            token
+            for token in self._parser.parse(pending)
+            if token.level == 0 and token.nesting != -1 and token.map
+        ]
+        if len(blocks) < 2:
+            return
+        last_block_start = blocks[-1].map[0]  # type: ignore[index]
+        lines = pending.split("\n")
+        finished_length = sum(len(line) + 1 for line in lines[:last_block_start])
+        self._finished_sources.append(pending[:finished_length])
+        self._finished_length += finished_length
+
+    def _render_blocks(
+        self,
+        markup: str,
+        rendered: RenderedLines,
+        console: Console,
+        options: ConsoleOptions,
+    ) -> tuple[list[list[Segment]], bool]:
+        """Render some of the blocks, as they'd appear in the whole Markdown.
+
+        Returns the lines, and whether the last block is a horizontal rule.
+        """
+        markdown = Markdown(markup, code_theme=self.code_theme)
+        lines = console.render_lines(markdown, options, pad=False, new_lines=False)
+        if not markdown.parsed:
+            return lines, False
+        # Blocks are separated by a blank line, which Rich has already added
+        # if the first block is a container.
+        first_block = markdown.parsed[0]
+        if (
+            rendered.finished_lines
+            and not rendered.ends_with_rule
+            and first_block.type not in CONTAINER_BLOCKS
+        ):
+            lines.insert(0, [])
+        return lines, markdown.parsed[-1].type == "hr"
+
+    def _get_rendered(self, width: int) -> RenderedLines:
+        """Get the lines rendered at this width, forgetting the least recent."""
+        rendered = self._rendered.pop(width, None)
+        if rendered is None:
+            rendered = RenderedLines()
+            while len(self._rendered) >= MAX_CACHED_WIDTHS:
+                del self._rendered[next(iter(self._rendered))]
+        self._rendered[width] = rendered
+        return rendered
+
+    def __rich_console__(
+        self, console: Console, options: ConsoleOptions
+    ) -> RenderResult:
+        options = options.update(height=None)
+        rendered = self._get_rendered(options.max_width)
+
+        # Render the blocks which have been finished since the last render.
+        for source in self._finished_sources[rendered.rendered_group_count :]:
+            lines, ends_with_rule = self._render_blocks(
+                source, rendered, console, options
+            )
+            rendered.finished_lines.extend(lines)
+            rendered.ends_with_rule = ends_with_rule
+        if rendered.rendered_group_count < len(self._finished_sources):
+            rendered.rendered_group_count = len(self._finished_sources)
+            rendered.open_block_lines = None
+
+        if rendered.open_block_lines is None:
+            open_block = self.markup[self._finished_length :]
+            rendered.open_block_lines, _ = self._render_blocks(
+                open_block, rendered, console, options
+            )
+
+        new_line = Segment.line()
+        for line in rendered.finished_lines:
+            yield from line
+            yield new_line
+        for line in rendered.open_block_lines:
+            yield from line
+            yield new_line
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+
+# Elia reads its data and config directories when it's imported, so these must
+# be set first, to keep the tests away from the user's own chats.
+_test_directory = tempfile.mkdtemp(prefix="elia-tests-")
+os.environ["XDG_DATA_HOME"] = os.path.join(_test_directory, "data")
+os.environ["XDG_CONFIG_HOME"] = os.path.join(_test_directory, "config")
+# Don't fetch LiteLLM's model list over the network.
+os.environ["LITELLM_LOCAL_MODEL_COST_MAP"] = "True"
+
+import pytest  # noqa: E402
+from textual._context import active_app  # noqa: E402
+
+from elia_chat.chats_manager import ChatsManager  # noqa: E402
+from elia_chat.config import LaunchConfig  # noqa: E402
+from elia_chat.database.database import (  # noqa: E402
+    archive_file_name,
+    create_database,
+    engine,
+    sqlite_file_name,
+)
+
+
+async def _reset_database() -> None:
+    await engine.dispose()
+    for path in (sqlite_file_name, archive_file_name):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            path.with_name(path.name + suffix).unlink(missing_ok=True)
+    await create_database()
+    ChatsManager.cache.clear()
+
+
+@pytest.fixture
+def launch_config() -> LaunchConfig:
+    return LaunchConfig()
+
+
+@pytest.fixture
+def database(launch_config: LaunchConfig):
+    """An empty database, and an active app for looking up models in."""
+    app = SimpleNamespace(
+        launch_config=launch_config, _is_devtools_connected=False, devtools=None
+    )
+    token = active_app.set(app)  # type: ignore
+    asyncio.run(_reset_database())
+    yield
+    asyncio.run(engine.dispose())
+    active_app.reset(token)
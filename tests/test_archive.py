@@ -0,0 +1,195 @@
+import asyncio
+import datetime
+import sqlite3
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.config import LaunchConfig
+from elia_chat.database import archive
+from elia_chat.database.archive import ARCHIVE_SCHEMA, MAIN_SCHEMA
+from elia_chat.database.database import archive_file_name, get_session, sqlite_file_name
+from elia_chat.models import ChatData, ChatMessage
+
+
+def create_chat(title: str) -> int:
+    model = LaunchConfig().default_model_object
+    now = datetime.datetime.now(datetime.timezone.utc)
+    chat_data = ChatData(
+        id=None,
+        title=None,
+        create_timestamp=None,
+        model=model,
+        messages=[
+            ChatMessage({"role": "system", "content": "Be brief."}, now, model),
+            ChatMessage({"role": "user", "content": f"{title}?"}, now, model),
+            ChatMessage({"role": "assistant", "content": f"{title}!"}, now, model),
+        ],
+    )
+
+    async def create() -> int:
+        chat_id = await ChatsManager.create_chat(chat_data)
+        await ChatsManager.rename_chat(chat_id, title)
+        return chat_id
+
+    return asyncio.run(create())
+
+
+def chats_in(path) -> list[tuple[int, str, int]]:
+    with sqlite3.connect(path) as connection:
+        return connection.execute(
+            "SELECT chat.id, chat.title, count(message.id) FROM chat "
+            "LEFT JOIN message ON message.chat_id = chat.id "
+            "GROUP BY chat.id ORDER BY chat.id"
+        ).fetchall()
+
+
+def test_archiving_and_unarchiving_moves_chats_and_messages(database):
+    first = create_chat("First")
+    second = create_chat("Second")
+
+    asyncio.run(ChatsManager.archive_chats([first]))
+    assert chats_in(sqlite_file_name) == [(second, "Second", 3)]
+    assert chats_in(archive_file_name) == [(first, "First", 3)]
+
+    restored = asyncio.run(ChatsManager.unarchive_chats([first]))
+    assert restored == {first: first}
+    assert chats_in(sqlite_file_name) == [(first, "First", 3), (second, "Second", 3)]
+    assert chats_in(archive_file_name) == []
+
+
+def test_ids_reused_in_the_target_are_shifted(database):
+    first = create_chat("First")
+    asyncio.run(ChatsManager.archive_chats([first]))
+    # SQLite reuses the ID of the archived chat for the next one.
+    reused = create_chat("Reused")
+    assert reused == first
+
+    asyncio.run(ChatsManager.archive_chats([reused]))
+    archived = chats_in(archive_file_name)
+    assert [(title, count) for _, title, count in archived] == [
+        ("First", 3),
+        ("Reused", 3),
+    ]
+    assert archived[1][0] > first
+    assert chats_in(sqlite_file_name) == []
+
+
+def copy_without_deleting(chat_ids: list[int], source: str, target: str) -> None:
+    """Copy chats as a move does, as if Elia stopped before deleting them."""
+
+    async def copy() -> None:
+        async with get_session() as session:
+            await archive._copy_chats(session, chat_ids, source, target)
+            await session.commit()
+
+    asyncio.run(copy())
+
+
+def test_interrupted_archive_is_finished_at_startup(database):
+    first = create_chat("First")
+    second = create_chat("Second")
+    copy_without_deleting([first], MAIN_SCHEMA, ARCHIVE_SCHEMA)
+    assert chats_in(sqlite_file_name) == [(first, "First", 3), (second, "Second", 3)]
+    assert chats_in(archive_file_name) == [(first, "First", 3)]
+
+    assert asyncio.run(archive.archive_pending_chats()) == 0
+    assert chats_in(sqlite_file_name) == [(second, "Second", 3)]
+    assert chats_in(archive_file_name) == [(first, "First", 3)]
+
+    # Finishing the moves again doesn't delete anything else.
+    assert asyncio.run(archive.finish_pending_moves()) == 0
+    assert chats_in(sqlite_file_name) == [(second, "Second", 3)]
+
+
+def test_interrupted_unarchive_is_finished_at_startup(database):
+    first = create_chat("First")
+    asyncio.run(ChatsManager.archive_chats([first]))
+    copy_without_deleting([first], ARCHIVE_SCHEMA, MAIN_SCHEMA)
+
+    assert asyncio.run(archive.finish_pending_moves()) == 1
+    assert chats_in(sqlite_file_name) == [(first, "First", 3)]
+    assert chats_in(archive_file_name) == []
+
+
+def test_chats_marked_as_archived_are_moved_at_startup(database):
+    first = create_chat("First")
+    second = create_chat("Second")
+    with sqlite3.connect(sqlite_file_name) as connection:
+        connection.execute("UPDATE chat SET archived = 1 WHERE id = ?", (first,))
+
+    assert asyncio.run(archive.archive_pending_chats()) == 1
+    assert chats_in(sqlite_file_name) == [(second, "Second", 3)]
+    assert chats_in(archive_file_name) == [(first, "First", 3)]
+
+
+def link_replies(chat_id: int) -> None:
+    """Link each message of a chat to the one before it, as imported chats are."""
+    with sqlite3.connect(sqlite_file_name) as connection:
+        connection.execute(
+            "UPDATE message SET parent_id = ("
+            "SELECT max(previous.id) FROM message AS previous "
+            "WHERE previous.chat_id = message.chat_id AND previous.id < message.id"
+            ") WHERE chat_id = ?",
+            (chat_id,),
+        )
+
+
+def parent_ids_in(path, chat_id: int) -> list[int | None]:
+    """The `parent_id` of each message of a chat, oldest first."""
+    with sqlite3.connect(path) as connection:
+        return [
+            parent_id
+            for (parent_id,) in connection.execute(
+                "SELECT parent_id FROM message WHERE chat_id = ? ORDER BY id",
+                (chat_id,),
+            )
+        ]
+
+
+def test_chats_with_taken_ids_survive_archiving_and_unarchiving(database):
+    titles = ["Alpha", "Bravo", "Charlie", "Delta"]
+    first = [create_chat(title) for title in titles[:2]]
+    asyncio.run(ChatsManager.archive_chats(first))
+    # SQLite reuses the chat and message IDs of the archived chats.
+    second = [create_chat(title) for title in titles[2:]]
+    assert second == first
+    for chat_id in second:
+        link_replies(chat_id)
+
+    asyncio.run(ChatsManager.archive_chats(second))
+    archived = chats_in(archive_file_name)
+    assert [(title, count) for _, title, count in archived] == [
+        (title, 3) for title in titles
+    ]
+    archived_ids = [chat_id for chat_id, _, _ in archived]
+    assert min(archived_ids[2:]) > max(first)
+
+    # The IDs of the first chats are taken in the main database again.
+    assert [create_chat("Echo"), create_chat("Foxtrot")] == first
+    restored = asyncio.run(ChatsManager.unarchive_chats(archived_ids))
+    assert sorted(restored) == sorted(archived_ids)
+    assert chats_in(archive_file_name) == []
+    main = {
+        title: (chat_id, count) for chat_id, title, count in chats_in(sqlite_file_name)
+    }
+    assert set(main) == {*titles, "Echo", "Foxtrot"}
+    for archived_id, (_, title, _) in zip(archived_ids, archived):
+        assert main[title] == (restored[archived_id], 3)
+
+    for title in titles:
+        chat_id = main[title][0]
+        chat = asyncio.run(ChatsManager.get_chat(chat_id))
+        assert [message.message["content"] for message in chat.messages] == [
+            "Be brief.",
+            f"{title}?",
+            f"{title}!",
+        ]
+        message_ids = [message.id for message in chat.messages]
+        if title in titles[2:]:
+            assert parent_ids_in(sqlite_file_name, chat_id) == [None, *message_ids[:-1]]
+        else:
+            assert parent_ids_in(sqlite_file_name, chat_id) == [None, None, None]
+
+        results = asyncio.run(ChatsManager.search(title))
+        assert {(result.chat_id, result.message_id) for result in results} == {
+            (chat_id, message_id) for message_id in message_ids[1:]
+        }
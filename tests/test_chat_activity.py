@@ -0,0 +1,57 @@
+import asyncio
+import datetime
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.config import LaunchConfig
+from elia_chat.models import ChatData, ChatMessage
+
+
+def chat_messages(*contents: tuple[str, str]) -> list[ChatMessage]:
+    model = LaunchConfig().default_model_object
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [
+        ChatMessage({"role": role, "content": content}, now, model)  # type: ignore
+        for role, content in contents
+    ]
+
+
+def new_chat() -> ChatData:
+    return ChatData(
+        id=None,
+        title=None,
+        create_timestamp=None,
+        model=LaunchConfig().default_model_object,
+        messages=chat_messages(
+            ("system", "Be brief."), ("user", "Hi"), ("assistant", "Hello")
+        ),
+    )
+
+
+async def stored_and_loaded_counts(chat_id: int) -> tuple[int, int]:
+    [summary] = await ChatsManager.chat_summaries_page()
+    chat = await ChatsManager.get_chat(chat_id)
+    return summary.message_count, chat.message_count
+
+
+def test_message_count_excludes_the_system_prompt(database):
+    async def run() -> None:
+        chat_id = await ChatsManager.create_chat(new_chat())
+        assert await stored_and_loaded_counts(chat_id) == (2, 2)
+
+        [message] = chat_messages(("user", "Thanks"))
+        await ChatsManager.add_message_to_chat(chat_id, message)
+        assert await stored_and_loaded_counts(chat_id) == (3, 3)
+
+    asyncio.run(run())
+
+
+def test_recounted_messages_exclude_the_system_prompt(database):
+    async def run() -> None:
+        chat_data = new_chat()
+        chat_id = await ChatsManager.create_chat(chat_data)
+        response = chat_data.messages[-1]
+        assert response.id is not None
+        await ChatsManager.delete_messages(chat_id, [response.id])
+        assert await stored_and_loaded_counts(chat_id) == (1, 1)
+
+    asyncio.run(run())
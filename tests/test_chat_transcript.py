@@ -0,0 +1,87 @@
+import asyncio
+import datetime
+
+from elia_chat.app import Elia
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.config import LaunchConfig
+from elia_chat.models import ChatData, ChatMessage
+from elia_chat.screens.chat_screen import ChatScreen
+from elia_chat.widgets.chat_transcript import ChatTranscript
+from elia_chat.widgets.chatbox import Chatbox
+
+MESSAGE_COUNT = 40
+
+
+def long_chat() -> ChatData:
+    model = LaunchConfig().default_model_object
+    now = datetime.datetime.now(datetime.timezone.utc)
+    messages = [ChatMessage({"role": "system", "content": "Be brief."}, now, model)]
+    for index in range(MESSAGE_COUNT):
+        role = "user" if index % 2 else "assistant"
+        # Vary the heights of the messages.
+        content = "\n".join(f"Message {index}" for _ in range(1 + index % 4))
+        messages.append(ChatMessage({"role": role, "content": content}, now, model))
+    return ChatData(
+        id=None, title=None, create_timestamp=None, model=model, messages=messages
+    )
+
+
+def mounted_indices(transcript: ChatTranscript) -> list[int]:
+    """The indices of the messages with mounted chatboxes, in the order they're
+    mounted in."""
+    return [
+        transcript.index_of(chatbox.message) for chatbox in transcript.query(Chatbox)
+    ]
+
+
+def assert_visible_messages_are_mounted(transcript: ChatTranscript) -> None:
+    indices = mounted_indices(transcript)
+    assert indices == list(range(indices[0], indices[-1] + 1))
+    assert len(indices) < MESSAGE_COUNT
+    # The spacers standing in for the other messages are out of view.
+    visible = transcript.content_region
+    for spacer in transcript.query(".transcript-spacer"):
+        assert not spacer.region.height or not spacer.region.overlaps(visible)
+    assert any(
+        chatbox.region.overlaps(visible) for chatbox in transcript.query(Chatbox)
+    )
+
+
+def test_only_chatboxes_near_the_view_are_mounted(database):
+    chat_id = asyncio.run(ChatsManager.create_chat(long_chat()))
+
+    async def run() -> None:
+        app = Elia(LaunchConfig())
+        async with app.run_test() as pilot:
+            await pilot.pause()
+            chat_data = await ChatsManager.get_chat(chat_id)
+            await app.push_screen(ChatScreen(chat_data))
+            await pilot.pause()
+            transcript = app.screen.query_one(ChatTranscript)
+            assert len(transcript.messages) == MESSAGE_COUNT
+
+            # The chat opens at the end.
+            await pilot.pause()
+            assert_visible_messages_are_mounted(transcript)
+            assert mounted_indices(transcript)[-1] == MESSAGE_COUNT - 1
+
+            transcript.scroll_home(animate=False, immediate=True)
+            await pilot.pause()
+            assert_visible_messages_are_mounted(transcript)
+            assert mounted_indices(transcript)[0] == 0
+
+            transcript.scroll_to(
+                y=transcript.max_scroll_y // 2, animate=False, immediate=True
+            )
+            await pilot.pause()
+            assert_visible_messages_are_mounted(transcript)
+            indices = mounted_indices(transcript)
+            assert indices[0] > 0 and indices[-1] < MESSAGE_COUNT - 1
+
+            # Scrolling back to the end reuses chatboxes for the messages there.
+            transcript.scroll_end(animate=False, immediate=True)
+            await pilot.pause()
+            assert_visible_messages_are_mounted(transcript)
+            assert mounted_indices(transcript)[-1] == MESSAGE_COUNT - 1
+
+    asyncio.run(run())
@@ -0,0 +1,67 @@
+import asyncio
+import datetime
+import json
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.config import LaunchConfig
+from elia_chat.database.export import export_chats
+from elia_chat.models import ChatData, ChatMessage
+
+
+def create_chat(title: str, reply: str) -> int:
+    model = LaunchConfig().default_model_object
+    now = datetime.datetime.now(datetime.timezone.utc)
+    chat_data = ChatData(
+        id=None,
+        title=None,
+        create_timestamp=None,
+        model=model,
+        messages=[
+            ChatMessage({"role": "system", "content": "Be brief."}, now, model),
+            ChatMessage({"role": "user", "content": "Hi"}, now, model),
+            ChatMessage({"role": "assistant", "content": reply}, now, model),
+        ],
+    )
+
+    async def create() -> int:
+        chat_id = await ChatsManager.create_chat(chat_data)
+        await ChatsManager.rename_chat(chat_id, title)
+        return chat_id
+
+    return asyncio.run(create())
+
+
+def test_archived_and_main_chats_with_the_same_id_export_to_separate_files(
+    database, tmp_path
+):
+    archived_id = create_chat("Same title", "Archived reply")
+    asyncio.run(ChatsManager.archive_chats([archived_id]))
+    # SQLite reuses the ID of the chat which was moved to the archive.
+    main_id = create_chat("Same title", "Main reply")
+    assert main_id == archived_id
+
+    progress = asyncio.run(export_chats(tmp_path, export_format="markdown"))
+
+    assert progress.chat_count == 2
+    files = sorted(path.name for path in tmp_path.iterdir())
+    assert files == [
+        f"{main_id:06d}-same-title.md",
+        f"archive-{archived_id:06d}-same-title.md",
+    ]
+    assert "Main reply" in (tmp_path / files[0]).read_text()
+    assert "Archived reply" in (tmp_path / files[1]).read_text()
+
+
+def test_jsonl_export_marks_archived_chats(database, tmp_path):
+    archived_id = create_chat("Archived", "Archived reply")
+    asyncio.run(ChatsManager.archive_chats([archived_id]))
+    create_chat("Main", "Main reply")
+
+    output = tmp_path / "chats.jsonl"
+    asyncio.run(export_chats(output))
+
+    chats = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [(chat["title"], chat["archived"]) for chat in chats] == [
+        ("Main", False),
+        ("Archived", True),
+    ]
@@ -0,0 +1,311 @@
+import asyncio
+import io
+import json
+import sqlite3
+
+import pytest
+
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.database.database import (
+    create_database,
+    get_session,
+    sqlite_file_name,
+)
+from elia_chat.database import import_chatgpt
+from elia_chat.database.import_chatgpt import (
+    ImportCheckpoint,
+    ImportFormatError,
+    convert_conversation,
+    import_chatgpt_data,
+    iter_json_array,
+)
+
+
+def read_all(data: bytes, chunk_size: int, resume_offset: int = 0) -> list:
+    return list(
+        iter_json_array(io.BytesIO(data), chunk_size, resume_offset=resume_offset)
+    )
+
+
+ELEMENTS = [
+    {"title": "First", "text": "plain"},
+    {"title": "Second", "text": "ünïcödé → 🐍" * 20},
+    [1, 2, {"nested": ["a", "b"]}],
+    "a string, with ] and , inside",
+    None,
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 4096])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_elements_are_decoded_one_at_a_time(chunk_size, indent):
+    data = json.dumps(ELEMENTS, indent=indent, ensure_ascii=False).encode()
+    elements = [element for element, _ in read_all(data, chunk_size)]
+    assert elements == ELEMENTS
+
+
+def test_offsets_are_the_byte_offsets_of_each_element_end():
+    data = json.dumps(ELEMENTS, ensure_ascii=False).encode()
+    for element, offset in read_all(data, chunk_size=7):
+        # The element ends just before the offset.
+        encoded = json.dumps(element, ensure_ascii=False).encode()
+        assert data[offset - len(encoded) : offset] == encoded
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_resuming_from_an_offset_yields_the_remaining_elements(chunk_size):
+    data = json.dumps(ELEMENTS, indent=2, ensure_ascii=False).encode()
+    results = read_all(data, chunk_size)
+    for index, (_, offset) in enumerate(results):
+        resumed = read_all(data, chunk_size, resume_offset=offset)
+        assert resumed == results[index + 1 :]
+
+
+@pytest.mark.parametrize("data", [b"[]", b"  [\n ]\n"])
+def test_empty_array(data):
+    assert read_all(data, chunk_size=1) == []
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b'{"not": "an array"}', b"[1, 2", b"[1 2]", b'[{"unterminated": ]'],
+)
+def test_invalid_files_are_rejected(data):
+    with pytest.raises(ImportFormatError):
+        read_all(data, chunk_size=4)
+
+
+def node(node_id, parent, children, role=None, text="", create_time=0.0):
+    message = None
+    if role is not None:
+        message = {
+            "author": {"role": role},
+            "content": {"parts": [text]},
+            "create_time": create_time,
+            "metadata": {},
+        }
+    return {"id": node_id, "parent": parent, "children": children, "message": message}
+
+
+def branching_conversation(current_node="a3", **extra_nodes):
+    """A conversation whose first response was regenerated: `a1` was replaced
+    by `a2`, which the conversation continued from."""
+    mapping = {
+        "root": node("root", None, ["u1"]),
+        "u1": node("u1", "root", ["a1", "a2"], "user", "Question", 1),
+        "a1": node("a1", "u1", [], "assistant", "First answer", 2),
+        "a2": node("a2", "u1", ["u2"], "assistant", "Second answer", 3),
+        "u2": node("u2", "a2", ["a3"], "user", "Follow up", 4),
+        "a3": node("a3", "u2", [], "assistant", "Final answer", 5),
+        **extra_nodes,
+    }
+    return {
+        "id": "conversation-1",
+        "title": "Branches",
+        "create_time": 1.0,
+        "current_node": current_node,
+        "mapping": mapping,
+    }
+
+
+def test_every_branch_is_converted():
+    imported = convert_conversation(branching_conversation())
+    messages = {message["source_id"]: message for message in imported.messages}
+    assert set(messages) == {"u1", "a1", "a2", "u2", "a3"}
+    source_ids = [message["source_id"] for message in imported.messages]
+    parents = dict(zip(source_ids, imported.parent_nodes))
+    # The root has no message, so the first message doesn't reply to anything.
+    assert parents == {"u1": None, "a1": "u1", "a2": "u1", "u2": "a2", "a3": "u2"}
+    active = {source_id for source_id in messages if messages[source_id]["active"]}
+    assert active == {"u1", "a2", "u2", "a3"}
+
+
+def test_parents_are_converted_before_their_replies():
+    imported = convert_conversation(branching_conversation())
+    seen = set()
+    for message, parent in zip(imported.messages, imported.parent_nodes):
+        assert parent is None or parent in seen
+        seen.add(message["source_id"])
+
+
+def test_latest_leaf_is_active_without_a_current_node():
+    imported = convert_conversation(branching_conversation(current_node=None))
+    active = {
+        message["source_id"] for message in imported.messages if message["active"]
+    }
+    assert active == {"u1", "a2", "u2", "a3"}
+
+
+def imported_messages() -> list[tuple[str, str | None, int]]:
+    with sqlite3.connect(sqlite_file_name) as connection:
+        return connection.execute(
+            "SELECT message.source_id, parent.source_id, message.active "
+            "FROM message LEFT JOIN message AS parent "
+            "ON parent.id = message.parent_id ORDER BY message.source_id"
+        ).fetchall()
+
+
+def import_file(tmp_path, conversations) -> None:
+    path = tmp_path / "conversations.json"
+    path.write_text(json.dumps(conversations))
+    asyncio.run(import_chatgpt_data(path))
+
+
+def test_imported_branches_are_linked(database, tmp_path):
+    import_file(tmp_path, [branching_conversation()])
+    assert imported_messages() == [
+        ("a1", "u1", 0),
+        ("a2", "u1", 1),
+        ("a3", "u2", 1),
+        ("u1", None, 1),
+        ("u2", "a2", 1),
+    ]
+
+
+def test_only_the_current_branch_is_loaded(database, tmp_path):
+    import_file(tmp_path, [branching_conversation()])
+
+    async def load():
+        [summary] = await ChatsManager.chat_summaries_page()
+        return await ChatsManager.get_chat(summary.id)
+
+    chat = asyncio.run(load())
+    assert [message.message["content"] for message in chat.messages] == [
+        "Question",
+        "Second answer",
+        "Follow up",
+        "Final answer",
+    ]
+
+
+def message_ids() -> list[int]:
+    with sqlite3.connect(sqlite_file_name) as connection:
+        return [row[0] for row in connection.execute("SELECT id FROM message")]
+
+
+def test_reimporting_an_unchanged_conversation_changes_nothing(database, tmp_path):
+    import_file(tmp_path, [branching_conversation()])
+    ids_before = message_ids()
+    import_file(tmp_path, [branching_conversation()])
+    assert message_ids() == ids_before
+    assert asyncio.run(ChatsManager.count_chats()) == 1
+
+
+def test_reimporting_a_continued_conversation_adds_new_messages(database, tmp_path):
+    import_file(tmp_path, [branching_conversation()])
+    ids_before = message_ids()
+
+    continued = branching_conversation(
+        current_node="a4",
+        u3=node("u3", "a3", ["a4"], "user", "Another question", 6),
+        a4=node("a4", "u3", [], "assistant", "Another answer", 7),
+    )
+    continued["mapping"]["a3"]["children"] = ["u3"]
+    import_file(tmp_path, [continued])
+
+    assert message_ids()[: len(ids_before)] == ids_before
+    assert imported_messages() == [
+        ("a1", "u1", 0),
+        ("a2", "u1", 1),
+        ("a3", "u2", 1),
+        ("a4", "u3", 1),
+        ("u1", None, 1),
+        ("u2", "a2", 1),
+        ("u3", "a3", 1),
+    ]
+    [summary] = asyncio.run(ChatsManager.chat_summaries_page())
+    assert summary.message_count == 6
+
+
+def test_reimporting_a_different_branch_switches_the_active_messages(
+    database, tmp_path
+):
+    import_file(tmp_path, [branching_conversation()])
+    import_file(tmp_path, [branching_conversation(current_node="a1")])
+    active = [source_id for source_id, _, active in imported_messages() if active]
+    assert active == ["a1", "u1"]
+    assert asyncio.run(ChatsManager.count_chats()) == 1
+
+
+def test_interrupted_import_resumes_after_the_last_saved_offset(database, tmp_path):
+    conversations = [
+        {**branching_conversation(), "id": f"conversation-{index}"}
+        for index in range(3)
+    ]
+    path = tmp_path / "conversations.json"
+    path.write_text(json.dumps(conversations))
+    with open(path, "rb") as file:
+        [(_, first_offset), *_] = iter_json_array(file)
+    checkpoint = ImportCheckpoint.for_file(path)
+
+    async def interrupt_after_first_conversation() -> None:
+        async with get_session() as session:
+            await checkpoint.save_offset(session, first_offset)
+            await session.commit()
+
+    asyncio.run(interrupt_after_first_conversation())
+    asyncio.run(import_chatgpt_data(path))
+
+    # The first conversation was (supposedly) imported before the interruption.
+    assert asyncio.run(ChatsManager.count_chats()) == 2
+    assert asyncio.run(checkpoint.load_offset()) == 0
+
+
+def test_checkpoint_is_ignored_if_the_file_has_changed(database, tmp_path):
+    path = tmp_path / "conversations.json"
+    path.write_text(json.dumps([branching_conversation()]))
+    checkpoint = ImportCheckpoint.for_file(path)
+
+    async def save_checkpoint() -> None:
+        async with get_session() as session:
+            await checkpoint.save_offset(session, 10)
+            await session.commit()
+
+    asyncio.run(save_checkpoint())
+    path.write_text(json.dumps([branching_conversation(), branching_conversation()]))
+    assert asyncio.run(ImportCheckpoint.for_file(path).load_offset()) == 0
+
+
+def search_index_triggers() -> list[str]:
+    with sqlite3.connect(sqlite_file_name) as connection:
+        return [
+            name
+            for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'trigger' AND name LIKE 'message_fts_%' ORDER BY name"
+            )
+        ]
+
+
+def test_cancelled_batch_keeps_the_search_index_trigger(
+    database, tmp_path, monkeypatch
+):
+    triggers = search_index_triggers()
+    assert "message_fts_after_insert" in triggers
+
+    async def cancel(*args, **kwargs):
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(import_chatgpt, "_link_replies", cancel)
+    with pytest.raises(asyncio.CancelledError):
+        import_file(tmp_path, [branching_conversation()])
+
+    assert search_index_triggers() == triggers
+    # The rest of the batch was rolled back with it.
+    assert asyncio.run(ChatsManager.count_chats()) == 0
+    assert message_ids() == []
+
+
+def test_missing_search_index_trigger_is_restored(database, tmp_path):
+    import_file(tmp_path, [branching_conversation()])
+    with sqlite3.connect(sqlite_file_name) as connection:
+        connection.execute("DROP TRIGGER message_fts_after_insert")
+        connection.execute(
+            "INSERT INTO message_fts (message_fts) VALUES ('delete-all')"
+        )
+        connection.execute("DELETE FROM schema_version WHERE version >= 9")
+
+    asyncio.run(create_database())
+    assert "message_fts_after_insert" in search_index_triggers()
+    [result] = asyncio.run(ChatsManager.search("Second"))
+    assert result.chat_title == "Branches"
@@ -0,0 +1,12 @@
+import asyncio
+import sys
+
+from elia_chat.litellm_import import import_litellm
+
+
+def test_concurrent_imports_share_one_module():
+    async def import_concurrently():
+        return await asyncio.gather(*[import_litellm() for _ in range(8)])
+
+    modules = asyncio.run(import_concurrently())
+    assert all(module is sys.modules["litellm"] for module in modules)
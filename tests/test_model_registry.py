@@ -0,0 +1,57 @@
+from elia_chat.config import EliaChatModel, LaunchConfig
+from elia_chat.models import ModelRegistry, UnknownModel, get_model
+
+
+def test_models_are_found_by_id_name_and_alias():
+    model = EliaChatModel(
+        id="work-gpt", name="gpt-4o", display_name="GPT-4o", provider="OpenAI"
+    )
+    registry = ModelRegistry([model])
+    for key in ("work-gpt", "gpt-4o", "GPT-4o", "OpenAI/gpt-4o"):
+        assert registry.get(key) is model
+
+
+def test_id_takes_precedence_over_name_and_alias():
+    by_id = EliaChatModel(id="shared", name="first")
+    by_name = EliaChatModel(name="shared")
+    by_alias = EliaChatModel(name="third", display_name="shared")
+    registry = ModelRegistry([by_alias, by_name, by_id])
+    assert registry.get("shared") is by_id
+
+
+def test_name_takes_precedence_over_alias():
+    by_name = EliaChatModel(name="shared")
+    by_alias = EliaChatModel(name="other", display_name="shared")
+    registry = ModelRegistry([by_alias, by_name])
+    assert registry.get("shared") is by_name
+
+
+def test_the_last_model_with_an_id_or_name_wins():
+    first = EliaChatModel(id="same-id", name="same-name")
+    last = EliaChatModel(id="same-id", name="same-name")
+    registry = ModelRegistry([first, last])
+    assert registry.get("same-id") is last
+    assert registry.by_name["same-name"] is last
+
+
+def test_the_first_model_with_an_alias_wins():
+    first = EliaChatModel(name="one", display_name="Shared", provider="local")
+    last = EliaChatModel(name="two", display_name="Shared", provider="local")
+    registry = ModelRegistry([first, last])
+    assert registry.get("Shared") is first
+    assert registry.get("local/two") is last
+    assert registry.by_provider["local"] == [first, last]
+
+
+def test_unknown_models_are_the_same_instance():
+    registry = ModelRegistry([EliaChatModel(name="known")])
+    unknown = registry.get("missing")
+    assert isinstance(unknown, UnknownModel)
+    assert registry.get("also missing") is unknown
+
+
+def test_get_model_uses_the_configs_registry():
+    config = LaunchConfig()
+    assert config.model_registry is config.model_registry
+    model = config.all_models[0]
+    assert get_model(model.id or model.name, config) is model
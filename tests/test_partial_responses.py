@@ -0,0 +1,174 @@
+import asyncio
+import datetime
+import sqlite3
+from types import SimpleNamespace
+
+import litellm
+import pytest
+
+from elia_chat.app import Elia
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.config import LaunchConfig
+from elia_chat.database.database import sqlite_file_name
+from elia_chat.models import ChatData, ChatMessage
+from elia_chat.screens.chat_screen import ChatScreen
+from elia_chat.widgets.chat import Chat, ChatPromptInput
+from elia_chat.widgets.chatbox import Chatbox
+
+
+def fake_stream(chunks: list[str], fail: bool):
+    """A replacement for `litellm.acompletion` which streams `chunks`, and then
+    either fails or finishes."""
+
+    async def acompletion(**kwargs):
+        async def stream():
+            for chunk in chunks:
+                await asyncio.sleep(0.01)
+                delta = SimpleNamespace(content=chunk)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+            if fail:
+                raise ConnectionError("The connection was lost")
+            delta = SimpleNamespace(content=None)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+        return stream()
+
+    return acompletion
+
+
+def assistant_rows() -> list[tuple[str, str | None]]:
+    with sqlite3.connect(sqlite_file_name) as connection:
+        return connection.execute(
+            "SELECT content, json_extract(meta, '$.partial') FROM message "
+            "WHERE role = 'assistant' ORDER BY id"
+        ).fetchall()
+
+
+async def send_prompt(app: Elia, pilot, prompt: str) -> Chat:
+    await pilot.pause()
+    await app.launch_chat(prompt, app.runtime_config.selected_model)
+    await pilot.pause()
+    await app.workers.wait_for_complete()
+    await pilot.pause()
+    return app.screen.query_one(Chat)
+
+
+def test_failure_after_some_chunks_keeps_partial_response(database, monkeypatch):
+    monkeypatch.setattr(
+        litellm, "acompletion", fake_stream(["Hello", " there"], fail=True)
+    )
+
+    async def run() -> None:
+        app = Elia(LaunchConfig())
+        async with app.run_test() as pilot:
+            chat = await send_prompt(app, pilot, "Hi")
+            response = chat.chat_data.messages[-1]
+            assert response.message == {"role": "assistant", "content": "Hello there"}
+            assert response.partial
+            assert response.id is not None
+            chatbox = chat.chat_container.get_chatbox(1)
+            assert chatbox is not None
+            assert chatbox.border_title == "Agent (incomplete)"
+            assert chat.query_one(ChatPromptInput).submit_ready
+            assert chat.allow_input_submit
+
+    asyncio.run(run())
+    assert assistant_rows() == [("Hello there", 1)]
+
+
+def test_failure_before_any_chunks_saves_nothing(database, monkeypatch):
+    monkeypatch.setattr(litellm, "acompletion", fake_stream([], fail=True))
+
+    async def run() -> None:
+        app = Elia(LaunchConfig())
+        async with app.run_test() as pilot:
+            chat = await send_prompt(app, pilot, "Hi")
+            roles = [message.message["role"] for message in chat.chat_data.messages]
+            assert roles == ["system", "user"]
+            assert len(chat.chat_container.messages) == 1
+            assert not app.screen.query(Chatbox).filter(".assistant-message")
+
+    asyncio.run(run())
+    assert assistant_rows() == []
+
+
+def test_completed_response_is_no_longer_partial(database, monkeypatch):
+    monkeypatch.setattr(
+        litellm, "acompletion", fake_stream(["All", " done"], fail=False)
+    )
+
+    async def run() -> None:
+        app = Elia(LaunchConfig())
+        async with app.run_test() as pilot:
+            chat = await send_prompt(app, pilot, "Hi")
+            assert not chat.chat_data.messages[-1].partial
+
+    asyncio.run(run())
+    assert assistant_rows() == [("All done", None)]
+
+
+def test_empty_partial_response_is_requested_again(database, monkeypatch):
+    """Older versions saved an empty response before any of it arrived."""
+    config = LaunchConfig()
+    model = config.default_model_object
+    now = datetime.datetime.now(datetime.timezone.utc)
+    chat_data = ChatData(
+        id=None,
+        title=None,
+        create_timestamp=None,
+        model=model,
+        messages=[
+            ChatMessage({"role": "system", "content": "Be brief."}, now, model),
+            ChatMessage({"role": "user", "content": "Hi"}, now, model),
+            ChatMessage({"role": "assistant", "content": ""}, now, model, partial=True),
+        ],
+    )
+    chat_id = asyncio.run(ChatsManager.create_chat(chat_data))
+    sent_messages = []
+    stream = fake_stream(["Hello"], fail=False)
+
+    async def acompletion(**kwargs):
+        sent_messages.extend(kwargs["messages"])
+        return await stream(**kwargs)
+
+    monkeypatch.setattr(litellm, "acompletion", acompletion)
+
+    async def run() -> None:
+        app = Elia(config)
+        async with app.run_test() as pilot:
+            await pilot.pause()
+            loaded = await ChatsManager.get_chat(chat_id)
+            await app.push_screen(ChatScreen(loaded))
+            await pilot.pause()
+            await app.workers.wait_for_complete()
+
+    asyncio.run(run())
+    assert [message["role"] for message in sent_messages] == ["system", "user"]
+    assert assistant_rows() == [("Hello", None)]
+
+
+@pytest.mark.parametrize("partial", [True, False])
+def test_partial_flag_round_trips(database, partial):
+    config = LaunchConfig()
+    model = config.default_model_object
+    now = datetime.datetime.now(datetime.timezone.utc)
+    chat_data = ChatData(
+        id=None,
+        title=None,
+        create_timestamp=None,
+        model=model,
+        messages=[
+            ChatMessage({"role": "system", "content": "Be brief."}, now, model),
+            ChatMessage({"role": "user", "content": "Hi"}, now, model),
+            ChatMessage(
+                {"role": "assistant", "content": "Hel"}, now, model, partial=partial
+            ),
+        ],
+    )
+
+    async def run() -> None:
+        chat_id = await ChatsManager.create_chat(chat_data)
+        loaded = await ChatsManager.get_chat(chat_id)
+        assert loaded.messages[-1].partial == partial
+
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+import io
+import re
+
+import pytest
+from rich.console import Console, RenderableType
+from rich.markdown import Markdown
+
+from elia_chat.widgets.streaming_markdown import StreamingMarkdown
+
+PARAGRAPHS = "First paragraph,\nover two lines.\n\nSecond *paragraph*.\n"
+LISTS = "Intro\n\n- One\n- Two\n  - Nested\n\n1. First\n2. Second\n\nAfter.\n"
+FENCED_CODE = "Code:\n\n```python\ndef f():\n\n    return 1\n```\n\nDone.\n"
+TABLE = "Table:\n\n| Name | Value |\n| ---- | ----: |\n| a | 1 |\n| b | 22 |\n\nEnd.\n"
+RULE = "Above\n\n---\n\nBelow\n\n***\n- Item\n"
+REFERENCE_LINKS = "See [the docs][docs].\n\nMore text.\n\n[docs]: https://example.com\n"
+
+
+def render(renderable: RenderableType, width: int = 40) -> str:
+    console = Console(
+        file=io.StringIO(), width=width, force_terminal=True, color_system="truecolor"
+    )
+    console.print(renderable)
+    output = console.file.getvalue()  # type: ignore[attr-defined]
+    # Rich gives each hyperlink a random ID.
+    return re.sub(r"\x1b]8;id=\d+;", "\x1b]8;;", output)
+
+
+@pytest.mark.parametrize(
+    "markup", [PARAGRAPHS, LISTS, FENCED_CODE, TABLE, RULE, REFERENCE_LINKS]
+)
+@pytest.mark.parametrize("chunk_size", [1, 3, 8])
+def test_chunked_appends_render_like_the_whole_markdown(markup, chunk_size):
+    streaming = StreamingMarkdown()
+    for start in range(0, len(markup), chunk_size):
+        streaming.append(markup[start : start + chunk_size])
+        # Render as it arrives, so the finished blocks are kept between chunks.
+        render(streaming)
+    assert streaming.markup == markup
+    assert render(streaming) == render(Markdown(markup))
+
+
+@pytest.mark.parametrize("markup", [PARAGRAPHS, TABLE, RULE])
+def test_finished_blocks_are_rendered_again_at_a_new_width(markup):
+    streaming = StreamingMarkdown()
+    for line in markup.splitlines(keepends=True):
+        streaming.append(line)
+        render(streaming, width=40)
+    assert render(streaming, width=30) == render(Markdown(markup), width=30)
+    assert render(streaming, width=40) == render(Markdown(markup), width=40)
+
+
+def test_a_reference_definition_changes_earlier_links():
+    streaming = StreamingMarkdown("See [the docs][docs].\n\nMore text.\n\n")
+    assert "[docs]" in render(streaming)
+
+    streaming.append("[docs]: https://exa")
+    streaming.append("mple.com\n")
+    rendered = render(streaming)
+    assert "[docs]" not in rendered
+    assert rendered == render(Markdown(streaming.markup))
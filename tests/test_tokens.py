@@ -0,0 +1,179 @@
+import asyncio
+import datetime
+import sqlite3
+
+import litellm
+from sqlalchemy import event
+
+from elia_chat.app import Elia
+from elia_chat.chats_manager import ChatsManager
+from elia_chat.config import LaunchConfig
+from elia_chat.database.database import engine, sqlite_file_name
+from elia_chat.database.models import MessageDao
+from elia_chat.models import ChatData, ChatMessage
+from elia_chat.screens.chat_screen import ChatScreen
+from elia_chat.tokens import backfill_token_counts
+from elia_chat.widgets import chat as chat_widget
+
+
+def long_chat(message_count: int) -> ChatData:
+    model = LaunchConfig().default_model_object
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    messages = [ChatMessage({"role": "system", "content": "Be brief."}, start, model)]
+    for index in range(1, message_count + 1):
+        role = "user" if index % 2 else "assistant"
+        timestamp = start + datetime.timedelta(minutes=index)
+        messages.append(
+            ChatMessage({"role": role, "content": f"Message {index}"}, timestamp, model)
+        )
+    return ChatData(
+        id=None, title=None, create_timestamp=None, model=model, messages=messages
+    )
+
+
+def test_older_message_tokens_are_added_up_from_stored_counts(database):
+    async def run() -> None:
+        chat_data = long_chat(10)
+        chat_id = await ChatsManager.create_chat(chat_data)
+        model_name = chat_data.model.name
+        # Count every message except the first user message.
+        await ChatsManager.save_token_counts(
+            {
+                message.id: {model_name: index}
+                for index, message in enumerate(chat_data.messages)
+                if index != 1 and message.id is not None
+            },
+            [chat_id],
+        )
+
+        opened = await ChatsManager.get_chat(chat_id, message_limit=4)
+        assert opened.older_message_count == 6
+        # Messages 1 to 6 haven't been loaded, and message 1 wasn't counted.
+        tokens = await ChatsManager.older_message_tokens(opened, model_name)
+        assert tokens == (2 + 3 + 4 + 5 + 6, 1)
+        assert await ChatsManager.older_message_tokens(opened, "other-model") == (
+            0,
+            6,
+        )
+
+    asyncio.run(run())
+
+
+def test_chats_loaded_in_full_have_no_older_message_tokens(database):
+    async def run() -> None:
+        chat_data = long_chat(4)
+        chat_id = await ChatsManager.create_chat(chat_data)
+        opened = await ChatsManager.get_chat(chat_id)
+        assert await ChatsManager.older_message_tokens(opened, "gpt-4o") == (0, 0)
+
+    asyncio.run(run())
+
+
+def save_counts(chat_data: ChatData, counts: list[int]) -> None:
+    model_name = chat_data.model.name
+    assert chat_data.id is not None
+    asyncio.run(
+        ChatsManager.save_token_counts(
+            {
+                message.id: {model_name: tokens}
+                for message, tokens in zip(chat_data.messages, counts)
+                if message.id is not None
+            },
+            [chat_data.id],
+        )
+    )
+
+
+def test_older_messages_within_tokens_are_counted_newest_first(database):
+    chat_data = long_chat(10)
+    chat_data.id = asyncio.run(ChatsManager.create_chat(chat_data))
+    save_counts(chat_data, [100, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+
+    async def count(tokens: int) -> int:
+        opened = await ChatsManager.get_chat(chat_data.id, message_limit=4)
+        return await ChatsManager.count_older_messages_within_tokens(
+            opened, chat_data.model.name, tokens
+        )
+
+    # Messages 1 to 6 haven't been loaded.
+    assert asyncio.run(count(0)) == 0
+    assert asyncio.run(count(6)) == 1
+    assert asyncio.run(count(10)) == 1
+    assert asyncio.run(count(11)) == 2
+    assert asyncio.run(count(1000)) == 6
+
+
+def test_only_older_messages_which_could_fit_are_loaded(database, monkeypatch):
+    chat_data = long_chat(11)
+    chat_data.id = asyncio.run(ChatsManager.create_chat(chat_data))
+    save_counts(chat_data, [10] * 12)
+    # The system prompt and the 4 most recent messages are loaded (53 tokens,
+    # with the reply priming), leaving room for 2 of the older messages.
+    monkeypatch.setattr(chat_widget, "context_budget", lambda model_name: 78)
+
+    limits = []
+    get_older_messages = ChatsManager.get_older_messages
+
+    async def record_limit(chat_data, limit=None):
+        limits.append(limit)
+        return await get_older_messages(chat_data, limit)
+
+    monkeypatch.setattr(ChatsManager, "get_older_messages", record_limit)
+    sent_messages = []
+
+    async def acompletion(**kwargs):
+        sent_messages.extend(kwargs["messages"])
+        raise ConnectionError("Not connected")
+
+    monkeypatch.setattr(litellm, "acompletion", acompletion)
+
+    async def run() -> None:
+        app = Elia(LaunchConfig())
+        async with app.run_test() as pilot:
+            await pilot.pause()
+            opened = await ChatsManager.get_chat(chat_data.id, message_limit=4)
+            await app.push_screen(ChatScreen(opened))
+            await pilot.pause()
+            await app.workers.wait_for_complete()
+
+    asyncio.run(run())
+    # The next oldest message may be shortened to fit, so it's loaded too.
+    assert limits == [3]
+    contents = [message["content"] for message in sent_messages]
+    assert contents[0] == "Be brief."
+    assert contents[-6:] == [f"Message {index}" for index in range(6, 12)]
+    assert "Message 4" not in contents
+
+
+def test_uncounted_messages_are_found_with_the_partial_index(database):
+    asyncio.run(ChatsManager.create_chat(long_chat(4)))
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, many):
+        statements.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record_statement)
+    try:
+        asyncio.run(MessageDao.without_token_counts(after_id=0, limit=500))
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record_statement)
+    [(statement, parameters)] = [
+        (statement, parameters)
+        for statement, parameters in statements
+        if "json_type" in statement
+    ]
+    with sqlite3.connect(sqlite_file_name) as connection:
+        connection.create_function("message_content", 2, lambda *args: None)
+        plan = connection.execute(
+            f"EXPLAIN QUERY PLAN {statement}", parameters
+        ).fetchall()
+    assert any("ix_message_uncounted" in detail for *_, detail in plan)
+
+    # Once every message has been counted, the index is empty.
+    assert asyncio.run(backfill_token_counts()) == 5
+    with sqlite3.connect(sqlite_file_name) as connection:
+        uncounted = connection.execute(
+            "SELECT count(*) FROM message INDEXED BY ix_message_uncounted "
+            "WHERE active AND json_type(meta, '$.tokens') IS NULL"
+        ).fetchone()
+    assert uncounted == (0,)